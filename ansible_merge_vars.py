@@ -5,10 +5,73 @@ An Ansible action plugin to allow explicit merging of dict and list facts.
 
 """
 
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+import cProfile
+import hashlib
+import json
+import os
+import tempfile
+from timeit import default_timer
+
 from ansible.plugins.action import ActionBase
 from ansible.errors import AnsibleError
+from ansible.parsing.ajson import AnsibleJSONEncoder
+from ansible.module_utils.six import string_types, viewkeys
+from ansible.template import Templar
 from ansible.utils.vars import isidentifier
 
+# The merge engine is in its own module, which doesn't need Ansible.  Names
+# that aren't used here are imported so they can still be imported from here.
+from ansible_merge_vars_core import (  # pylint: disable=unused-import
+    APPEND,
+    LIST_MERGES,
+    SORTED_UNION,
+    _OPAQUE,
+    DictMerger,
+    KeyedMerge,
+    ListMerger,
+    LRUCache,
+    MergeError,
+    NotCacheable,
+    PersistentCache,
+    SeenSet,
+    SuffixIndex,
+    SuffixScan,
+    check_type,
+    content_digest,
+    deduplicate,
+    fingerprint,
+    flatten,
+    is_sorted,
+    merge_dict,
+    merge_list,
+    merge_values,
+    sorted_union,
+)
+from ansible_merge_vars_caching import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_PERSISTENT_CACHE_AGE,
+    DEFAULT_PERSISTENT_CACHE_SIZE,
+    MERGE_CACHE,
+    PERSISTENT_CACHE_ENV,
+    merge_cache_for,
+    merge_cache_key,
+    persistent_cache_for,
+    persistent_cache_key,
+)
+from ansible_merge_vars_output import OUTPUT_FORMATS, write_output
+from ansible_merge_vars_templates import (
+    DEFAULT_TEMPLATE_CACHE_SIZE,
+    TEMPLATE_CACHE,
+    CachingTemplar,
+    defer_templates,
+    has_templates,
+    render_deferred,
+    render_templates,
+    template_dependencies,
+)
+
 
 # Funky import dance for Ansible backwards compatitility (not sure if we
 # actually need to do this or not)
@@ -29,12 +92,34 @@ class ActionModule(ActionBase):
 
     """
     def run(self, tmp=None, task_vars=None):
-        suffix_to_merge = self._task.args.get('suffix_to_merge', '')
-        merged_var_name = self._task.args.get('merged_var_name', '')
-        dedup = self._task.args.get('dedup', True)
-        expected_type = self._task.args.get('expected_type')
-        recursive_dict_merge = bool(self._task.args.get('recursive_dict_merge', False))
+        profile_dir = os.environ.get(PROFILE_DIR_ENV)
+        if not profile_dir:
+            return self._run(task_vars)
+
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self._run, task_vars)
+        finally:
+            dump_profile(profile, profile_dir, (task_vars or {}).get('inventory_hostname'))
+
+    def _run(self, task_vars):
+        stats_wanted = self._task.args.get(
+            'merge_stats', os.environ.get(STATS_ENV, '').lower() in ('1', 'yes', 'true')
+        )
+        stats = MergeStats() if stats_wanted else NO_STATS
+        with stats.phase('total'):
+            try:
+                result = self._merge_all(task_vars, stats)
+            except MergeError as e:
+                raise AnsibleError(str(e))
+        if stats is not NO_STATS:
+            result['merge_stats'] = stats.result()
+            display.vvv("merge_vars stats: {}".format(
+                json.dumps(result['merge_stats'], sort_keys=True)
+            ))
+        return result
 
+    def _merge_all(self, task_vars, stats):
         if 'cacheable' in self._task.args.keys():
             display.deprecated(
                 "The `cacheable` option does not actually do anything, since Ansible 2.5. "
@@ -44,110 +129,588 @@ class ActionModule(ActionBase):
                 "will be removed in a future version of this plugin."
             )
 
-        # Validate args
-        if expected_type not in ['dict', 'list']:
-            raise AnsibleError("expected_type must be set ('dict' or 'list').")
-        if not merged_var_name:
-            raise AnsibleError("merged_var_name must be set")
-        if not isidentifier(merged_var_name):
-            raise AnsibleError("merged_var_name '%s' is not a valid identifier" % merged_var_name)
-        if not suffix_to_merge.endswith('__to_merge'):
-            raise AnsibleError("Merge suffix must end with '__to_merge', sorry!")
+        specs = merge_specs(self._task.args)
+
+        persistent_cache = self._persistent_cache()
+        merge_cache = None
+        if self._task.args.get('cache', False):
+            merge_cache = merge_cache_for(persistent_cache, display.warning)
+        MERGE_CACHE.resize(positive_int(self._task.args, 'cache_size', DEFAULT_CACHE_SIZE))
+
+        templar = self._templar
+        if self._task.args.get('template_cache', False):
+            TEMPLATE_CACHE.resize(positive_int(
+                self._task.args, 'template_cache_size', DEFAULT_TEMPLATE_CACHE_SIZE
+            ))
+            templar = CachingTemplar(self._templar, task_vars, TEMPLATE_CACHE)
+
+        context = MergeContext(task_vars, templar, merge_cache, persistent_cache)
+
+        host_indexes = None
+        hosts = hosts_to_merge(self._task.args, task_vars)
+        if hosts is not None:
+            if not self._task.run_once:
+                display.warning(
+                    "merge_vars with across_hosts merges the vars of every host again for "
+                    "each host that it runs for; set run_once to only merge them once"
+                )
+            with stats.phase('scan'):
+                host_indexes = self._host_indexes(hosts, task_vars, len(specs))
+
+        facts = self._merge_each(specs, context, stats, host_indexes)
+
+        if templar is not self._templar:
+            display.vvv(
+                "merge_vars template cache: {} hits, {} misses, {} entries".format(
+                    TEMPLATE_CACHE.hits, TEMPLATE_CACHE.misses, len(TEMPLATE_CACHE),
+                )
+            )
+
+        changed = False
+        if self._task.args.get('skip_unchanged', False):
+            with stats.phase('compare'):
+                facts = changed_facts(facts, task_vars)
+            changed = bool(facts)
+        return {
+            'ansible_facts': facts,
+            'changed': changed,
+        }
+
+    def _persistent_cache(self):
+        path = self._task.args.get('persistent_cache', os.environ.get(PERSISTENT_CACHE_ENV))
+        if not path:
+            return None
+        return persistent_cache_for(
+            path,
+            positive_int(
+                self._task.args, 'persistent_cache_max_size', DEFAULT_PERSISTENT_CACHE_SIZE
+            ),
+            positive_int(
+                self._task.args, 'persistent_cache_max_age', DEFAULT_PERSISTENT_CACHE_AGE
+            ),
+            display.warning,
+        )
+
+    def _host_indexes(self, hosts, task_vars, lookups):
+        """
+        For merging across hosts, a MergeContext for each of hosts, with its
+        raw vars and a templar that renders them with its vars, and a
+        suffix_index() of its vars for lookups suffixes
+        """
+        hostvars = task_vars.get('hostvars')
+        if hostvars is None:
+            raise AnsibleError("across_hosts needs hostvars")
+        contexts = []
+        for host in hosts:
+            host_vars = raw_host_vars(hostvars, host)
+            try:
+                templar = self._templar.copy_with_new_env(available_variables=host_vars)
+            except AttributeError:
+                # copy_with_new_env was added in Ansible 2.10
+                templar = Templar(loader=self._loader, variables=host_vars)
+            if self._task.args.get('template_cache', False):
+                templar = CachingTemplar(templar, host_vars, TEMPLATE_CACHE)
+            contexts.append((
+                MergeContext(host_vars, templar, None, None),
+                suffix_index(host_vars, lookups),
+            ))
+        return contexts
+
+    def _merge_each(self, specs, context, stats, host_indexes=None):
+        """
+        The merged value for each spec, by merged_var_name, from the vars of
+        each host in host_indexes if it's set, or else from the task vars
+        """
+        template_cache_before = (TEMPLATE_CACHE.hits, TEMPLATE_CACHE.misses)
+        persistent_cache = context.persistent_cache
+        if persistent_cache is not None:
+            persistent_cache_before = (persistent_cache.hits, persistent_cache.misses)
+
+        # Every merge in a batch uses the same index of the vars' names
+        if host_indexes is None:
+            with stats.phase('scan'):
+                index = suffix_index(context.task_vars, len(specs))
+        facts = {}
+        for spec in specs:
+            name = spec['merged_var_name']
+            merge_stats = stats.for_merge(name)
+            with merge_stats.phase('total'):
+                if host_indexes is not None:
+                    merged = merge_across_hosts(spec, host_indexes, merge_stats)
+                else:
+                    with merge_stats.phase('scan'):
+                        keys = index.matching(spec['suffix_to_merge'])
+                    merged = merge_one(spec, keys, context, merge_stats)
+                if spec['output_file']:
+                    with merge_stats.phase('write'):
+                        merged = write_output(
+                            merged, spec['output_file'], spec['output_format'],
+                        )
+                    display.v("merge_vars: wrote {} bytes to {}".format(
+                        merged['bytes'], merged['path'],
+                    ))
+                    # The file's already been serialized once
+                    merge_stats.record(output_bytes=merged['bytes'])
+                else:
+                    merge_stats.record_output(merged)
+                facts[name] = merged
+
+        if isinstance(context.templar, CachingTemplar):
+            stats.record(
+                template_cache_hits=TEMPLATE_CACHE.hits - template_cache_before[0],
+                template_cache_misses=TEMPLATE_CACHE.misses - template_cache_before[1],
+            )
+        if persistent_cache is not None:
+            stats.record(
+                persistent_cache_hits=persistent_cache.hits - persistent_cache_before[0],
+                persistent_cache_misses=persistent_cache.misses - persistent_cache_before[1],
+            )
+        return facts
+
 
-        keys = sorted([key for key in task_vars.keys()
-                       if key.endswith(suffix_to_merge)])
+def merge_one(spec, keys, context, stats):
+    """
+    Merge the vars named in keys for one spec, with the templar and caches of
+    context.  The lookup plugin uses this too.
 
-        display.v("Merging vars in this order: {}".format(keys))
+    """
+    display.v("Merging vars in this order: {}".format(keys))
+    stats.record(sources=len(keys))
+
+    # Hosts that share the same inputs (the merge vars themselves, and
+    # any vars their templates reference) get the same merged value, so
+    # there's no need to template and merge them again.
+    cache_key = None
+    if context.merge_cache is not None or context.persistent_cache is not None:
+        with stats.phase('cache_key'):
+            cache_key = merge_cache_key(spec, keys, context.task_vars)
 
+    merged = None
+    if cache_key is not None:
+        with stats.phase('cache_lookup'):
+            merged = cached_merge(context, cache_key)
+    cached = merged is not None
+    stats.record(cached=cached)
+    if not cached:
         # We need to render any jinja in the merged var now, because once it
         # leaves this plugin, ansible will cleanse it by turning any jinja tags
         # into comments.
         # And we need it done before merging the variables,
         # in case any structured data is specified with templates.
-        merge_vals = [self._templar.template(task_vars[key]) for key in keys]
-
-        # Dispatch based on type that we're merging
-        if merge_vals == []:
-            if expected_type == 'list':
-                merged = []
-            else:
-                merged = {}
-        elif isinstance(merge_vals[0], list):
-            merged = merge_list(merge_vals, dedup)
-        elif isinstance(merge_vals[0], dict):
-            merged = merge_dict(merge_vals, dedup, recursive_dict_merge)
-        else:
-            raise AnsibleError(
-                "Don't know how to merge variables of type: {}".format(type(merge_vals[0]))
-            )
+        with stats.phase('template'):
+            merge_vals = [prepare_source(context, spec, key) for key in keys]
+        merged = merge_prepared(spec, merge_vals, stats)
+        if cache_key is not None:
+            store_merge(context, cache_key, merged)
 
-        return {
-            'ansible_facts': {merged_var_name: merged},
-            'changed': False,
-        }
+    if context.merge_cache is not None:
+        display.vvv("merge_vars cache: {}".format(
+            'uncacheable' if cache_key is None else 'key {}, {}'.format(
+                cache_key, 'hit' if cached else 'miss',
+            )
+        ))
+    stats.record(items_after_dedup=len(merged))
+    return merged
 
 
-def merge_dict(merge_vals, dedup, recursive_dict_merge):
+def merge_across_hosts(spec, host_indexes, stats):
     """
-    To merge dicts, just update one with the values of the next, etc.
+    Merge the vars for one spec from every host, host by host, with each
+    host's vars rendered with its own vars.  host_indexes has a MergeContext
+    and a suffix_index() of its vars for each host.
+
     """
-    check_type(merge_vals, dict)
-    merged = {}
-    for val in merge_vals:
-        if not recursive_dict_merge:
-            merged.update(val)
-        else:
-            # Recursive merging of dictionaries with overlapping keys:
-            #   LISTS: merge with merge_list
-            #   DICTS: recursively merge with merge_dict
-            #   any other types: replace (same as usual behaviour)
-            for key in val.keys():
-                if not key in merged:
-                    # first hit of the value - just assign
-                    merged[key] = val[key]
-                elif isinstance(merged[key], list):
-                    merged[key] = merge_list([merged[key], val[key]], dedup)
-                elif isinstance(merged[key], dict):
-                    merged[key] = merge_dict([merged[key], val[key]], dedup, recursive_dict_merge)
-                else:
-                    merged[key] = val[key]
+    with stats.phase('scan'):
+        sources = [
+            (host_context, key)
+            for host_context, index in host_indexes
+            for key in index.matching(spec['suffix_to_merge'])
+        ]
+    display.v("Merging vars of {} hosts in this order: {}".format(
+        len(host_indexes),
+        [(host_context.task_vars.get('inventory_hostname'), key) for host_context, key in sources],
+    ))
+    stats.record(sources=len(sources), cached=False)
+    with stats.phase('template'):
+        merge_vals = [prepare_source(host_context, spec, key) for host_context, key in sources]
+    merged = merge_prepared(spec, merge_vals, stats)
+    stats.record(items_after_dedup=len(merged))
     return merged
 
 
-def merge_list(merge_vals, dedup):
-    """ To merge lists, just concat them. Dedup if wanted. """
-    check_type(merge_vals, list)
-    merged = flatten(merge_vals)
-    if dedup:
-        merged = deduplicate(merged)
+def merge_prepared(spec, merge_vals, stats):
+    """ Merge the values from prepare_source() for one spec """
+    stats.record(items_before_dedup=sum(
+        len(val) for val in merge_vals if isinstance(val, (dict, list))
+    ))
+
+    # Top level lists are deduped as a separate step, so that it can be
+    # timed separately.  merge_values() merges dicts or lists depending on
+    # what the values are, whatever expected_type says, so this has to too.
+    list_merge = list_merge_for(spec)
+    top_level_dedup = (
+        spec['dedup'] and list_merge == APPEND
+        and bool(merge_vals) and isinstance(merge_vals[0], list)
+    )
+    with stats.phase('merge'):
+        merged = merge_values(
+            merge_vals, spec['expected_type'], spec['dedup'] and not top_level_dedup,
+            spec['recursive_dict_merge'], list_merge=list_merge,
+        )
+    if isinstance(merged, dict):
+        with stats.phase('template'):
+            merged = render_deferred(merged)
+    if top_level_dedup:
+        with stats.phase('dedup'):
+            merged = deduplicate(merged)
+    return merged
+
+
+def cached_merge(context, cache_key):
+    """
+    The merged value for cache_key from the in-memory cache, or else from the
+    persistent cache (or None if neither has it).
+
+    """
+    merged = None
+    if context.merge_cache is not None:
+        merged = context.merge_cache.get(cache_key)
+    if merged is None and context.persistent_cache is not None:
+        merged = context.persistent_cache.get(persistent_cache_key('merge', cache_key))
+        if merged is not None and context.merge_cache is not None:
+            context.merge_cache.set(cache_key, merged)
     return merged
 
 
-def check_type(mylist, _type):
-    """ Ensure that all members of mylist are of type _type. """
-    if not all(isinstance(item, _type) for item in mylist):
-        raise AnsibleError("All values to merge must be of the same type, either dict or list")
+def store_merge(context, cache_key, merged):
+    if context.merge_cache is not None:
+        context.merge_cache.set(cache_key, merged)
+    if context.persistent_cache is not None:
+        context.persistent_cache.set(persistent_cache_key('merge', cache_key), merged)
+
+
+def prepare_source(context, spec, key):
+    """
+    One of the vars to merge, ready to be merged.  Templates in dicts that
+    might be overridden by a later var are left unrendered, for
+    render_deferred() to render if they're still in the merged value.  With
+    a persistent cache, whole vars are rendered, so they can be stored in it.
+
+    """
+    value = context.task_vars[key]
+    if context.persistent_cache is not None or not isinstance(value, dict):
+        return render_source(context, key)
+    return defer_templates(context.templar, value, spec['recursive_dict_merge'])
+
+
+def render_source(context, key):
+    """
+    Render the templates in one of the vars to merge.  With a persistent
+    cache, the rendered value is stored in it, and reused for as long as the
+    var and every var that its templates reference stay the same.
+
+    """
+    value = context.task_vars[key]
+    cache = context.persistent_cache
+    if cache is None or not has_templates(value):
+        return render_templates(context.templar, value)
+    try:
+        digest = content_digest([
+            value, template_dependencies([value], context.task_vars),
+        ])
+    except NotCacheable:
+        return render_templates(context.templar, value)
+
+    source_key = persistent_cache_key('source', digest)
+    rendered = cache.get(source_key)
+    if rendered is None:
+        rendered = render_templates(context.templar, value)
+        cache.set(source_key, rendered)
+    return rendered
+
+
+def changed_facts(facts, task_vars):
+    """
+    Only the facts that don't have the same content as the existing fact (or
+    var) with the same name.
+
+    """
+    existing = task_vars.get('ansible_facts') or {}
+    changed = {}
+    for name, value in facts.items():
+        current = existing[name] if name in existing else task_vars.get(name, _OPAQUE)
+        digest = fact_digest(value)
+        if current is not _OPAQUE and digest is not None and fact_digest(current) == digest:
+            display.v("merge_vars: {} is unchanged".format(name))
+        else:
+            changed[name] = value
+    return changed
+
+
+def fact_digest(value):
+    """
+    A digest of value as it would be stored in the fact cache, so it ignores
+    the differences that don't survive being stored there, like tuples vs
+    lists, unsafe vs safe strings, and the order of dict keys.  Returns None
+    if value can't be serialized.
+
+    """
+    try:
+        serialized = json.dumps(value, cls=AnsibleJSONEncoder, sort_keys=True)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+# Everything that's shared by all of the merges in one run of the plugin
+MergeContext = namedtuple(
+    'MergeContext', ['task_vars', 'templar', 'merge_cache', 'persistent_cache'],
+)
+
+
+# Name of the environment variable with the directory to write a cProfile
+# dump to, for each run of the plugin
+PROFILE_DIR_ENV = 'ANSIBLE_MERGE_VARS_PROFILE_DIR'
+
+# Name of the environment variable that turns merge_stats on by default
+STATS_ENV = 'ANSIBLE_MERGE_VARS_STATS'
+
+# How many suffixes have to be looked up before sorting the names into a
+# SuffixIndex is quicker than checking all of them for each suffix.  Measured
+# at 4 to 6 lookups, for 500 to 5000 names.
+SUFFIX_INDEX_MIN_LOOKUPS = 5
+
+
+def dump_profile(profile, profile_dir, hostname):
+    """ Write profile to a new file in profile_dir """
+    if not os.path.isdir(profile_dir):
+        try:
+            os.makedirs(profile_dir)
+        except OSError:
+            # Someone else made it first
+            if not os.path.isdir(profile_dir):
+                raise
+    handle, path = tempfile.mkstemp(
+        prefix='merge_vars-{}-'.format(hostname or 'unknown'), suffix='.prof', dir=profile_dir,
+    )
+    os.close(handle)
+    profile.dump_stats(path)
+    display.vvv("merge_vars profile written to {}".format(path))
+
+
+class MergeStats(object):
+    """
+    Timings (in seconds) of each phase of a run, and sizes of what was
+    merged, for the whole run and for each merge in it.  Time spent in a
+    merge's phases is added to the run's phases too.
+
+    """
+    def __init__(self, parent=None):
+        self.seconds = {}
+        self.sizes = {}
+        self._parent = parent
+        self._merges = OrderedDict()
+
+    def for_merge(self, name):
+        """ Stats for one merge of the run """
+        stats = MergeStats(parent=self)
+        self._merges[name] = stats
+        return stats
+
+    @contextmanager
+    def phase(self, name):
+        start = default_timer()
+        try:
+            yield
+        finally:
+            self.add_time(name, default_timer() - start)
+
+    def add_time(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        if self._parent is not None and name != 'total':
+            self._parent.add_time(name, seconds)
+
+    def record(self, **sizes):
+        self.sizes.update(sizes)
+
+    def record_output(self, merged):
+        self.record(output_bytes=len(json.dumps(merged, cls=AnsibleJSONEncoder)))
+
+    def result(self):
+        result = dict(self.sizes, seconds=dict(self.seconds))
+        if self._merges:
+            result['merges'] = dict(
+                (name, stats.result()) for name, stats in self._merges.items()
+            )
+        return result
+
+
+class _NoStats(object):
+    """ Does nothing, for when stats aren't wanted """
+    @contextmanager
+    def phase(self, name):  # pylint: disable=unused-argument
+        yield
+
+    def for_merge(self, name):  # pylint: disable=unused-argument
+        return self
+
+    def record(self, **sizes):
+        pass
+
+    def record_output(self, merged):
+        pass
+
+
+NO_STATS = _NoStats()
+
+
+# Options that can be set for each merge, either as task args or in each item
+# of the `merges` task arg.  Task args are the defaults for `merges` items.
+MERGE_OPTIONS = (
+    'suffix_to_merge', 'merged_var_name', 'expected_type', 'dedup', 'recursive_dict_merge',
+    'list_merge', 'list_merge_key', 'output_file', 'output_format',
+)
+
+
+def list_merge_for(spec):
+    """ How to merge lists for spec: APPEND, SORTED_UNION or a KeyedMerge """
+    if spec['list_merge_key'] is not None:
+        return KeyedMerge(spec['list_merge_key'], spec['recursive_dict_merge'])
+    return spec['list_merge']
+
+
+def merge_specs(task_args):
+    """
+    Validated merge specs for the task: one for a normal task, or one for each
+    item of `merges` in batch mode.
+
+    """
+    merges = task_args.get('merges')
+    if merges is None:
+        return [merge_spec(task_args)]
+
+    if not isinstance(merges, list) or not merges:
+        raise AnsibleError("merges must be a non-empty list of merges")
+    if 'suffix_to_merge' in task_args or 'merged_var_name' in task_args:
+        raise AnsibleError(
+            "suffix_to_merge and merged_var_name must be set for each of the merges, "
+            "not for the whole task"
+        )
 
+    specs = []
+    for merge in merges:
+        if not isinstance(merge, dict):
+            raise AnsibleError("Each of the merges must be a dict, got: {}".format(merge))
+        args = dict(
+            (name, val) for name, val in task_args.items() if name in MERGE_OPTIONS
+        )
+        args.update(merge)
+        specs.append(merge_spec(args))
 
-def flatten(list_of_lists):
+    for option in ('merged_var_name', 'output_file'):
+        values = [spec[option] for spec in specs if spec[option]]
+        duplicates = sorted(set(val for val in values if values.count(val) > 1))
+        if duplicates:
+            raise AnsibleError("{} used for more than one merge: {}".format(option, duplicates))
+    return specs
+
+
+def hosts_to_merge(task_args, task_vars):
     """
-    Flattens a list of lists:
-        >>> flatten([[1, 2] [3, 4]])
-        [1, 2, 3, 4]
+    The names of the hosts to merge vars across, from the across_hosts task
+    arg (a group name, or a list of host names), or None to merge the task
+    vars like usual
 
-    I wish Python had this in the standard lib :(
     """
-    return list((x for y in list_of_lists for x in y))
+    across_hosts = task_args.get('across_hosts')
+    if across_hosts is None:
+        return None
+    if isinstance(across_hosts, string_types):
+        groups = task_vars.get('groups') or {}
+        if across_hosts not in groups:
+            raise AnsibleError("across_hosts: there's no group called {}".format(across_hosts))
+        across_hosts = groups[across_hosts]
+    if not isinstance(across_hosts, (list, tuple)) or not all(
+            isinstance(host, string_types) for host in across_hosts):
+        raise AnsibleError("across_hosts must be a group name, or a list of host names")
+    # Each host only once, in case it's in a list of groups more than once
+    return list(OrderedDict.fromkeys(across_hosts))
+
 
+def raw_host_vars(hostvars, host):
+    """ A host's vars from hostvars, without rendering their templates """
+    try:
+        host_vars = hostvars.raw_get(host)
+    except AttributeError:
+        # A plain dict, rather than Ansible's HostVars
+        host_vars = hostvars.get(host)
+    if not isinstance(host_vars, dict):
+        raise AnsibleError("across_hosts: there's no host called {}".format(host))
+    return host_vars
 
-def deduplicate(mylist):
+
+def positive_int(args, name, default):
+    """ Get an arg that has to be a positive integer """
+    try:
+        value = int(args.get(name, default))
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise AnsibleError("{} must be a positive integer".format(name))
+    return value
+
+
+def merge_spec(args):
+    """ Validate the options for one merge, and fill in the defaults """
+    spec = {
+        'suffix_to_merge': args.get('suffix_to_merge', ''),
+        'merged_var_name': args.get('merged_var_name', ''),
+        'dedup': args.get('dedup', True),
+        'expected_type': args.get('expected_type'),
+        'recursive_dict_merge': bool(args.get('recursive_dict_merge', False)),
+        'list_merge': args.get('list_merge', APPEND),
+        'list_merge_key': args.get('list_merge_key'),
+        'output_file': args.get('output_file'),
+        'output_format': args.get('output_format', 'json'),
+    }
+
+    if spec['expected_type'] not in ['dict', 'list']:
+        raise AnsibleError("expected_type must be set ('dict' or 'list').")
+    if not spec['merged_var_name']:
+        raise AnsibleError("merged_var_name must be set")
+    if not isidentifier(spec['merged_var_name']):
+        raise AnsibleError(
+            "merged_var_name '%s' is not a valid identifier" % spec['merged_var_name']
+        )
+    if not spec['suffix_to_merge'].endswith('__to_merge'):
+        raise AnsibleError("Merge suffix must end with '__to_merge', sorry!")
+    if spec['list_merge'] not in LIST_MERGES:
+        raise AnsibleError("list_merge must be one of: {}".format(', '.join(LIST_MERGES)))
+    if spec['list_merge_key'] is not None:
+        if not isinstance(spec['list_merge_key'], string_types) or not spec['list_merge_key']:
+            raise AnsibleError("list_merge_key must be a non-empty string")
+        if spec['list_merge'] != APPEND:
+            raise AnsibleError("list_merge_key can't be used with list_merge: {}".format(
+                spec['list_merge']
+            ))
+    if spec['output_file'] is not None and not isinstance(spec['output_file'], string_types):
+        raise AnsibleError("output_file must be a path")
+    if spec['output_format'] not in OUTPUT_FORMATS:
+        raise AnsibleError("output_format must be one of: {}".format(', '.join(OUTPUT_FORMATS)))
+    return spec
+
+
+def suffix_index(task_vars, lookups=1):
     """
-    Just brute force it. This lets us keep order, and lets us dedup unhashable
-    things, like dicts. Hopefully you won't run into such big lists that
-    this will ever be a performance issue.
+    A SuffixScan or SuffixIndex of the names in task_vars, to look up the
+    names with lookups different suffixes.  Building an index sorts all of
+    the names, which takes about as long as checking each of them
+    SUFFIX_INDEX_MIN_LOOKUPS times, so it's only worth it for that many
+    lookups.  Each task runs in a new worker process, so an index can't be
+    kept for the next host.
+
     """
-    deduped = []
-    for item in mylist:
-        if item not in deduped:
-            deduped.append(item)
-    return deduped
+    names = viewkeys(task_vars)
+    if lookups >= SUFFIX_INDEX_MIN_LOOKUPS:
+        return SuffixIndex(names)
+    return SuffixScan(names)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+
+"""
+The caches of merged values that ansible_merge_vars can share between hosts
+with the same inputs: one for `cache: yes`, which lasts for one run, and a
+persistent one in an SQLite database that lasts between runs.
+
+"""
+
+import json
+import os
+
+from ansible import constants as C
+from ansible.parsing.ajson import AnsibleJSONEncoder
+from ansible.release import __version__ as ansible_version
+from ansible.utils.unsafe_proxy import wrap_var
+
+from ansible_merge_vars_core import (
+    LRUCache,
+    NotCacheable,
+    PersistentCache,
+    content_digest,
+)
+from ansible_merge_vars_templates import template_dependencies
+
+
+DEFAULT_CACHE_SIZE = 256
+
+# Merge options that don't change what the merged value is, so they're left
+# out of cache keys.
+NON_MERGE_ARGS = frozenset(['merged_var_name', 'output_file', 'output_format'])
+
+# Merged values for `cache: yes`, for the rest of the process
+MERGE_CACHE = LRUCache(DEFAULT_CACHE_SIZE)
+
+# Name of the database that `cache: yes` shares merged values through, in
+# Ansible's local temp dir for the run
+RUN_CACHE_NAME = 'merge_vars_cache.db'
+
+
+def merge_cache_key(spec, keys, task_vars):
+    """
+    Digest of everything that determines the merged value: the merge spec, the
+    raw values of the vars to merge, and the raw values of every var that
+    their templates reference (recursively).  Returns None if any of those
+    can't be fingerprinted.
+
+    """
+    merge_args = sorted(
+        (name, val) for name, val in spec.items() if name not in NON_MERGE_ARGS
+    )
+    raw_vals = [(key, task_vars[key]) for key in keys]
+    try:
+        dependencies = template_dependencies([val for _, val in raw_vals], task_vars)
+        return content_digest([merge_args, raw_vals, dependencies])
+    except NotCacheable:
+        return None
+
+
+# Name of the environment variable with the default persistent_cache
+PERSISTENT_CACHE_ENV = 'ANSIBLE_MERGE_VARS_PERSISTENT_CACHE'
+
+DEFAULT_PERSISTENT_CACHE_SIZE = 100 * 1024 * 1024
+
+DEFAULT_PERSISTENT_CACHE_AGE = 7 * 24 * 60 * 60
+
+# The PersistentCache for each path, and the pid of the process that opened
+# it.  Worker processes are forked, and mustn't use their parent's
+# connections.
+PERSISTENT_CACHES = {}
+
+
+def persistent_cache_for(path, max_bytes, max_age, warn):
+    pid, cache = PERSISTENT_CACHES.get(path, (None, None))
+    if cache is None or pid != os.getpid():
+        cache = PersistentCache(
+            path, max_bytes, max_age, codec=(encode_for_cache, decode_from_cache), warn=warn,
+        )
+        PERSISTENT_CACHES[path] = (os.getpid(), cache)
+    cache.max_bytes = max_bytes
+    cache.max_age = max_age
+    return cache
+
+
+class MergeCache(object):
+    """
+    The cache for `cache: yes`.  Ansible runs each task for each host in a new
+    forked worker process, so merged values in memory are only reused within
+    that process, and the store in shared (a PersistentCache, or None) is
+    what actually shares them between hosts.  Values from shared are kept in
+    memory too.
+
+    """
+    def __init__(self, memory, shared):
+        self.memory = memory
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        merged = self.memory.get(digest)
+        if merged is None and self.shared is not None:
+            merged = self.shared.get(persistent_cache_key('merge', digest))
+            if merged is not None:
+                self.memory.set(digest, merged)
+        if merged is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return merged
+
+    def set(self, digest, merged):
+        self.memory.set(digest, merged)
+        if self.shared is not None:
+            self.shared.set(persistent_cache_key('merge', digest), merged)
+
+
+def merge_cache_for(persistent_cache, warn):
+    """
+    The MergeCache for a task with `cache: yes`.  Without a persistent cache,
+    merged values are shared through a database in Ansible's local temp dir,
+    which the controller creates for each run (before forking any workers)
+    and removes at the end of it.  A persistent cache already shares them, so
+    the MergeCache doesn't need another one.
+
+    """
+    shared = None
+    if persistent_cache is None:
+        shared = persistent_cache_for(
+            os.path.join(C.DEFAULT_LOCAL_TMP, RUN_CACHE_NAME),  # pylint: disable=no-member
+            DEFAULT_PERSISTENT_CACHE_SIZE, DEFAULT_PERSISTENT_CACHE_AGE, warn,
+        )
+    return MergeCache(MERGE_CACHE, shared)
+
+
+def persistent_cache_key(kind, digest):
+    """
+    Key of a value in the persistent cache.  Rendering templates might change
+    with the version of Ansible, so it's part of the key.
+
+    """
+    return '{}:{}:{}'.format(kind, ansible_version, digest)
+
+
+def encode_for_cache(value):
+    """
+    Serialize value for the persistent cache.  Raises ValueError if it
+    wouldn't come back out of the cache the same (like tuples, or dicts with
+    keys that aren't strings).
+
+    """
+    data = json.dumps(value, cls=AnsibleJSONEncoder)
+    if json.loads(data) != value:
+        raise ValueError("Value doesn't survive being serialized as JSON")
+    return data
+
+
+def decode_from_cache(data):
+    """
+    Values from the persistent cache have already been rendered, so they're
+    marked as unsafe, so that Ansible won't render them again.
+
+    """
+    return wrap_var(json.loads(data))
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+"""
+An Ansible callback plugin that collects the merge_stats of every run of the
+ansible_merge_vars action plugin, and reports on them at the end of the
+playbook.
+
+"""
+
+DOCUMENTATION = '''
+    name: merge_vars_profile
+    type: aggregate
+    short_description: Reports on the performance of every merge_vars task
+    description:
+        - Turns on merge_stats for every merge_vars task (unless
+          ANSIBLE_MERGE_VARS_STATS is already set), and collects them from the
+          results of the task for each host.
+        - At the end of the playbook, shows a summary for each merge_vars task
+          with the number of hosts, the total and 50th, 95th and 99th
+          percentile run times, the slowest hosts, the hosts with the biggest
+          merged values, and cache hit rates.
+    requirements:
+      - enable in configuration
+    options:
+      report_file:
+        description:
+          - File to write the report to, as JSON.  The report is only shown
+            if this isn't set.
+        env:
+          - name: ANSIBLE_MERGE_VARS_REPORT_FILE
+        ini:
+          - key: report_file
+            section: merge_vars
+        type: path
+      top_hosts:
+        default: 5
+        description: How many of the slowest hosts, and hosts with the biggest outputs, to report
+        env:
+          - name: ANSIBLE_MERGE_VARS_REPORT_TOP_HOSTS
+        ini:
+          - key: report_top_hosts
+            section: merge_vars
+        type: integer
+'''
+
+# Ansible plugins have their DOCUMENTATION before their imports
+# pylint: disable=wrong-import-position
+from collections import OrderedDict
+import codecs
+import json
+import math
+import os
+
+from ansible.errors import AnsibleError
+from ansible.plugins.callback import CallbackBase
+
+from ansible_merge_vars import STATS_ENV
+
+
+DEFAULT_TOP_HOSTS = 5
+
+
+class CallbackModule(CallbackBase):
+    """
+    Aggregates the merge_stats of every merge_vars task, for every host.
+
+    """
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'merge_vars_profile'
+    CALLBACK_NEEDS_ENABLED = True
+    # For Ansible < 2.11
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(CallbackModule, self).__init__(*args, **kwargs)
+        # Task workers are forked from this process, so they'll see this
+        os.environ.setdefault(STATS_ENV, '1')
+        self._tasks = OrderedDict()
+
+    def _option(self, name, default):
+        try:
+            value = self.get_option(name)
+        except (KeyError, AnsibleError):
+            # Options weren't loaded from DOCUMENTATION
+            return default
+        return default if value is None else value
+
+    def v2_runner_on_ok(self, result):
+        stats = result._result.get('merge_stats')  # pylint: disable=protected-access
+        if not isinstance(stats, dict):
+            return
+        task = result._task  # pylint: disable=protected-access
+        summary = self._tasks.get(task._uuid)  # pylint: disable=protected-access
+        if summary is None:
+            summary = TaskSummary(task.get_name())
+            self._tasks[task._uuid] = summary  # pylint: disable=protected-access
+        summary.add(result._host.get_name(), stats)  # pylint: disable=protected-access
+
+    def v2_playbook_on_stats(self, stats):
+        top = int(self._option('top_hosts', DEFAULT_TOP_HOSTS))
+        report = [summary.report(top) for summary in self._tasks.values()]
+        report_file = self._option('report_file', None)
+        if report_file:
+            with codecs.open(report_file, 'w', encoding='utf-8') as f:
+                json.dump({'tasks': report}, f, indent=2, sort_keys=True)
+            self._display.display("merge_vars report written to {}".format(report_file))
+            return
+        for task_report in report:
+            self._display.banner("MERGE VARS: {}".format(task_report['task']))
+            self._display.display(format_report(task_report))
+
+
+class TaskSummary(object):
+    """ The merge_stats of one task, for every host that it ran on """
+    def __init__(self, name):
+        self.name = name
+        # (seconds, host) and (output bytes, host) for each host
+        self.seconds = []
+        self.output_bytes = []
+        self.merges = 0
+        self.cached_merges = 0
+        self.template_cache_hits = 0
+        self.template_cache_misses = 0
+
+    def add(self, host, stats):
+        self.seconds.append((stats.get('seconds', {}).get('total', 0.0), host))
+        merges = list(stats.get('merges', {}).values())
+        self.output_bytes.append((sum(merge.get('output_bytes', 0) for merge in merges), host))
+        self.merges += len(merges)
+        self.cached_merges += sum(1 for merge in merges if merge.get('cached'))
+        self.template_cache_hits += stats.get('template_cache_hits', 0)
+        self.template_cache_misses += stats.get('template_cache_misses', 0)
+
+    def report(self, top):
+        seconds = sorted(seconds for seconds, _ in self.seconds)
+        return {
+            'task': self.name,
+            'count': len(seconds),
+            'total_seconds': sum(seconds),
+            'p50_seconds': percentile(seconds, 50),
+            'p95_seconds': percentile(seconds, 95),
+            'p99_seconds': percentile(seconds, 99),
+            'slowest_hosts': [
+                {'host': host, 'seconds': value} for value, host in largest(self.seconds, top)
+            ],
+            'biggest_outputs': [
+                {'host': host, 'bytes': value} for value, host in largest(self.output_bytes, top)
+            ],
+            'merge_cache_hit_rate': ratio(self.cached_merges, self.merges),
+            'template_cache_hit_rate': ratio(
+                self.template_cache_hits, self.template_cache_hits + self.template_cache_misses
+            ),
+        }
+
+
+def largest(values, count):
+    """ The count largest (value, host) pairs, largest first """
+    return sorted(values, key=lambda pair: pair[0], reverse=True)[:count]
+
+
+def percentile(sorted_values, pct):
+    """ Nearest-rank percentile of an already sorted list, or None if it's empty """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+def ratio(part, whole):
+    return float(part) / whole if whole else None
+
+
+def format_report(task_report):
+    """ Human readable lines for one task's report """
+    def seconds(value):
+        return '-' if value is None else '{:.4f}s'.format(value)
+
+    def rate(value):
+        return '-' if value is None else '{:.1%}'.format(value)
+
+    lines = [
+        "hosts: {}, total: {}, p50: {}, p95: {}, p99: {}".format(
+            task_report['count'], seconds(task_report['total_seconds']),
+            seconds(task_report['p50_seconds']), seconds(task_report['p95_seconds']),
+            seconds(task_report['p99_seconds']),
+        ),
+        "merge cache hit rate: {}, template cache hit rate: {}".format(
+            rate(task_report['merge_cache_hit_rate']),
+            rate(task_report['template_cache_hit_rate']),
+        ),
+        "slowest hosts: {}".format(', '.join(
+            '{} ({})'.format(item['host'], seconds(item['seconds']))
+            for item in task_report['slowest_hosts']
+        )),
+        "biggest outputs: {}".format(', '.join(
+            '{} ({} bytes)'.format(item['host'], item['bytes'])
+            for item in task_report['biggest_outputs']
+        )),
+    ]
+    return '\n'.join(lines)
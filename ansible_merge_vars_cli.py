@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+"""
+Compute merged vars for every host in an inventory, without running a
+playbook, with exactly the same logic as the ansible_merge_vars action plugin.
+
+"""
+
+import argparse
+import codecs
+from collections import OrderedDict
+import json
+import multiprocessing
+import sys
+
+from ansible.errors import AnsibleError
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.ajson import AnsibleJSONEncoder
+from ansible.parsing.dataloader import DataLoader
+from ansible.playbook.task import Task
+from ansible.template import Templar
+from ansible.vars.manager import VariableManager
+
+from ansible_merge_vars import (
+    APPEND,
+    LIST_MERGES,
+    ActionModule,
+    merge_specs,
+    suffix_index,
+)
+from ansible_merge_vars_caching import merge_cache_key
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        prog='ansible-merge-vars',
+        description=(
+            "Merge vars for every host in an inventory, like the merge_vars "
+            "action plugin would, and write them out as JSON"
+        ),
+    )
+    parser.add_argument(
+        '-i', '--inventory', action='append', required=True,
+        help="Inventory source (can be given more than once)",
+    )
+    parser.add_argument(
+        '-l', '--limit', default='all', help="Host pattern to merge vars for (default: all)",
+    )
+    parser.add_argument('--suffix-to-merge')
+    parser.add_argument('--merged-var-name')
+    parser.add_argument('--expected-type', choices=['dict', 'list'])
+    parser.add_argument(
+        '--no-dedup', dest='dedup', action='store_false', help="Don't remove duplicates from lists",
+    )
+    parser.add_argument('--recursive-dict-merge', action='store_true')
+    parser.add_argument('--list-merge', choices=LIST_MERGES, default=APPEND)
+    parser.add_argument('--list-merge-key', help="Merge dicts in lists by this key")
+    parser.add_argument(
+        '--task-args',
+        help=(
+            "YAML or JSON file with the merge_vars task args to use, instead of the "
+            "options above (for example, to do several `merges`)"
+        ),
+    )
+    parser.add_argument(
+        '-f', '--format', choices=['json', 'jsonl'], default='json',
+        help="A JSON list of records, or one JSON record per line (default: json)",
+    )
+    parser.add_argument('-o', '--output', help="File to write to (default: stdout)")
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help="Number of processes to merge in (default: number of CPUs)",
+    )
+    return parser.parse_args(argv)
+
+
+def task_args_from(options, loader):
+    """ The merge_vars task args, from a file or from the command line options """
+    if options.task_args:
+        task_args = loader.load_from_file(options.task_args)
+        if not isinstance(task_args, dict):
+            raise AnsibleError("{} must contain a dict of task args".format(options.task_args))
+        return task_args
+    return {
+        'suffix_to_merge': options.suffix_to_merge or '',
+        'merged_var_name': options.merged_var_name or '',
+        'expected_type': options.expected_type,
+        'dedup': options.dedup,
+        'recursive_dict_merge': options.recursive_dict_merge,
+        'list_merge': options.list_merge,
+        'list_merge_key': options.list_merge_key,
+    }
+
+
+def host_vars(inventory_sources, limit, loader):
+    """ Yield (host name, vars) for every host matching limit """
+    inventory = InventoryManager(loader=loader, sources=inventory_sources)
+    variable_manager = VariableManager(loader=loader, inventory=inventory)
+    for host in inventory.get_hosts(limit):
+        # hostvars is a lazy view of every host's vars, which can't be sent
+        # to other processes, or fingerprinted
+        yield host.get_name(), variable_manager.get_vars(host=host, include_hostvars=False)
+
+
+def group_hosts(task_args, hosts):
+    """
+    Group hosts that will get the same merged values, because they have the
+    same inputs (the vars being merged, and every var their templates
+    reference).  Returns a list of (task vars, host names) pairs, with the
+    vars of the first host in each group.  Hosts with templates that can't
+    be fingerprinted (or that can't be fingerprinted without an error) get a
+    group of their own.
+
+    """
+    specs = merge_specs(task_args)
+    groups = OrderedDict()
+    for name, task_vars in hosts:
+        index = suffix_index(task_vars, len(specs))
+        try:
+            keys = [
+                merge_cache_key(spec, index.matching(spec['suffix_to_merge']), task_vars)
+                for spec in specs
+            ]
+        except Exception:  # pylint: disable=broad-except
+            # Whatever it is will happen again when the host's vars are
+            # merged, and be recorded for the host then
+            keys = [None]
+        group_key = tuple(keys) if None not in keys else name
+        if group_key not in groups:
+            groups[group_key] = (task_vars, [])
+        groups[group_key][1].append(name)
+    return list(groups.values())
+
+
+def merge_host(job):
+    """
+    Run the action plugin for one set of task vars, and return its facts and
+    the error (if there was one)
+
+    """
+    task_args, task_vars = job
+    loader = DataLoader()
+    task = Task()
+    task.args = task_args
+    plugin = ActionModule(
+        task=task,
+        connection=None,
+        play_context=None,
+        loader=loader,
+        templar=Templar(loader=loader, variables=task_vars),
+        shared_loader_obj=None,
+    )
+    try:
+        return plugin.run(task_vars=task_vars)['ansible_facts'], None
+    except AnsibleError as e:
+        return None, str(e)
+    except Exception as e:  # pylint: disable=broad-except
+        # Anything else (like a jinja2 error that Ansible didn't wrap) is
+        # still only an error for these hosts, not for every host
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
+def merge_groups(task_args, groups, jobs):
+    """ Yield (host names, (facts, error)) for each group """
+    work = [(task_args, task_vars) for task_vars, _ in groups]
+    if jobs > 1 and len(work) > 1:
+        # Pools aren't context managers in python 2.7
+        pool = multiprocessing.Pool(min(jobs, len(work)))  # pylint: disable=consider-using-with
+        try:
+            chunksize = max(1, len(work) // (jobs * 4))
+            results = list(pool.imap(merge_host, work, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [merge_host(job) for job in work]
+    for (_, names), result in zip(groups, results):
+        yield names, result
+
+
+def records(grouped_results):
+    """ One record for each host, sorted by host name """
+    host_records = []
+    for names, (facts, error) in grouped_results:
+        for name in names:
+            record = {'host': name}
+            if error is None:
+                record['facts'] = facts
+            else:
+                record['error'] = error
+            host_records.append(record)
+    return sorted(host_records, key=lambda record: record['host'])
+
+
+def write_records(host_records, output_format, out):
+    if output_format == 'jsonl':
+        for record in host_records:
+            out.write(json.dumps(record, cls=AnsibleJSONEncoder, sort_keys=True))
+            out.write('\n')
+    else:
+        json.dump(host_records, out, cls=AnsibleJSONEncoder, sort_keys=True, indent=2)
+        out.write('\n')
+
+
+def main(argv=None):
+    options = parse_args(sys.argv[1:] if argv is None else argv)
+    loader = DataLoader()
+    try:
+        task_args = task_args_from(options, loader)
+        groups = group_hosts(task_args, host_vars(options.inventory, options.limit, loader))
+    except AnsibleError as e:
+        sys.stderr.write("ERROR: {}\n".format(e))
+        return 2
+
+    host_records = records(merge_groups(task_args, groups, options.jobs))
+    if options.output:
+        with codecs.open(options.output, 'w', encoding='utf-8') as out:
+            write_records(host_records, options.format, out)
+    else:
+        write_records(host_records, options.format, sys.stdout)
+    return 1 if any('error' in record for record in host_records) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
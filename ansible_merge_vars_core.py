@@ -0,0 +1,868 @@
+#!/usr/bin/env python
+
+"""
+The merge engine of ansible_merge_vars, which doesn't need Ansible, so it can
+be used without loading Ansible (by benchmarks and other tools, for example).
+Errors are raised as MergeError, which the action plugin turns into an
+AnsibleError.
+
+"""
+
+from bisect import bisect_left
+from collections import deque, namedtuple, OrderedDict
+import hashlib
+import heapq
+import json
+import os
+import sqlite3
+import sys
+import time
+
+
+# The same as ansible.module_utils.six's
+PY3 = sys.version_info[0] >= 3
+string_types = (str,) if PY3 else (basestring,)  # pylint: disable=undefined-variable
+integer_types = (int,) if PY3 else (int, long)  # pylint: disable=undefined-variable
+binary_type = bytes  # pylint: disable=invalid-name
+
+# Lists of at least this many numbers are deduplicated with NumPy, if it's
+# installed.  For shorter lists, making an array costs more than it saves
+# (run tests/bin/run_benchmarks.py --crossover to see where that is).
+NUMPY_MIN_ITEMS = 200
+
+# NumPy takes longer to import than everything else here put together, so
+# it's only imported once there's a list of numbers long enough to use it.
+# numpy_module() keeps it (or None, if it isn't installed) in here.
+_NUMPY = []
+
+_NUMBER_TYPES = frozenset(integer_types + (float,))
+
+# Every integer smaller than this can be a float without being rounded
+_MAX_EXACT_FLOAT = 2 ** 53
+
+
+class MergeError(Exception):
+    """ Raised when values can't be merged """
+
+
+# How lists are merged: concatenated (and deduped if wanted), or merged into
+# one sorted list without duplicates
+APPEND = 'append'
+SORTED_UNION = 'sorted_union'
+LIST_MERGES = (APPEND, SORTED_UNION)
+
+# Merge list items that are dicts with the same value for key, either by
+# replacing the earlier item, or by recursively merging them if deep is set.
+KeyedMerge = namedtuple('KeyedMerge', ['key', 'deep'])
+
+
+def merge_values(merge_vals, expected_type, dedup, recursive_dict_merge, list_merge=APPEND):
+    """ Dispatch based on type that we're merging """
+    if merge_vals == []:
+        if expected_type == 'list':
+            return []
+        return {}
+    if isinstance(merge_vals[0], list):
+        return merge_list(merge_vals, dedup, list_merge)
+    if isinstance(merge_vals[0], dict):
+        return merge_dict(merge_vals, dedup, recursive_dict_merge, list_merge)
+    raise MergeError(
+        "Don't know how to merge variables of type: {}".format(type(merge_vals[0]))
+    )
+
+
+def merge_dict(merge_vals, dedup, recursive_dict_merge, list_merge=APPEND):
+    """
+    To merge dicts, just update one with the values of the next, etc.
+    """
+    check_type(merge_vals, dict)
+    if not recursive_dict_merge:
+        merged = {}
+        for val in merge_vals:
+            merged.update(val)
+    else:
+        merger = DictMerger(dedup, list_merge)
+        for val in merge_vals:
+            merger.add(val)
+        merged = merger.result()
+    return merged
+
+
+class DictMerger(object):
+    """
+    Recursively merges dicts, one at a time, with overlapping keys handled
+    like this:
+      LISTS: merged like merge_list (concatenated and deduped if wanted,
+             merged into a sorted union, or merged by key)
+      DICTS: recursively merged with another DictMerger
+      any other types: replaced (same as usual behaviour)
+
+    The running state for each overlapping list or dict is kept until the
+    end, so every source is only walked once, no matter how many of them
+    there are.  Nested mergers are fed from a queue rather than by
+    recursing, so the depth of the dicts isn't limited by the recursion
+    limit.
+
+    """
+    def __init__(self, dedup, list_merge=APPEND):
+        self.dedup = dedup
+        self.list_merge = list_merge
+        # Values seen only once are kept as-is, and only get a merger (and
+        # copied) if another source has the same key.
+        self._values = {}
+        self._mergers = {}
+
+    def add(self, val):
+        feed(self, val)
+
+    def _add(self, val, pending):
+        """
+        Add one dict, without walking into nested values: values for nested
+        mergers are appended to pending, as (merger, value) pairs.
+
+        """
+        if not isinstance(val, dict):
+            raise MergeError("All values to merge must be of the same type, either dict or list")
+        for key, new in val.items():
+            merger = self._mergers.get(key)
+            if merger is not None:
+                pending.append((merger, new))
+                continue
+
+            if key not in self._values:
+                # first hit of the value - just assign
+                self._values[key] = new
+                continue
+
+            current = self._values[key]
+            if isinstance(current, list):
+                merger = ListMerger(self.dedup, self.list_merge)
+            elif isinstance(current, dict):
+                merger = DictMerger(self.dedup, self.list_merge)
+            else:
+                self._values[key] = new
+                continue
+            pending.append((merger, current))
+            pending.append((merger, new))
+            self._mergers[key] = merger
+
+    def result(self):
+        return merged_result(self)
+
+    def _result(self, results):
+        return {
+            key: results[id(self._mergers[key])] if key in self._mergers else val
+            for key, val in self._values.items()
+        }
+
+
+class ListMerger(object):
+    """
+    Concatenates lists, one at a time, deduping as it goes if wanted.  For
+    sorted unions, the lists are kept until the end, and merged all at once.
+
+    For keyed merges, dict items with the same value for the key are merged
+    into the first one of them, which is found with an index of the key
+    values, and replaced or recursively merged with a DictMerger.  Any other
+    items are concatenated (and deduped if wanted).
+
+    """
+    def __init__(self, dedup, list_merge=APPEND):
+        self.dedup = dedup
+        self.list_merge = list_merge
+        self._items = []
+        self._seen = SeenSet()
+        self._keyed = isinstance(list_merge, KeyedMerge)
+        # Position in _items of the item for each key value
+        self._positions = {}
+        # DictMergers for keyed items that are deep merged, by position
+        self._mergers = {}
+
+    def add(self, val):
+        feed(self, val)
+
+    def _add(self, val, pending):
+        if not isinstance(val, list):
+            raise MergeError("All values to merge must be of the same type, either dict or list")
+        if self.list_merge == SORTED_UNION:
+            self._items.append(val)
+        elif self._keyed:
+            for item in val:
+                self._add_keyed(item, pending)
+        elif self.dedup:
+            self._items.extend(item for item in val if self._seen.add(item))
+        else:
+            self._items.extend(val)
+
+    def _add_keyed(self, item, pending):
+        key = _OPAQUE
+        if isinstance(item, dict) and self.list_merge.key in item:
+            key = fingerprint(item[self.list_merge.key])
+        if key is _OPAQUE:
+            if not self.dedup or self._seen.add(item):
+                self._items.append(item)
+            return
+
+        position = self._positions.get(key)
+        if position is None:
+            self._positions[key] = len(self._items)
+            self._items.append(item)
+        elif self.list_merge.deep:
+            merger = self._mergers.get(position)
+            if merger is None:
+                merger = self._mergers[position] = DictMerger(self.dedup, self.list_merge)
+                pending.append((merger, self._items[position]))
+            pending.append((merger, item))
+        else:
+            self._items[position] = item
+
+    def result(self):
+        return merged_result(self)
+
+    def _result(self, results):
+        if self.list_merge == SORTED_UNION:
+            return sorted_union(self._items)
+        if self._mergers:
+            return [
+                results[id(self._mergers[position])] if position in self._mergers else item
+                for position, item in enumerate(self._items)
+            ]
+        return self._items
+
+
+def feed(merger, val):
+    """
+    Add val to merger, and every value that it passes on to nested mergers
+    to them, in first in, first out order, so each merger still gets its
+    values in the order they were added.
+
+    """
+    pending = deque([(merger, val)])
+    while pending:
+        merger, val = pending.popleft()
+        merger._add(val, pending)  # pylint: disable=protected-access
+
+
+def merged_result(root):
+    """
+    The result of a DictMerger or ListMerger, building the results of the
+    mergers nested in it first, deepest first, instead of recursing.
+
+    """
+    mergers = []
+    stack = [root]
+    while stack:
+        merger = stack.pop()
+        mergers.append(merger)
+        stack.extend(merger._mergers.values())  # pylint: disable=protected-access
+    # Every merger comes after its parent in mergers, so in reverse, each
+    # merger's nested results are ready before it needs them
+    results = {}
+    for merger in reversed(mergers):
+        results[id(merger)] = merger._result(results)  # pylint: disable=protected-access
+    return results[id(root)]
+
+
+def merge_list(merge_vals, dedup, list_merge=APPEND):
+    """
+    To merge lists, just concat them. Dedup if wanted.
+    With list_merge=SORTED_UNION, make a sorted list without duplicates instead,
+    or with a KeyedMerge, merge dict items with the same key.
+    """
+    check_type(merge_vals, list)
+    if list_merge == SORTED_UNION:
+        merged = sorted_union(merge_vals)
+    elif isinstance(list_merge, KeyedMerge):
+        merger = ListMerger(dedup, list_merge)
+        for val in merge_vals:
+            merger.add(val)
+        merged = merger.result()
+    else:
+        merged = flatten(merge_vals)
+        if dedup:
+            merged = deduplicate(merged)
+    return merged
+
+
+def sorted_union(lists):
+    """
+    Merge lists into one sorted list, without duplicates (compared with
+    ``==``, keeping the first of them).  Lists that are already sorted are
+    merged as they are, with a k-way merge in O(N log k) time; any others
+    are sorted first.
+
+    """
+    try:
+        sources = [val if is_sorted(val) else sorted(val) for val in lists]
+        merged = []
+        for item in heapq.merge(*sources):
+            if not merged or item != merged[-1]:
+                merged.append(item)
+        return merged
+    except TypeError:
+        pass
+    raise MergeError(
+        "list_merge: sorted_union can only merge lists of items that can be "
+        "compared with each other"
+    )
+
+
+def is_sorted(mylist):
+    return all(mylist[i] <= mylist[i + 1] for i in range(len(mylist) - 1))
+
+
+def check_type(mylist, _type):
+    """ Ensure that all members of mylist are of type _type. """
+    if not all(isinstance(item, _type) for item in mylist):
+        raise MergeError("All values to merge must be of the same type, either dict or list")
+
+
+def flatten(list_of_lists):
+    """
+    Flattens a list of lists:
+        >>> flatten([[1, 2] [3, 4]])
+        [1, 2, 3, 4]
+
+    I wish Python had this in the standard lib :(
+    """
+    return list((x for y in list_of_lists for x in y))
+
+
+def deduplicate(mylist):
+    """
+    Remove duplicates from mylist, keeping the first occurrence of each item
+    and the original order.  Items are compared with ``==``, just like a
+    brute force ``item not in deduped`` check would, so ``1``, ``1.0`` and
+    ``True`` are duplicates of each other, and unhashable things like dicts
+    and lists are deduplicated by value.
+
+    """
+    if len(mylist) >= NUMPY_MIN_ITEMS:
+        deduped = deduplicate_numbers(mylist)
+        if deduped is not None:
+            return deduped
+    seen = SeenSet()
+    return [item for item in mylist if seen.add(item)]
+
+
+def deduplicate_numbers(mylist):
+    """
+    deduplicate() for a list of ints and floats, with NumPy.  Returns None if
+    NumPy isn't installed, if there's anything else in mylist (bools
+    included), or numbers that NumPy can't compare exactly like Python does
+    (NaNs, ints too big for int64, or ints that can't be floats exactly, when
+    there are floats too).  The items in the result are the items of mylist,
+    so ints stay ints.
+
+    """
+    types = set(map(type, mylist))
+    if not types <= _NUMBER_TYPES:
+        return None
+    numpy = numpy_module()
+    if numpy is None:
+        return None
+    try:
+        if float in types:
+            array = numpy.array(mylist, dtype=numpy.float64)
+            if numpy.isnan(array).any():
+                return None
+            if len(types) > 1 and numpy.abs(array).max() >= _MAX_EXACT_FLOAT:
+                return None
+        else:
+            array = numpy.array(mylist, dtype=numpy.int64)
+    except OverflowError:
+        return None
+    # Indices of the first occurrence of each distinct number, in order
+    first = numpy.unique(array, return_index=True)[1]
+    first.sort()
+    return [mylist[i] for i in first.tolist()]
+
+
+def numpy_module():
+    """ The numpy module, imported the first time it's needed, or None """
+    if not _NUMPY:
+        try:
+            import numpy  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+
+class SeenSet(object):
+    """
+    A set that also accepts unhashable members.  Hashable items are stored
+    as-is, lists/dicts/sets/tuples of hashable-or-fingerprintable things are
+    stored as a canonical fingerprint, and anything else falls back to a
+    linear scan.
+
+    """
+    def __init__(self):
+        self._hashed = set()
+        self._opaque = []
+
+    def add(self, item):
+        """ Add item, returning True if it wasn't already a member. """
+        key = fingerprint(item)
+        if key is _OPAQUE:
+            if item in self._opaque:
+                return False
+            self._opaque.append(item)
+            return True
+        if key in self._hashed:
+            return False
+        if self._opaque and item in self._opaque:
+            return False
+        self._hashed.add(key)
+        return True
+
+
+class _Tag(object):
+    """
+    Private marker used to tag fingerprints, so that the fingerprint of a
+    list can never be equal to a tuple that is in the data being merged.
+
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return '<{}>'.format(self.name)
+
+
+_LIST = _Tag('list')
+_DICT = _Tag('dict')
+_TUPLE = _Tag('tuple')
+_OPAQUE = _Tag('opaque')
+
+
+def fingerprint(item):
+    """
+    Return a hashable stand-in for item, such that two fingerprints are equal
+    exactly when the items they came from are equal.  Returns _OPAQUE for
+    things that we don't know how to fingerprint.
+
+    """
+    try:
+        hash(item)
+        return item
+    except TypeError:
+        pass
+
+    if isinstance(item, (set, frozenset)):
+        # Set members are always hashable, and set() == frozenset()
+        return frozenset(item)
+    if isinstance(item, dict):
+        tag = _DICT
+        members = frozenset((key, fingerprint(val)) for key, val in item.items())
+        opaque = any(val is _OPAQUE for _, val in members)
+    elif isinstance(item, (list, tuple)):
+        tag = _LIST if isinstance(item, list) else _TUPLE
+        members = tuple(fingerprint(val) for val in item)
+        opaque = any(val is _OPAQUE for val in members)
+    else:
+        return _OPAQUE
+    return _OPAQUE if opaque else (tag, members)
+
+
+class NotCacheable(Exception):
+    """ Raised when something can't go into a cache key """
+
+
+class LRUCache(object):
+    """
+    A size-bounded mapping that evicts the least recently used entry, and
+    counts its hits and misses.
+
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            # Re-insert to mark as most recently used (no move_to_end in 2.7)
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        self._evict()
+
+    def resize(self, maxsize):
+        self.maxsize = maxsize
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class SuffixScan(object):
+    """
+    Finds variable names that end with a suffix by checking every name.  For
+    a single lookup, that's quicker than building a SuffixIndex.
+
+    """
+    def __init__(self, names):
+        self.names = names
+
+    def matching(self, suffix):
+        """ All of the names ending with suffix, sorted """
+        return sorted(name for name in self.names if name.endswith(suffix))
+
+
+class SuffixIndex(object):
+    """
+    Finds variable names that end with a suffix without checking every name.
+    The names are kept reversed and sorted, so all of the names with the same
+    suffix are next to each other and can be found with a binary search.
+
+    """
+    def __init__(self, names):
+        self.names = frozenset(names)
+        self._reversed = sorted(name[::-1] for name in self.names)
+
+    def matching(self, suffix):
+        """ All of the names ending with suffix, sorted """
+        reversed_suffix = suffix[::-1]
+        start = end = bisect_left(self._reversed, reversed_suffix)
+        while end < len(self._reversed) and self._reversed[end].startswith(reversed_suffix):
+            end += 1
+        return sorted(name[::-1] for name in self._reversed[start:end])
+
+
+def content_digest(value):
+    """
+    A stable digest of value, which only matches the digest of another value
+    with the same types, the same contents and the same order.  Raises
+    NotCacheable for types that it doesn't know about.
+
+    """
+    digest = hashlib.sha1()
+    # Walked with a stack rather than by recursing, so value can be any depth
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, string_types):
+            # Unsafe strings don't get templated, so they don't count as the same
+            tag = 'unsafe' if hasattr(value, '__UNSAFE__') else 'text'
+            encoded = value.encode('utf-8')
+            digest.update('{}:{}:'.format(tag, len(encoded)).encode('ascii'))
+            digest.update(encoded)
+        elif isinstance(value, binary_type):
+            digest.update('bytes:{}:'.format(len(value)).encode('ascii'))
+            digest.update(value)
+        elif value is None or isinstance(value, (bool, float) + integer_types):
+            digest.update('{}:{!r};'.format(type(value).__name__, value).encode('ascii'))
+        elif isinstance(value, dict):
+            digest.update('dict:{}:'.format(len(value)).encode('ascii'))
+            for key, val in reversed(list(value.items())):
+                stack.append(val)
+                stack.append(key)
+        elif isinstance(value, (list, tuple)):
+            digest.update('{}:{}:'.format(type(value).__name__, len(value)).encode('ascii'))
+            stack.extend(reversed(value))
+        else:
+            raise NotCacheable("Can't fingerprint {}".format(type(value)))
+    return digest.hexdigest()
+
+
+class InternTable(object):
+    """
+    Keeps one copy of each distinct merged value, and of each distinct list
+    or dict inside of them, so that equal values (like the merged vars of
+    hosts with the same inputs) share the same objects instead of each one
+    having its own copy.  Values are matched by content_digest(), so they
+    must have the same types and order too, not just be equal.
+
+    Interned values are shared, so they must never be modified in place.
+
+    """
+    def __init__(self, maxsize):
+        self._table = LRUCache(maxsize)
+        self._bytes_shared = 0
+
+    def resize(self, maxsize):
+        self._table.resize(maxsize)
+
+    def clear(self):
+        self._table.clear()
+        self._bytes_shared = 0
+
+    def stats(self, since=None):
+        """ Counters for the table, or for the time since an earlier stats() """
+        stats = {
+            'hits': self._table.hits,
+            'misses': self._table.misses,
+            'bytes_shared': self._bytes_shared,
+            'entries': len(self._table),
+        }
+        if since is not None:
+            for name in ['hits', 'misses', 'bytes_shared']:
+                stats[name] -= since[name]
+        return stats
+
+    def intern(self, value):
+        return self._intern(value)[0]
+
+    def _intern(self, value):
+        """
+        Returns the interned value, its digest (None if it can't be
+        interned), its approximate size in bytes, and how many of those
+        bytes are shared with an already interned value.
+
+        """
+        if isinstance(value, dict):
+            tag = 'dict'
+            items = [(key, self._intern(key), self._intern(val)) for key, val in value.items()]
+            children = [child for _, key, val in items for child in (key, val)]
+            canonical = {key: val[0] for key, _, val in items}
+        elif isinstance(value, list):
+            tag = 'list'
+            children = [self._intern(val) for val in value]
+            canonical = [child[0] for child in children]
+        else:
+            try:
+                digest = content_digest(value)
+            except NotCacheable:
+                digest = None
+            return value, digest, sys.getsizeof(value), 0
+
+        size = sys.getsizeof(canonical) + sum(child[2] for child in children)
+        shared = sum(child[3] for child in children)
+        if any(child[1] is None for child in children):
+            return canonical, None, size, shared
+
+        digest = content_digest([tag] + [child[1] for child in children])
+        interned = self._table.get(digest)
+        if interned is None:
+            self._table.set(digest, canonical)
+            return canonical, digest, size, shared
+        self._bytes_shared += size - shared
+        return interned, digest, size, size
+
+
+class PersistentCache(object):  # pylint: disable=too-many-instance-attributes
+    """
+    A cache of JSON serializable values in an SQLite database, which lasts
+    between runs, and can be shared by several processes.  Entries that
+    haven't been used for max_age seconds are evicted, and so are the least
+    recently used entries, while the stored values add up to more than
+    max_bytes.
+
+    Nothing that goes wrong with the database is fatal: if it's corrupt, it's
+    moved aside and a new one is started, and if it can't be used at all (or
+    is locked for too long), the cache just misses.  warn is called with a
+    message about each of these.  Values are serialized with codec, a pair of
+    (encode, decode) functions, and values that encode raises a TypeError or
+    ValueError for aren't stored.
+
+    The total size of the entries is kept up to date by triggers, so that
+    it doesn't have to be added up for every set(), and old entries are
+    evicted at most once every AGE_EVICTION_INTERVAL seconds.
+
+    """
+    SCHEMA_VERSION = 2
+
+    AGE_EVICTION_INTERVAL = 60
+
+    def __init__(self, path, max_bytes, max_age, codec=(json.dumps, json.loads), warn=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._encode, self._decode = codec
+        self._warn = warn or (lambda message: None)
+        self._conn = None
+        self._broken = False
+        self._aged_at = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        row = self._execute('SELECT value FROM entries WHERE key = ?', (key,))
+        value = None
+        if row is not None:
+            try:
+                value = self._decode(row[0])
+            except ValueError:
+                self._execute('DELETE FROM entries WHERE key = ?', (key,))
+                row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self._execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            data = self._encode(value)
+        except (TypeError, ValueError):
+            return
+        now = time.time()
+        self._execute(
+            'INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+            (key, data, len(data), now),
+        )
+        self._evict(now)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _evict(self, now):
+        if self._aged_at is None or now - self._aged_at >= self.AGE_EVICTION_INTERVAL:
+            self._execute('DELETE FROM entries WHERE accessed < ?', (now - self.max_age,))
+            self._aged_at = now
+        total = self._execute('SELECT size FROM totals')
+        excess = (total[0] if total else 0) - self.max_bytes
+        if excess <= 0:
+            return
+        self._run(lambda conn: self._evict_least_recently_used(conn, excess))
+
+    @staticmethod
+    def _evict_least_recently_used(conn, excess):
+        evicted = []
+        for key, size in conn.execute('SELECT key, size FROM entries ORDER BY accessed'):
+            if excess <= 0:
+                break
+            evicted.append((key,))
+            excess -= size
+        conn.executemany('DELETE FROM entries WHERE key = ?', evicted)
+
+    def _execute(self, sql, params=()):
+        """ Run one statement, and return its first row (or None) """
+        return self._run(lambda conn: conn.execute(sql, params).fetchone())
+
+    def _run(self, statements):
+        """
+        Call statements with the connection to the database, and return what
+        it returns (or None).  If the database turns out to be corrupt, it's
+        replaced, and statements is called again with the new one.
+
+        """
+        for attempt in range(2):
+            conn = self._connect()
+            if conn is None:
+                return None
+            try:
+                return statements(conn)
+            except sqlite3.OperationalError as e:
+                # Locked for longer than the timeout, out of disk space, etc.
+                self._warn("Can't use the merge cache {}: {}".format(self.path, e))
+                return None
+            except sqlite3.DatabaseError as e:
+                if attempt:
+                    self._disable(e)
+                    return None
+                self._replace(e)
+        return None
+
+    def _connect(self):
+        if self._conn is None and not self._broken:
+            try:
+                self._conn = self._open()
+            except sqlite3.OperationalError as e:
+                self._disable(e)
+            except sqlite3.DatabaseError as e:
+                self._replace(e)
+                try:
+                    self._conn = self._open()
+                except (sqlite3.Error, OSError) as error:
+                    self._disable(error)
+            except OSError as e:
+                self._disable(e)
+        return self._conn
+
+    def _open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Someone else made it first
+                if not os.path.isdir(directory):
+                    raise
+        # Autocommit, so no process holds a lock for longer than a statement
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # So that the rows that INSERT OR REPLACE deletes fire the delete
+            # trigger
+            conn.execute('PRAGMA recursive_triggers = ON')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self._create_schema(conn)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _create_schema(self, conn):
+        """
+        Create the tables, in a transaction that checks the version again,
+        so that processes that open a new database at the same time don't
+        both create them.
+
+        """
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS entries')
+                conn.execute('DROP TABLE IF EXISTS totals')
+                conn.execute(
+                    'CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+                    'size INTEGER NOT NULL, accessed REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX entries_accessed ON entries (accessed)')
+                conn.execute('CREATE TABLE totals (size INTEGER NOT NULL)')
+                conn.execute('INSERT INTO totals (size) VALUES (0)')
+                conn.execute(
+                    'CREATE TRIGGER entries_inserted AFTER INSERT ON entries '
+                    'BEGIN UPDATE totals SET size = size + NEW.size; END'
+                )
+                conn.execute(
+                    'CREATE TRIGGER entries_deleted AFTER DELETE ON entries '
+                    'BEGIN UPDATE totals SET size = size - OLD.size; END'
+                )
+                conn.execute('PRAGMA user_version = {:d}'.format(self.SCHEMA_VERSION))
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                # BEGIN failed, so there's nothing to roll back
+                pass
+            raise
+
+    def _replace(self, error):
+        """ Move a corrupt database aside, so that a new one is started """
+        self._warn("The merge cache {} is corrupt ({}), starting a new one".format(
+            self.path, error
+        ))
+        self.close()
+        try:
+            os.rename(self.path, self.path + '.corrupt')
+        except OSError:
+            pass
+
+    def _disable(self, error):
+        self._warn("Can't use the merge cache {}: {}".format(self.path, error))
+        self.close()
+        self._broken = True
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+An Ansible cache plugin that works just like the jsonfile cache, except that
+large facts (like the ones set by ansible_merge_vars) are only written once,
+no matter how many hosts have them.
+
+"""
+
+DOCUMENTATION = '''
+    name: merge_vars_jsonfile
+    short_description: JSON formatted files, with large facts stored by content
+    description:
+        - This cache uses JSON formatted, per host, files saved to the filesystem,
+          like the jsonfile cache.
+        - Facts that are bigger than content_store_min_size when serialized are
+          written once to a content addressed store, named by their sha256 digest,
+          and the per host file only holds a reference to them.  References are
+          resolved when the facts are read back from the cache.
+        - Objects that no host's cache file can refer to anymore, because they
+          haven't been referenced for longer than the cache timeout, are
+          removed when the cache is loaded.  Flushing the cache removes the
+          default content store too.
+        - With intern_facts, facts that are equal (and equal lists and dicts
+          inside of them) share one copy in the controller's memory, however
+          many hosts have them.  How much is shared is shown with -vvv when
+          the cache is flushed, and at exit.
+    options:
+      _uri:
+        required: True
+        description:
+          - Path in which the cache plugin will save the JSON files
+        env:
+          - name: ANSIBLE_CACHE_PLUGIN_CONNECTION
+        ini:
+          - key: fact_caching_connection
+            section: defaults
+        type: path
+      _prefix:
+        default: ''
+        description: User defined prefix to use when creating the JSON files
+        env:
+          - name: ANSIBLE_CACHE_PLUGIN_PREFIX
+        ini:
+          - key: fact_caching_prefix
+            section: defaults
+      _timeout:
+        default: 86400
+        description: Expiration timeout for the cache plugin data
+        env:
+          - name: ANSIBLE_CACHE_PLUGIN_TIMEOUT
+        ini:
+          - key: fact_caching_timeout
+            section: defaults
+        type: integer
+      content_store:
+        description:
+          - Directory to write large facts to.  Defaults to a C(.objects)
+            directory inside of the cache directory.
+        env:
+          - name: ANSIBLE_MERGE_VARS_CONTENT_STORE
+        ini:
+          - key: content_store
+            section: merge_vars
+        type: path
+      content_store_min_size:
+        default: 65536
+        description:
+          - Facts that are at least this many bytes when serialized to JSON are
+            written to the content store.
+        env:
+          - name: ANSIBLE_MERGE_VARS_CONTENT_STORE_MIN_SIZE
+        ini:
+          - key: content_store_min_size
+            section: merge_vars
+        type: integer
+      intern_facts:
+        default: False
+        description:
+          - Whether equal facts of different hosts, and equal lists and dicts
+            inside of them, should share the same objects in memory.
+        env:
+          - name: ANSIBLE_MERGE_VARS_INTERN_FACTS
+        ini:
+          - key: intern_facts
+            section: merge_vars
+        type: boolean
+      intern_table_size:
+        default: 10000
+        description:
+          - Maximum number of distinct lists and dicts to keep for sharing.
+        env:
+          - name: ANSIBLE_MERGE_VARS_INTERN_TABLE_SIZE
+        ini:
+          - key: intern_table_size
+            section: merge_vars
+        type: integer
+'''
+
+# Ansible plugins have their DOCUMENTATION before their imports
+# pylint: disable=wrong-import-position
+import atexit
+import codecs
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from ansible.errors import AnsibleError
+from ansible.parsing.ajson import AnsibleJSONDecoder, AnsibleJSONEncoder
+from ansible.plugins.cache.jsonfile import CacheModule as JsonFileCacheModule
+from ansible.utils.display import Display
+
+from ansible_merge_vars_core import InternTable
+
+
+# The key of the dict that replaces a fact in the per host files
+REFERENCE_KEY = '__merge_vars_content_ref__'
+
+DEFAULT_MIN_SIZE = 65536
+
+DEFAULT_INTERN_TABLE_SIZE = 10000
+
+# Objects' mtimes are when a cache file last referred to them, but to save a
+# write for every host, they're only updated once in this many seconds.
+TOUCH_INTERVAL = 3600
+
+OBJECT_NAME = re.compile(r'^[0-9a-f]{64}\.json$')
+
+display = Display()
+
+
+class CacheModule(JsonFileCacheModule):
+    """
+    A jsonfile cache that writes large facts to a content addressed store,
+    and can intern the facts that it keeps in memory.
+
+    The cache runs in the controller, which keeps every host's facts for the
+    whole run, so that's where sharing equal facts saves memory.
+
+    """
+    def __init__(self, *args, **kwargs):
+        super(CacheModule, self).__init__(*args, **kwargs)
+        try:
+            content_store = self.get_option('content_store')
+            min_size = self.get_option('content_store_min_size')
+            intern_facts = self.get_option('intern_facts')
+            intern_table_size = self.get_option('intern_table_size')
+        except (KeyError, AnsibleError):
+            # Options weren't loaded from DOCUMENTATION
+            content_store = None
+            min_size = DEFAULT_MIN_SIZE
+            intern_facts = False
+            intern_table_size = DEFAULT_INTERN_TABLE_SIZE
+        self._default_store = not content_store
+        self._content_store = content_store or os.path.join(self._cache_dir, '.objects')
+        self._min_size = int(min_size)
+        # When we last touched each object that we know is in the store
+        self._stored = {}
+        self._interner = InternTable(int(intern_table_size)) if intern_facts else None
+        self._reported = None
+        if self._interner is not None:
+            atexit.register(self._report_interning)
+        self._prune_content_store()
+
+    def set(self, key, value):
+        super(CacheModule, self).set(key, self._intern(value))
+
+    def flush(self):
+        super(CacheModule, self).flush()
+        self._stored.clear()
+        self._report_interning()
+        # A content store somewhere else might be shared with other caches,
+        # and cache files with another prefix (or expired ones) might still
+        # refer to objects, so then they're left to be pruned by age.
+        if self._default_store and not any(
+                not name.startswith('.') for name in os.listdir(self._cache_dir)):
+            shutil.rmtree(self._content_store, ignore_errors=True)
+
+    def _prune_content_store(self):
+        """
+        Remove the objects that no cache file that hasn't expired yet can
+        refer to.  There's nothing to go by if cache files never expire.
+
+        """
+        if not self._timeout or not os.path.isdir(self._content_store):
+            return
+        oldest = time.time() - self._timeout - TOUCH_INTERVAL
+        for directory, _, names in os.walk(self._content_store):
+            for name in names:
+                if not OBJECT_NAME.match(name):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    if os.path.getmtime(path) < oldest:
+                        os.unlink(path)
+                except OSError:
+                    # Someone else removed it first
+                    pass
+
+    def _report_interning(self):
+        """ Show how much interning has shared since it was last reported, with -vvv """
+        if self._interner is None:
+            return
+        stats = self._interner.stats(since=self._reported)
+        self._reported = self._interner.stats()
+        display.vvv("merge_vars_jsonfile interning: {}".format(json.dumps(stats, sort_keys=True)))
+
+    def _intern(self, facts):
+        """
+        facts, with each fact interned.  The dict of facts itself isn't,
+        since Ansible updates it in place.
+
+        """
+        if self._interner is None or not isinstance(facts, dict):
+            return facts
+        return dict((key, self._interner.intern(val)) for key, val in facts.items())
+
+    def _load(self, filepath):
+        facts = super(CacheModule, self)._load(filepath)
+        if not isinstance(facts, dict):
+            return facts
+        try:
+            resolved = {
+                key: self._load_object(val[REFERENCE_KEY]) if is_reference(val) else val
+                for key, val in facts.items()
+            }
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                # A cache file that refers to a missing object is no use, so
+                # it's removed, and the cache raises a KeyError, which is a
+                # miss, for IOErrors
+                try:
+                    os.unlink(filepath)
+                except OSError:
+                    pass
+            raise
+        return self._intern(resolved)
+
+    def _dump(self, value, filepath):
+        if isinstance(value, dict):
+            value = {key: self._store_if_large(val) for key, val in value.items()}
+        super(CacheModule, self)._dump(value, filepath)
+
+    def _store_if_large(self, value):
+        """ Store value in the content store if it's large, and return a reference to it """
+        if not isinstance(value, (dict, list)):
+            return value
+        serialized = json.dumps(value, cls=AnsibleJSONEncoder, sort_keys=True).encode('utf-8')
+        if len(serialized) < self._min_size:
+            return value
+
+        digest = hashlib.sha256(serialized).hexdigest()
+        now = time.time()
+        if now - self._stored.get(digest, now - TOUCH_INTERVAL) >= TOUCH_INTERVAL:
+            path = self._object_path(digest)
+            try:
+                os.utime(path, None)
+            except OSError:
+                write_atomically(path, serialized)
+            self._stored[digest] = now
+        return {REFERENCE_KEY: digest}
+
+    def _load_object(self, digest):
+        with codecs.open(self._object_path(digest), 'r', encoding='utf-8') as f:
+            return json.load(f, cls=AnsibleJSONDecoder)
+
+    def _object_path(self, digest):
+        return os.path.join(self._content_store, digest[:2], digest + '.json')
+
+
+def is_reference(value):
+    return isinstance(value, dict) and list(value.keys()) == [REFERENCE_KEY]
+
+
+def write_atomically(path, data):
+    """ Write data to path, without anyone ever seeing a half-written file """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Someone else made it first
+            if not os.path.isdir(directory):
+                raise
+    handle, tmp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
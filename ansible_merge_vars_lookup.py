@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+An Ansible lookup plugin that merges vars with a suffix when a template uses
+the merged value, instead of in a merge_vars task that runs for every host.
+
+"""
+
+DOCUMENTATION = '''
+    name: merge_vars
+    short_description: Merges vars with a suffix when the merged value is used
+    description:
+        - Merges every var whose name ends with the suffix given as a term, in
+          exactly the same way as the merge_vars action plugin, and returns the
+          merged value.
+        - Nothing is merged until a template uses the lookup, so hosts (and
+          plays) that never use the merged value don't pay for it.
+        - Results are remembered for the rest of the task, keyed on the options
+          and the vars they're merged from, so using the lookup more than once
+          in a task with the same inputs only merges once.
+    options:
+      _terms:
+        description: Suffixes of the vars to merge.  They must end with C(__to_merge).
+        required: True
+      expected_type:
+        description: Type of the merged value.
+        choices: ['dict', 'list']
+        required: True
+      dedup:
+        description: Remove duplicates from lists.
+        default: True
+        type: bool
+      recursive_dict_merge:
+        description: Merge dicts recursively.
+        default: False
+        type: bool
+      list_merge:
+        description: How to merge lists.
+        choices: ['append', 'sorted_union']
+        default: append
+      list_merge_key:
+        description: Merge dicts in lists that have the same value for this key.
+      cache:
+        description:
+          - Share merged values between hosts with the same inputs for the
+            rest of the run, like the C(cache) option of the action plugin.
+        default: False
+        type: bool
+'''
+
+# Ansible plugins have their DOCUMENTATION before their imports
+# pylint: disable=wrong-import-position
+from ansible.errors import AnsibleError
+from ansible.plugins.lookup import LookupBase
+from ansible.utils.display import Display
+
+from ansible_merge_vars import (
+    MERGE_OPTIONS,
+    NO_STATS,
+    LRUCache,
+    MergeContext,
+    MergeError,
+    merge_one,
+    merge_spec,
+    suffix_index,
+)
+from ansible_merge_vars_caching import merge_cache_for, merge_cache_key
+
+
+display = Display()
+
+
+# Merge specs need a name, even though the lookup doesn't set a var
+LOOKUP_VAR_NAME = 'merge_vars_lookup'
+
+LOOKUP_OPTIONS = frozenset(MERGE_OPTIONS + ('cache',)) - frozenset([
+    'suffix_to_merge', 'merged_var_name', 'output_file', 'output_format',
+])
+
+# Merged values, keyed on merge_cache_key(), like the cache option.  Ansible
+# runs each task in a new worker process, so they only last for one task.
+MERGED_VALUES = LRUCache(256)
+
+
+class LookupModule(LookupBase):
+    """
+    Merges the vars ending with each term, on first use.
+
+    """
+    def run(self, terms, variables=None, **kwargs):
+        unknown = sorted(set(kwargs) - LOOKUP_OPTIONS)
+        if unknown:
+            raise AnsibleError("Unknown merge_vars lookup options: {}".format(', '.join(unknown)))
+        variables = variables or {}
+        return [self._merged(term, variables, kwargs) for term in terms]
+
+    def _merged(self, suffix, variables, options):
+        args = dict(options, suffix_to_merge=suffix, merged_var_name=LOOKUP_VAR_NAME)
+        spec = merge_spec(args)
+        keys = suffix_index(variables).matching(spec['suffix_to_merge'])
+        # Vars that can't be fingerprinted (like templates with lookups) get
+        # merged every time
+        key = merge_cache_key(spec, keys, variables)
+        if key is not None:
+            merged = MERGED_VALUES.get(key)
+            if merged is not None:
+                return merged
+
+        merge_cache = None
+        if options.get('cache', False):
+            merge_cache = merge_cache_for(None, display.warning)
+        context = MergeContext(variables, self._templar, merge_cache, None)
+        try:
+            merged = merge_one(spec, keys, context, NO_STATS)
+        except MergeError as e:
+            raise AnsibleError(str(e))
+        if key is not None:
+            MERGED_VALUES.set(key, merged)
+        return merged
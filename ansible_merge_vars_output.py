@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""
+Writing merged values to files, for the output_file option of
+ansible_merge_vars, instead of setting them as facts.
+
+"""
+
+import hashlib
+import os
+import stat
+import tempfile
+
+from ansible.errors import AnsibleError
+from ansible.parsing.ajson import AnsibleJSONEncoder
+
+
+OUTPUT_FORMATS = ('json', 'jsonl')
+
+# Encoded chunks are joined into writes of at least this many characters
+WRITE_SIZE = 64 * 1024
+
+
+def write_output(value, path, output_format):
+    """
+    Write value to path as JSON (or JSON lines), as it's encoded, so that a
+    whole serialized copy of it (or of any item in it) is never in memory, and
+    return what the fact gets instead of the value: the path, the format,
+    and the size and sha256 digest of the file.
+
+    """
+    path = os.path.abspath(path)
+    encoder = AnsibleJSONEncoder(sort_keys=True)
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = None
+    try:
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.merge_vars')
+        with os.fdopen(handle, 'wb') as f:
+            for data in joined(output_chunks(value, output_format, encoder), WRITE_SIZE):
+                digest.update(data)
+                f.write(data)
+                size += len(data)
+        # mkstemp makes the file private, but it should get the mode that
+        # writing to path would have left it with
+        os.chmod(tmp_path, file_mode(path))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as e:
+        raise AnsibleError("Can't write merged value to {}: {}".format(path, e))
+    finally:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+    return {
+        'path': path,
+        'format': output_format,
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+    }
+
+
+def file_mode(path):
+    """ The mode of the file at path, or the mode that a new file gets """
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def output_chunks(value, output_format, encoder):
+    """
+    Serialized value, in the chunks that encoder.iterencode() yields.  As
+    JSON, it's the same as json.dumps(value, sort_keys=True).  As JSON lines,
+    each item of a list, or each key of a dict (as a dict of just that key),
+    is on its own line.
+
+    """
+    if output_format == 'json':
+        items = [value]
+    elif isinstance(value, dict):
+        # Each key is encoded as a dict of its own, so keys are converted to
+        # strings just like json does
+        items = ({key: value[key]} for key in sorted(value))
+    else:
+        items = value
+    for item in items:
+        for chunk in encoder.iterencode(item):
+            yield chunk
+        yield '\n'
+
+
+def joined(chunks, size):
+    """
+    chunks, joined into UTF-8 encoded strings of at least size characters
+    (apart from the last one), so that there aren't lots of tiny writes.
+
+    """
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size >= size:
+            yield ''.join(pending).encode('utf-8')
+            pending = []
+            pending_size = 0
+    if pending:
+        yield ''.join(pending).encode('utf-8')
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+"""
+Rendering the templates in the vars that ansible_merge_vars merges: only the
+strings that have jinja in them are sent to the templar, templates in dicts
+can be left unrendered until they're known to be in the merged value, and
+rendered template strings can be cached, keyed on the vars they reference.
+
+"""
+
+from ansible.module_utils.six import integer_types, string_types
+import jinja2
+from jinja2 import nodes
+
+from ansible_merge_vars_core import _OPAQUE, LRUCache, NotCacheable, content_digest
+
+
+TEMPLATE_MARKERS = ('{{', '{%', '{#')
+
+# Template names that make rendering depend on something other than the
+# variables passed in (or on chance), so templates that use them can't be
+# cached.  hostvars and vars are left out because they're huge.  Filters and
+# tests are matched by the last part of their name, so that
+# ansible.builtin.shuffle is the same as shuffle.
+UNCACHEABLE_NAMES = frozenset([
+    'hostvars', 'vars', 'lookup', 'query', 'q', 'now', 'random', 'shuffle',
+    'password_hash',
+])
+
+JINJA_ENV = jinja2.Environment(extensions=['jinja2.ext.do', 'jinja2.ext.loopcontrols'])
+
+DEFAULT_TEMPLATE_CACHE_SIZE = 4096
+
+# Rendered template strings, keyed by the template and the values of the vars
+# it references
+TEMPLATE_CACHE = LRUCache(DEFAULT_TEMPLATE_CACHE_SIZE)
+
+# The names referenced by each template string, so each one is only parsed once
+TEMPLATE_NAMES = LRUCache(DEFAULT_TEMPLATE_CACHE_SIZE)
+
+
+def render_templates(templar, value):
+    """
+    Template value like templar.template() would, but only send the strings
+    that actually have jinja in them to the templar.  Dicts and lists without
+    any templates in them are returned untouched, instead of being walked and
+    copied by the templar.
+
+    """
+    def render(val):
+        if isinstance(val, string_types):
+            if any(marker in val for marker in TEMPLATE_MARKERS):
+                return templar.template(val)
+            return val
+        if val is None or isinstance(val, (bool, float) + integer_types):
+            return val
+        if isinstance(val, (dict, list)):
+            return _DESCEND
+        # Anything else (tuples, sets, etc.) gets whatever the templar does to it
+        return templar.template(val)
+
+    rendered = render(value)
+    return _rebuild(value, render) if rendered is _DESCEND else rendered
+
+
+class Unrendered(object):
+    """
+    A value with templates in it, which is only rendered if it's still in the
+    merged value after the merge.
+
+    """
+    __slots__ = ('value', 'templar')
+
+    def __init__(self, value, templar):
+        self.value = value
+        # Vars from different hosts are rendered with different templars
+        self.templar = templar
+
+
+def defer_templates(templar, value, recursive_dict_merge):
+    """
+    A dict to merge, with its values that have templates in them wrapped in
+    Unrendered, where that can't change what they're merged with.
+
+    Without a recursive merge, a value is always replaced by a later value for
+    the same key, whatever types they are, so they can all be rendered later.
+    With one, dicts are walked, and templates that can only render to scalars
+    are rendered later, since scalars are replaced no matter what their value
+    is.  Templates that might render to a list or dict, and lists (which are
+    deduped or merged by their rendered items), are rendered now.
+
+    """
+    def defer(val):
+        if not recursive_dict_merge:
+            return Unrendered(val, templar) if has_templates(val) else val
+        if isinstance(val, dict):
+            return _DESCEND
+        if isinstance(val, string_types) and not may_render_to_container(val):
+            return Unrendered(val, templar) if has_templates(val) else val
+        return render_templates(templar, val)
+
+    return _rebuild(value, defer)
+
+
+def render_deferred(value):
+    """
+    Render the Unrendered values in the dicts of a merged value.  They're
+    never inside of lists, since lists are rendered before they're merged.
+
+    """
+    def render(val):
+        if isinstance(val, Unrendered):
+            return render_templates(val.templar, val.value)
+        if isinstance(val, dict):
+            return _DESCEND
+        return val
+
+    rendered = render(value)
+    return _rebuild(value, render) if rendered is _DESCEND else rendered
+
+
+# Returned by the functions passed to _rebuild for the dicts and lists whose
+# items should be rebuilt too
+_DESCEND = object()
+
+
+class _Rebuilt(object):
+    """
+    A dict or list that's part way through being rebuilt by _rebuild: its
+    keys (or indexes), and the new values of the items that are done so far.
+
+    """
+    __slots__ = ('value', 'keys', 'items', 'changed')
+
+    def __init__(self, value):
+        self.value = value
+        self.keys = list(value) if isinstance(value, dict) else list(range(len(value)))
+        self.items = []
+        self.changed = False
+
+    def done(self):
+        return len(self.items) == len(self.keys)
+
+    def next_item(self):
+        return self.value[self.keys[len(self.items)]]
+
+    def add(self, new):
+        self.changed = self.changed or new is not self.next_item()
+        self.items.append(new)
+
+    def result(self):
+        if not self.changed:
+            return self.value
+        if isinstance(self.value, dict):
+            return dict(zip(self.keys, self.items))
+        return self.items
+
+
+def _rebuild(value, rebuild_item):
+    """
+    Rebuild the dict or list value, replacing each item with what
+    rebuild_item returns for it, or rebuilding the item the same way if it
+    returns _DESCEND.  Dicts and lists whose items are all unchanged are
+    returned as they were.  The tree is walked with a stack rather than by
+    recursing, so it can be any depth.
+
+    """
+    stack = [_Rebuilt(value)]
+    while True:
+        current = stack[-1]
+        if current.done():
+            stack.pop()
+            if not stack:
+                return current.result()
+            stack[-1].add(current.result())
+            continue
+        item = current.next_item()
+        new = rebuild_item(item)
+        if new is _DESCEND:
+            stack.append(_Rebuilt(item))
+        else:
+            current.add(new)
+
+
+def has_templates(value):
+    return next(template_strings(value), None) is not None
+
+
+def may_render_to_container(template):
+    """
+    Whether a template string might render to a list or dict.  Ansible only
+    turns a rendered template into a list or dict if it's one value that's
+    already a list or dict, or if it looks like a literal one, so a template
+    that starts with any other text (like 'www.{{ domain }}') always renders
+    to a string (or another scalar).
+
+    """
+    return template.lstrip()[:1] in ('{', '[', '(')
+
+
+def template_strings(value):
+    """ Yield every string in value that looks like it has jinja in it. """
+    pending = [value]
+    while pending:
+        value = pending.pop()
+        if isinstance(value, string_types):
+            if any(marker in value for marker in TEMPLATE_MARKERS):
+                yield value
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+
+
+def template_dependencies(values, task_vars):
+    """
+    Find the vars referenced by templates in values, and by templates in
+    those vars, and so on.  Returns a list of (name, raw value) pairs, with
+    None for names that aren't defined.
+
+    """
+    dependencies = []
+    seen = set()
+    pending = list(values)
+    while pending:
+        for name in sorted(referenced_names(pending.pop())):
+            if name in seen:
+                continue
+            seen.add(name)
+            value = task_vars.get(name)
+            dependencies.append((name, value))
+            pending.append(value)
+    return dependencies
+
+
+def referenced_names(value):
+    """
+    Names of all of the variables referenced by templates in value.  Raises
+    NotCacheable if a template can't be parsed, or uses something in
+    UNCACHEABLE_NAMES.
+
+    """
+    names = set()
+    for template in template_strings(value):
+        template_names = TEMPLATE_NAMES.get(template)
+        if template_names is None:
+            template_names = parse_template_names(template)
+            TEMPLATE_NAMES.set(template, template_names)
+        if template_names is _OPAQUE:
+            raise NotCacheable("Can't cache template {!r}".format(template))
+        names.update(template_names)
+    return names
+
+
+def parse_template_names(template):
+    """
+    The names of the variables referenced by a template string, or _OPAQUE if
+    it can't be parsed or uses something in UNCACHEABLE_NAMES.
+
+    The template is only parsed, not compiled, since compiling it needs every
+    filter and test that it uses, and Ansible's aren't in a plain jinja2
+    Environment.  Every name that's loaded counts, even ones that the
+    template sets itself (like loop variables), which can only make a cache
+    key depend on more vars than it has to.
+
+    """
+    try:
+        ast = JINJA_ENV.parse(template)
+    except jinja2.TemplateSyntaxError:
+        return _OPAQUE
+    names = frozenset(node.name for node in ast.find_all(nodes.Name) if node.ctx == 'load')
+    filters = set(
+        node.name.rsplit('.', 1)[-1] for node in ast.find_all((nodes.Filter, nodes.Test))
+    )
+    if (names | filters) & UNCACHEABLE_NAMES:
+        return _OPAQUE
+    return names
+
+
+class CachingTemplar(object):
+    """
+    Wraps a templar, and reuses rendered template strings from cache if the
+    same template has been rendered before with the same values for all of
+    the vars that it references (and the vars that they reference, etc).
+
+    """
+    def __init__(self, templar, task_vars, cache):
+        self._templar = templar
+        self._task_vars = task_vars
+        self._cache = cache
+        # Digests of each var (and its dependencies), for this set of vars
+        self._var_digests = {}
+
+    def template(self, value):
+        # Unsafe strings aren't templated, but are equal to ones that are
+        if not isinstance(value, string_types) or hasattr(value, '__UNSAFE__'):
+            return self._templar.template(value)
+        try:
+            key = (value, self._dependencies_digest(value))
+        except NotCacheable:
+            return self._templar.template(value)
+
+        rendered = self._cache.get(key, _OPAQUE)
+        if rendered is _OPAQUE:
+            rendered = self._templar.template(value)
+            self._cache.set(key, rendered)
+        return rendered
+
+    def _dependencies_digest(self, value):
+        return content_digest([
+            (name, self._var_digest(name)) for name in sorted(referenced_names(value))
+        ])
+
+    def _var_digest(self, name):
+        digest = self._var_digests.get(name)
+        if digest is None:
+            value = self._task_vars.get(name)
+            digest = content_digest([
+                name, value, template_dependencies([value], self._task_vars)
+            ])
+            self._var_digests[name] = digest
+        return digest
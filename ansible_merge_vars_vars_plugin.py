@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""
+An Ansible vars plugin that does merges while variables are loaded, instead
+of in a merge_vars task in every play.
+
+"""
+
+DOCUMENTATION = '''
+    name: merge_vars
+    short_description: Merges vars with a suffix when inventory vars are loaded
+    requirements:
+      - enable in configuration
+    description:
+        - Does the merges declared in a YAML file, with the same options as the
+          merge_vars action plugin, and sets the merged vars for every host.
+        - The vars that are merged are the ones set in the inventory, and in
+          group_vars and host_vars directories.  They're merged as they are,
+          without templating them, and any templates in the merged vars are
+          rendered whenever they're used, like with any other var.
+        - Hosts in the same groups share one merge (unless they have vars to
+          merge of their own), which is reused for every play.
+    options:
+      config:
+        description:
+          - YAML file with the merges to do.  It has the same options as a
+            merge_vars task, so it's either one merge, or a list of C(merges).
+        env:
+          - name: ANSIBLE_MERGE_VARS_CONFIG
+        ini:
+          - key: vars_plugin_config
+            section: merge_vars
+        type: path
+'''
+
+# Ansible plugins have their DOCUMENTATION before their imports
+# pylint: disable=wrong-import-position
+import os
+
+from ansible.errors import AnsibleError
+from ansible.inventory.helpers import sort_groups
+from ansible.inventory.host import Host
+from ansible.plugins.loader import vars_loader
+from ansible.plugins.vars import BaseVarsPlugin
+from ansible.utils.vars import combine_vars
+
+from ansible_merge_vars import list_merge_for, merge_specs
+from ansible_merge_vars_core import LRUCache, MergeError, SuffixIndex, merge_values
+
+
+CONFIG_ENV = 'ANSIBLE_MERGE_VARS_CONFIG'
+
+# Merged vars for each combination of groups (or host, for hosts with vars to
+# merge of their own), for the life of the controller process
+MERGED_VARS = LRUCache(4096)
+
+# Every path that vars have been loaded from, in the order they were first
+# seen.  Ansible loads vars from each inventory (and playbook) directory in
+# turn, with later ones overriding earlier ones, so the merges for each path
+# include the vars from every path before it.
+PATHS = []
+
+
+class VarsModule(BaseVarsPlugin):
+    """
+    Sets the vars merged from the inventory vars of each host, and its groups.
+
+    """
+    REQUIRES_ENABLED = True
+    # For Ansible < 2.11
+    REQUIRES_WHITELIST = True
+
+    def __init__(self, *args, **kwargs):
+        super(VarsModule, self).__init__(*args, **kwargs)
+        self._specs = {}
+
+    def get_vars(self, loader, path, entities, cache=True):
+        super(VarsModule, self).get_vars(loader, path, entities)
+        if not isinstance(entities, list):
+            entities = [entities]
+        hosts = [entity for entity in entities if isinstance(entity, Host)]
+        config = self._config()
+        if not hosts or not config:
+            return {}
+
+        if path not in PATHS:
+            PATHS.append(path)
+        paths = PATHS[:PATHS.index(path) + 1]
+        specs = self._load_specs(loader, config)
+        if not cache:
+            MERGED_VARS.clear()
+
+        merged = {}
+        for host in hosts:
+            merged = combine_vars(merged, self._merge_for_host(loader, paths, specs, host))
+        return merged
+
+    def _config(self):
+        try:
+            config = self.get_option('config')
+        except (KeyError, AnsibleError):
+            # Options weren't loaded from DOCUMENTATION
+            config = None
+        return config or os.environ.get(CONFIG_ENV)
+
+    def _load_specs(self, loader, config):
+        specs = self._specs.get(config)
+        if specs is None:
+            task_args = loader.load_from_file(config)
+            if not isinstance(task_args, dict):
+                raise AnsibleError("{} must contain merge_vars options".format(config))
+            specs = merge_specs(task_args)
+            if any(spec['output_file'] for spec in specs):
+                raise AnsibleError("output_file can't be used in {}".format(config))
+            self._specs[config] = specs
+        return specs
+
+    def _merge_for_host(self, loader, paths, specs, host):
+        file_vars = vars_loader.get('host_group_vars')
+        host_vars = combine_vars(host.get_vars(), dict_union(
+            file_vars.get_vars(loader, path, [host]) for path in paths
+        ))
+        groups = sort_groups(host.get_groups())
+        key = (tuple(paths), tuple(group.get_name() for group in groups), None)
+        suffixes = [spec['suffix_to_merge'] for spec in specs]
+        if any(name.endswith(suffix) for name in host_vars for suffix in suffixes):
+            # The host has vars to merge of its own, so it can't share a merge
+            key = key[:2] + (host.get_name(),)
+        else:
+            host_vars = {}
+
+        merged = MERGED_VARS.get(key)
+        if merged is None:
+            group_vars = {}
+            for group in groups:
+                group_vars = combine_vars(group_vars, group.get_vars())
+            group_vars = combine_vars(group_vars, dict_union(
+                file_vars.get_vars(loader, path, groups) for path in paths
+            ))
+            merged = merge_all(specs, combine_vars(group_vars, host_vars))
+            MERGED_VARS.set(key, merged)
+        return merged
+
+
+def dict_union(dicts):
+    """ Combine dicts, with later ones overriding earlier ones """
+    combined = {}
+    for val in dicts:
+        combined = combine_vars(combined, val)
+    return combined
+
+
+def merge_all(specs, all_vars):
+    """ The merged value for each spec, by merged_var_name """
+    index = SuffixIndex(all_vars)
+    merged = {}
+    for spec in specs:
+        keys = index.matching(spec['suffix_to_merge'])
+        try:
+            merged[spec['merged_var_name']] = merge_values(
+                [all_vars[key] for key in keys],
+                spec['expected_type'], spec['dedup'], spec['recursive_dict_merge'],
+                list_merge=list_merge_for(spec),
+            )
+        except MergeError as e:
+            raise AnsibleError("Can't merge {}: {}".format(spec['merged_var_name'], e))
+    return merged
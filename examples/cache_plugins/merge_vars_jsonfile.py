@@ -0,0 +1 @@
+from ansible_merge_vars_fact_cache import CacheModule, DOCUMENTATION
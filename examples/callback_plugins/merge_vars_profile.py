@@ -0,0 +1 @@
+from ansible_merge_vars_callback import CallbackModule, DOCUMENTATION
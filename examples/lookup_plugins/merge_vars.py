@@ -0,0 +1 @@
+from ansible_merge_vars_lookup import LookupModule, DOCUMENTATION
@@ -0,0 +1 @@
+from ansible_merge_vars_vars_plugin import VarsModule, DOCUMENTATION
@@ -30,7 +30,19 @@ setup(
         'Programming Language :: Python :: 3.8',
     ],
     keywords='ansible plugin',  # Optional
-    py_modules=["ansible_merge_vars"],
+    py_modules=["ansible_merge_vars", "ansible_merge_vars_core", "ansible_merge_vars_fact_cache",
+                "ansible_merge_vars_callback", "ansible_merge_vars_cli",
+                "ansible_merge_vars_vars_plugin", "ansible_merge_vars_lookup",
+                "ansible_merge_vars_templates", "ansible_merge_vars_caching",
+                "ansible_merge_vars_output"],
+    extras_require={
+        'numpy': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'ansible-merge-vars = ansible_merge_vars_cli:main',
+        ],
+    },
     project_urls={  # Optional
         'Bug Reports': 'https://github.com/leapfrogonline/ansible-merge-vars/issues',
         'Source': 'https://github.com/leapfrogonline/ansible-merge-vars/',
@@ -0,0 +1,177 @@
+"""
+Benchmark scenarios for the merge engine and the action plugin
+
+Each scenario is a function that returns the task args and a list of task vars,
+one for each simulated host.  Data is generated from a fixed seed, so every run
+merges exactly the same thing.
+
+"""
+
+import random
+
+from hypothesis import given, settings, HealthCheck
+import hypothesis.strategies as s
+
+from tests.property.test_merge_vars_properties import (
+    gen_dict_lists,
+    gen_int_lists,
+    gen_list_dicts,
+)
+
+
+SEED = 1234
+
+
+def list_args(dedup=True):
+    return {
+        'suffix_to_merge': 'bench__to_merge',
+        'merged_var_name': 'merged',
+        'expected_type': 'list',
+        'dedup': dedup,
+    }
+
+
+def dict_args(recursive_dict_merge=True):
+    return {
+        'suffix_to_merge': 'bench__to_merge',
+        'merged_var_name': 'merged',
+        'expected_type': 'dict',
+        'recursive_dict_merge': recursive_dict_merge,
+    }
+
+
+def sources(values):
+    """ Task vars with each of values as a var to merge """
+    return {
+        'source{:04d}_bench__to_merge'.format(i): value for i, value in enumerate(values)
+    }
+
+
+def int_list(rng, length, ratio):
+    """ A list of ints, about ratio of which are repeats """
+    distinct = max(1, int(length * (1 - ratio)))
+    return [rng.randrange(distinct) if i >= distinct else i for i in range(length)]
+
+
+def num_sources(count):
+    rng = random.Random(SEED)
+    return list_args(), [sources(int_list(rng, 1000, 0.5) for _ in range(count))]
+
+
+def list_length(length):
+    rng = random.Random(SEED)
+    return list_args(), [sources(int_list(rng, length, 0.5) for _ in range(4))]
+
+
+def duplicate_ratio(ratio):
+    """ Lists of dicts, which are the expensive things to dedup """
+    rng = random.Random(SEED)
+    return list_args(), [sources(
+        [{'name': 'user{}'.format(i), 'uid': i} for i in int_list(rng, 2000, ratio)]
+        for _ in range(4)
+    )]
+
+
+def nested(depth, width, leaf):
+    value = leaf
+    for level in range(depth):
+        value = {'level{}_{}'.format(level, i): value for i in range(width)}
+    return value
+
+
+def nesting_depth(depth):
+    """ Recursive dict merges of trees with roughly the same number of leaves """
+    width = max(2, int(round(4096 ** (1.0 / depth))))
+    return dict_args(), [sources(nested(depth, width, [i, i + 1]) for i in range(8))]
+
+
+def deep_tree(depth):
+    """ Recursive dict merges of narrow trees that are much deeper than they are wide """
+    def tree(source):
+        value = {'leaf': source}
+        for level in range(depth):
+            value = {'child': value, 'level{}'.format(level % 4): [source, level]}
+        return value
+    return dict_args(), [sources(tree(i) for i in range(8))]
+
+
+def templated_share(share):
+    rng = random.Random(SEED)
+    task_vars = sources(
+        ['{{ base_domain }}' if rng.random() < share else 'static{}'.format(i)
+         for i in range(2000)]
+        for _ in range(4)
+    )
+    task_vars['base_domain'] = 'example.com'
+    # template_cache is off by default, but it's what makes templated vars
+    # cheap, so that's what's measured
+    return dict(list_args(dedup=False), template_cache=True), [task_vars]
+
+
+def host_count(count):
+    rng = random.Random(SEED)
+    shared = sources(int_list(rng, 1000, 0.5) for _ in range(8))
+    hosts = []
+    for i in range(count):
+        task_vars = dict(shared)
+        task_vars['inventory_hostname'] = 'host{}'.format(i)
+        hosts.append(task_vars)
+    return list_args(), hosts
+
+
+def hypothesis_corpus(generators, count=50):
+    """
+    Task vars for count hosts, drawn from the property tests' generators.
+    Drawing is derandomized, so the corpus is the same on every run.
+
+    """
+    drawn = []
+
+    @settings(
+        max_examples=count,
+        derandomize=True,
+        database=None,
+        suppress_health_check=list(HealthCheck),
+    )
+    @given(s.tuples(*generators))
+    def collect(values):
+        drawn.append(sources(values))
+
+    collect()  # pylint: disable=no-value-for-parameter
+    return drawn
+
+
+def hypothesis_lists():
+    return list_args(), hypothesis_corpus(gen_int_lists(3) + gen_dict_lists(3))
+
+
+def hypothesis_dicts():
+    return dict_args(), hypothesis_corpus(gen_list_dicts(6))
+
+
+# (name, function that builds the scenario) pairs
+SCENARIOS = [
+    ('sources_{}'.format(count), lambda count=count: num_sources(count))
+    for count in [1, 10, 40]
+] + [
+    ('list_length_{}'.format(length), lambda length=length: list_length(length))
+    for length in [100, 1000, 10000]
+] + [
+    ('duplicate_ratio_{}'.format(ratio), lambda ratio=ratio: duplicate_ratio(ratio))
+    for ratio in [0.0, 0.5, 0.9]
+] + [
+    ('nesting_depth_{}'.format(depth), lambda depth=depth: nesting_depth(depth))
+    for depth in [1, 4, 12]
+] + [
+    ('deep_tree_{}'.format(depth), lambda depth=depth: deep_tree(depth))
+    for depth in [200]
+] + [
+    ('templated_share_{}'.format(share), lambda share=share: templated_share(share))
+    for share in [0.0, 0.1, 0.5]
+] + [
+    ('hosts_{}'.format(count), lambda count=count: host_count(count))
+    for count in [1, 10, 100]
+] + [
+    ('hypothesis_lists', hypothesis_lists),
+    ('hypothesis_dicts', hypothesis_dicts),
+]
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Runs the benchmarks in tests/benchmark, and compares them to a stored baseline.
+
+* Every scenario is timed twice: through the action plugin (for every simulated
+  host, with tests.utils.make_and_run_plugin), and through the merge engine
+  alone (ansible_merge_vars_core.merge_values on the raw vars).
+* Times are divided by the time of a fixed pure Python calibration loop, so
+  that baselines recorded on one machine are roughly comparable on another.
+* Exits non-zero if any scenario is more than --tolerance slower than the
+  baseline.  Timings on shared machines are noisy, so the default tolerance is
+  meant to catch things like accidentally quadratic code, not 10% slowdowns.
+  Run with --update-baseline to record a new baseline.
+* With --crossover, times deduplicating lists of ints of growing lengths with
+  and without NumPy instead, to show where NumPy starts to pay for itself
+  (which is what ansible_merge_vars_core.NUMPY_MIN_ITEMS should be).
+
+Needs no network access, just ansible and hypothesis installed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.insert(0, ROOT_DIR)
+
+# pylint: disable=wrong-import-position
+from ansible_merge_vars import suffix_index
+import ansible_merge_vars_core
+from ansible_merge_vars_core import merge_values
+from tests.benchmark.scenarios import SCENARIOS, SEED, int_list
+from tests.utils import make_and_run_plugin
+
+BASELINE = os.path.join(ROOT_DIR, 'tests', 'benchmark', 'baseline.json')
+
+
+def best_time(func, repeat, min_time=0.2):
+    """
+    Fastest time for one call of func, out of repeat runs of enough calls to
+    take at least min_time, so that quick scenarios aren't all noise.
+
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2
+    times = [elapsed] + timeit.repeat(func, number=number, repeat=repeat - 1)
+    return min(times) / number
+
+
+def calibration(repeat):
+    """ Time of a fixed amount of plain Python work on this machine """
+    def work():
+        total = {}
+        for i in range(200000):
+            total[i % 1000] = total.get(i % 1000, 0) + i
+        return total
+    return best_time(work, repeat)
+
+
+def run_plugin(task_args, hosts):
+    for task_vars in hosts:
+        make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+
+
+def run_engine(task_args, hosts):
+    for task_vars in hosts:
+        keys = suffix_index(task_vars).matching(task_args['suffix_to_merge'])
+        merge_values(
+            [task_vars[key] for key in keys],
+            task_args['expected_type'],
+            task_args.get('dedup', True),
+            task_args.get('recursive_dict_merge', False),
+        )
+
+
+def run_benchmarks(pattern, repeat):
+    results = {}
+    for name, build in SCENARIOS:
+        if pattern not in name:
+            continue
+        task_args, hosts = build()
+        # Calibrate next to every scenario, in case the machine's speed drifts
+        unit = calibration(repeat)
+        results[name + '.plugin'] = best_time(lambda: run_plugin(task_args, hosts), repeat) / unit
+        results[name + '.engine'] = best_time(lambda: run_engine(task_args, hosts), repeat) / unit
+        print('{:<28} plugin {:>9.3f}   engine {:>9.3f}'.format(
+            name, results[name + '.plugin'], results[name + '.engine']
+        ))
+    return results
+
+
+def crossover(repeat, lengths=(50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000)):
+    """ Shortest of lengths that NumPy dedups faster, or None """
+    if ansible_merge_vars_core.numpy_module() is None:
+        print('NumPy is not installed')
+        return None
+    min_items = ansible_merge_vars_core.NUMPY_MIN_ITEMS
+    rng = random.Random(SEED)
+    fastest = None
+    print('{:>8} {:>12} {:>12}'.format('length', 'python', 'numpy'))
+    try:
+        for length in lengths:
+            items = int_list(rng, length, 0.5)
+            unit = calibration(repeat)
+            times = []
+            # Never, then always, use NumPy
+            for threshold in [sys.maxsize, 0]:
+                ansible_merge_vars_core.NUMPY_MIN_ITEMS = threshold
+                times.append(best_time(
+                    lambda: ansible_merge_vars_core.deduplicate(items), repeat
+                ) / unit)
+            print('{:>8} {:>12.5f} {:>12.5f}'.format(length, times[0], times[1]))
+            if fastest is None and times[1] < times[0]:
+                fastest = length
+    finally:
+        ansible_merge_vars_core.NUMPY_MIN_ITEMS = min_items
+    return fastest
+
+
+def compare(results, baseline, tolerance):
+    """ Names of the benchmarks that are slower than the baseline allows """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            print('{}: no baseline'.format(name))
+        elif result > baseline[name] * (1 + tolerance):
+            print('REGRESSION {}: {:.3f} (baseline {:.3f})'.format(name, result, baseline[name]))
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Record the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='How much slower than the baseline is a regression (1.0 = 100%%)')
+    parser.add_argument('--filter', default='',
+                        help='Only run scenarios with this in their names')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Times to run each scenario (the fastest run counts)')
+    parser.add_argument('--crossover', action='store_true',
+                        help='Find the list length where deduplicating with NumPy is faster')
+    args = parser.parse_args()
+
+    print('Times are relative to a calibration loop on this machine\n')
+    if args.crossover:
+        fastest = crossover(args.repeat)
+        if fastest is not None:
+            print('\nNumPy is faster from {} items (NUMPY_MIN_ITEMS is {})'.format(
+                fastest, ansible_merge_vars_core.NUMPY_MIN_ITEMS
+            ))
+        return 0
+
+    results = run_benchmarks(args.filter, args.repeat)
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE, 'r') as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('\n{} written'.format(BASELINE))
+        return 0
+
+    if not os.path.exists(BASELINE):
+        print('\nNo baseline at {}, run with --update-baseline to make one'.format(BASELINE))
+        return 0
+    with open(BASELINE, 'r') as f:
+        baseline = json.load(f)
+    print()
+    regressions = compare(results, baseline, args.tolerance)
+    print('{} regressions'.format(len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
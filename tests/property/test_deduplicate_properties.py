@@ -0,0 +1,89 @@
+import unittest
+
+from hypothesis import given
+from hypothesis import example
+import hypothesis.strategies as s
+
+from ansible_merge_vars_core import deduplicate, deduplicate_numbers, numpy_module
+
+
+def brute_force_deduplicate(mylist):
+    """
+    The original O(n^2) implementation, which is the reference for what
+    deduplicate() should return
+
+    """
+    deduped = []
+    for item in mylist:
+        if item not in deduped:
+            deduped.append(item)
+    return deduped
+
+
+# Small value ranges, so that we actually get plenty of duplicates, and a mix
+# of types that compare equal to each other (1 == 1.0 == True)
+scalars = s.one_of(
+    s.none(),
+    s.booleans(),
+    s.integers(min_value=-2, max_value=2),
+    s.sampled_from([0.0, 1.0, 1.5]),
+    s.text(alphabet='ab', max_size=2),
+)
+
+values = s.recursive(
+    scalars,
+    lambda children: s.one_of(
+        s.lists(children, max_size=3),
+        s.tuples(children, children),
+        s.dictionaries(
+            keys=s.one_of(s.text(alphabet='ab', max_size=2), s.integers(min_value=0, max_value=2)),
+            values=children,
+            max_size=3,
+        ),
+    ),
+    max_leaves=10,
+)
+
+numbers = s.one_of(
+    s.integers(min_value=-3, max_value=3),
+    s.sampled_from([0.0, -0.0, 1.0, 2.5, float('inf'), 2.0 ** 53, 2 ** 53 + 1, 2 ** 63]),
+    s.integers(),
+    s.floats(),
+)
+
+
+class TestDeduplicateProperties(unittest.TestCase):
+
+    @given(s.lists(values, max_size=50))
+    @example([1, 1.0, True, 0, False, 0.0])
+    @example([{'a': 1}, {'a': True}, {'a': [1]}, {'a': [1.0]}])
+    @example([[1, [2]], (1, [2]), [1, [2]], ([2], 1)])
+    @example([{1: 'a'}, {True: 'a'}, {1.0: 'b'}])
+    def test_matches_brute_force(self, mylist):
+        self.assertEqual(deduplicate(mylist), brute_force_deduplicate(mylist))
+
+    @given(s.lists(values, max_size=50))
+    def test_keeps_first_occurrence(self, mylist):
+        deduped = deduplicate(mylist)
+        expected = brute_force_deduplicate(mylist)
+        self.assertTrue(all(
+            actual is reference for actual, reference in zip(deduped, expected)
+        ))
+
+    @given(s.lists(s.sets(s.integers(min_value=0, max_value=3), max_size=3), max_size=20))
+    def test_sets_match_brute_force(self, mylist):
+        mylist = mylist + [frozenset(item) for item in mylist]
+        self.assertEqual(deduplicate(mylist), brute_force_deduplicate(mylist))
+
+    @unittest.skipIf(numpy_module() is None, "NumPy isn't installed")
+    @given(s.lists(numbers, max_size=50))
+    @example([1, 1.0, 0, -0.0, 0.0])
+    @example([2 ** 53 + 1, 2.0 ** 53])
+    def test_numbers_match_brute_force(self, mylist):
+        deduped = deduplicate_numbers(mylist)
+        if deduped is not None:
+            expected = brute_force_deduplicate(mylist)
+            self.assertEqual(deduped, expected)
+            self.assertTrue(all(
+                actual is reference for actual, reference in zip(deduped, expected)
+            ))
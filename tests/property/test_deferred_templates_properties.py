@@ -0,0 +1,69 @@
+import unittest
+
+from ansible.errors import AnsibleError
+from hypothesis import example, given
+import hypothesis.strategies as s
+
+from ansible_merge_vars import MergeError, merge_values
+from ansible_merge_vars_templates import render_templates
+from tests.property.test_render_templates_properties import TASK_VARS, make_templar
+from tests.utils import make_and_run_plugin
+
+
+leaves = s.one_of(
+    s.none(),
+    s.integers(),
+    s.text(alphabet='ab[ ', max_size=4),
+    s.sampled_from([
+        '{{ some_var }}',
+        'foo{{ some_var }}',
+        ' {{ some_var }}',
+        '{{ some_list }}',
+        "[{{ some_list | join(', ') }}]",
+        '{{ some_dict }}',
+        '{% if true %}yes{% endif %}',
+    ]),
+)
+dicts = s.recursive(
+    s.dictionaries(keys=s.sampled_from('abc'), values=leaves, max_size=3),
+    lambda children: s.dictionaries(
+        keys=s.sampled_from('abc'),
+        values=s.one_of(leaves, children, s.lists(leaves, max_size=3)),
+        max_size=3,
+    ),
+    max_leaves=12,
+)
+
+
+def eager_merge(sources, recursive_dict_merge):
+    """ Render every source in full, then merge them, like the plugin used to """
+    templar = make_templar()
+    rendered = [render_templates(templar, source) for source in sources]
+    return merge_values(rendered, 'dict', True, recursive_dict_merge)
+
+
+class TestDeferredTemplatesProperties(unittest.TestCase):
+
+    @given(s.lists(dicts, min_size=1, max_size=4), s.booleans())
+    @example([{'a': 'foo{{ some_var }}'}, {'a': {'b': 1}}], True)
+    @example([{'a': {'b': 1}}, {'a': '{{ some_dict }}'}], True)
+    @example([{'a': {'b': 1}}, {'a': 'foo{{ some_var }}'}], True)
+    def test_matches_rendering_everything_first(self, sources, recursive_dict_merge):
+        task_vars = dict(TASK_VARS)
+        for i, source in enumerate(sources):
+            task_vars['var{}__to_merge'.format(i)] = source
+        task_args = {
+            'suffix_to_merge': '__to_merge',
+            'merged_var_name': 'merged',
+            'expected_type': 'dict',
+            'recursive_dict_merge': recursive_dict_merge,
+        }
+
+        try:
+            expected = eager_merge(sources, recursive_dict_merge)
+        except MergeError:
+            with self.assertRaises(AnsibleError):
+                make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+            return
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(result['ansible_facts']['merged'], expected)
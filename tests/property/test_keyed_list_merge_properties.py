@@ -0,0 +1,47 @@
+import unittest
+
+from hypothesis import given
+import hypothesis.strategies as s
+
+from ansible_merge_vars_core import KeyedMerge
+from ansible_merge_vars_core import merge_list
+
+
+def brute_force_keyed_merge(lists, key):
+    """
+    Replace each earlier item with the same key, checking every earlier item,
+    which is the reference for keyed merges without dedup or deep merging
+
+    """
+    merged = []
+    for item in (item for val in lists for item in val):
+        if isinstance(item, dict) and key in item:
+            matches = [
+                i for i, old in enumerate(merged)
+                if isinstance(old, dict) and key in old and old[key] == item[key]
+            ]
+            if matches:
+                merged[matches[0]] = item
+                continue
+        merged.append(item)
+    return merged
+
+
+items = s.one_of(
+    s.integers(min_value=0, max_value=3),
+    s.dictionaries(
+        keys=s.sampled_from(['name', 'uid']),
+        values=s.one_of(s.integers(min_value=0, max_value=3), s.lists(s.booleans(), max_size=2)),
+        max_size=2,
+    ),
+)
+
+
+class TestKeyedListMergeProperties(unittest.TestCase):
+
+    @given(s.lists(s.lists(items, max_size=8), max_size=4))
+    def test_matches_brute_force(self, lists):
+        self.assertEqual(
+            merge_list(lists, False, list_merge=KeyedMerge('name', False)),
+            brute_force_keyed_merge(lists, 'name'),
+        )
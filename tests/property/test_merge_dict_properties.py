@@ -0,0 +1,59 @@
+import unittest
+
+from hypothesis import given
+from hypothesis import example
+import hypothesis.strategies as s
+
+from ansible_merge_vars_core import MergeError
+from ansible_merge_vars_core import check_type
+from ansible_merge_vars_core import merge_dict
+from ansible_merge_vars_core import merge_list
+
+
+def pairwise_merge_dict(merge_vals, dedup):
+    """
+    The original recursive merge, which merges each source into the
+    accumulated result pair by pair, and is the reference for what
+    merge_dict() should return
+
+    """
+    check_type(merge_vals, dict)
+    merged = {}
+    for val in merge_vals:
+        for key in val.keys():
+            if not key in merged:
+                merged[key] = val[key]
+            elif isinstance(merged[key], list):
+                merged[key] = merge_list([merged[key], val[key]], dedup)
+            elif isinstance(merged[key], dict):
+                merged[key] = pairwise_merge_dict([merged[key], val[key]], dedup)
+            else:
+                merged[key] = val[key]
+    return merged
+
+
+# Few distinct keys and values, so that sources overlap a lot
+keys = s.sampled_from(['a', 'b', 'c'])
+small_ints = s.integers(min_value=0, max_value=3)
+leaves = s.one_of(small_ints, s.lists(small_ints, max_size=4))
+nested_dicts = s.recursive(
+    s.dictionaries(keys=keys, values=leaves, max_size=3),
+    lambda children: s.dictionaries(keys=keys, values=s.one_of(leaves, children), max_size=3),
+    max_leaves=10,
+)
+
+
+class TestMergeDictProperties(unittest.TestCase):
+
+    @given(s.lists(nested_dicts, max_size=6), s.booleans())
+    @example([{'a': [1, 1]}], True)
+    @example([{'a': [1, 1]}, {'a': [2, 1]}, {'a': [1, 3]}], True)
+    @example([{'a': {'b': [1]}}, {'a': {'b': [1, 2]}}, {'a': {'c': 1}}], False)
+    def test_matches_pairwise_merge(self, merge_vals, dedup):
+        try:
+            expected = pairwise_merge_dict(merge_vals, dedup)
+        except MergeError:
+            with self.assertRaises(MergeError):
+                merge_dict(merge_vals, dedup, recursive_dict_merge=True)
+        else:
+            self.assertEqual(merge_dict(merge_vals, dedup, recursive_dict_merge=True), expected)
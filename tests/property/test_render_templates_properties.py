@@ -0,0 +1,76 @@
+import unittest
+
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+from hypothesis import given
+from hypothesis import example
+import hypothesis.strategies as s
+
+from ansible_merge_vars_templates import render_templates
+
+
+TASK_VARS = {
+    'some_var': 'woohoo',
+    'some_list': [1, 2],
+    'some_dict': '{{ {1: 1, 2: 2} }}',
+}
+
+
+def make_templar():
+    templar = Templar(loader=DataLoader())
+    try:
+        templar.set_available_variables(TASK_VARS)
+    except AttributeError:
+        # set_available_variables was removed in ansible 2.13
+        templar.available_variables = TASK_VARS
+    return templar
+
+
+static_leaves = s.one_of(
+    s.none(),
+    s.booleans(),
+    s.integers(),
+    s.text(alphabet='ab} ', max_size=5),
+)
+leaves = s.one_of(
+    static_leaves,
+    s.sampled_from([
+        '{{ some_var }}',
+        'foo{{ some_var }}',
+        '{{ some_list }}',
+        '{{ some_dict }}',
+        '{% if true %}yes{% endif %}',
+        '{# comment #}',
+    ]),
+)
+values = s.recursive(
+    leaves,
+    lambda children: s.one_of(
+        s.lists(children, max_size=3),
+        s.tuples(children),
+        s.dictionaries(keys=s.text(alphabet='ab', max_size=2), values=children, max_size=3),
+    ),
+    max_leaves=10,
+)
+static_values = s.recursive(
+    static_leaves,
+    lambda children: s.one_of(
+        s.lists(children, max_size=3),
+        s.dictionaries(keys=s.text(alphabet='ab', max_size=2), values=children, max_size=3),
+    ),
+    max_leaves=10,
+)
+
+
+class TestRenderTemplatesProperties(unittest.TestCase):
+
+    @given(values)
+    @example({'a': [1, {'b': '{{ some_var }}'}], 'b': ['static']})
+    @example(('{{ some_var }}', 1))
+    def test_matches_templar(self, value):
+        templar = make_templar()
+        self.assertEqual(render_templates(templar, value), templar.template(value))
+
+    @given(static_values)
+    def test_static_values_are_untouched(self, value):
+        self.assertIs(render_templates(make_templar(), value), value)
@@ -0,0 +1,45 @@
+import unittest
+
+from hypothesis import given
+from hypothesis import example
+import hypothesis.strategies as s
+
+from ansible_merge_vars_core import SORTED_UNION
+from ansible_merge_vars_core import merge_list
+from ansible_merge_vars_core import sorted_union
+
+
+def sort_and_dedup(lists):
+    """ The obvious implementation, which is the reference for sorted_union() """
+    deduped = []
+    for item in sorted(item for val in lists for item in val):
+        if item not in deduped:
+            deduped.append(item)
+    return deduped
+
+
+int_lists = s.lists(s.lists(s.integers(min_value=-5, max_value=5), max_size=10), max_size=6)
+
+
+class TestSortedUnionProperties(unittest.TestCase):
+
+    @given(int_lists)
+    @example([[1, 2], [True, 1.0, 3], []])
+    def test_matches_reference(self, lists):
+        self.assertEqual(sorted_union(lists), sort_and_dedup(lists))
+
+    @given(int_lists)
+    def test_sorted_sources_match_reference(self, lists):
+        lists = [sorted(val) for val in lists]
+        self.assertEqual(sorted_union(lists), sort_and_dedup(lists))
+
+    @given(int_lists)
+    def test_merge_list_ignores_dedup(self, lists):
+        self.assertEqual(
+            merge_list(lists, False, list_merge=SORTED_UNION),
+            merge_list(lists, True, list_merge=SORTED_UNION),
+        )
+
+    @given(s.lists(s.lists(s.text(alphabet='abc', max_size=3), max_size=10), max_size=6))
+    def test_strings_match_reference(self, lists):
+        self.assertEqual(sorted_union(lists), sort_and_dedup(lists))
@@ -0,0 +1,18 @@
+import unittest
+
+from hypothesis import given
+import hypothesis.strategies as s
+
+from ansible_merge_vars_core import SuffixIndex
+
+
+# A tiny alphabet, so that lots of names share suffixes
+names = s.text(alphabet='ab_', max_size=6)
+
+
+class TestSuffixIndexProperties(unittest.TestCase):
+
+    @given(s.lists(names, max_size=50), names)
+    def test_matches_linear_scan(self, var_names, suffix):
+        expected = sorted(name for name in set(var_names) if name.endswith(suffix))
+        self.assertEqual(SuffixIndex(set(var_names)).matching(suffix), expected)
@@ -0,0 +1,395 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ansible import constants as C
+from ansible.errors import AnsibleError
+from ansible.template import Templar
+import mock
+
+import ansible_merge_vars
+
+from ansible_merge_vars_caching import DEFAULT_CACHE_SIZE, MERGE_CACHE, PERSISTENT_CACHES
+from ansible_merge_vars_core import _OPAQUE
+from ansible_merge_vars_templates import TEMPLATE_CACHE, parse_template_names
+from tests.utils import make_and_run_plugin
+
+
+class TestMergeCache(unittest.TestCase):
+    def setUp(self):
+        MERGE_CACHE.clear()
+        # A new temp dir for each run, like Ansible's
+        self.tmp_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(C, 'DEFAULT_LOCAL_TMP', self.tmp_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        MERGE_CACHE.clear()
+        MERGE_CACHE.resize(DEFAULT_CACHE_SIZE)
+        for _, cache in PERSISTENT_CACHES.values():
+            cache.close()
+        PERSISTENT_CACHES.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_same_inputs_hit_cache(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+        }
+        task_vars = {
+            'some_var': 'woohoo',
+            'var1_whatever__to_merge': ['{{ some_var }}'],
+            'var2_whatever__to_merge': [1, 2],
+        }
+
+        first = make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+        second = make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+
+        self.assertEqual(first, second)
+        self.assertEqual(second['ansible_facts']['merged_var'], [u'woohoo', 1, 2])
+        self.assertEqual((MERGE_CACHE.hits, MERGE_CACHE.misses), (1, 1))
+
+    def test_shared_between_worker_processes(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+            'merge_stats': True,
+        }
+        task_vars = {
+            'some_var': 'woohoo',
+            'var1_whatever__to_merge': ['{{ some_var }}', 1],
+        }
+        first = make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+        # Each host's task runs in a new worker, which starts with an empty
+        # MERGE_CACHE, and its own connection to the run's database
+        MERGE_CACHE.clear()
+        for _, cache in PERSISTENT_CACHES.values():
+            cache.close()
+        PERSISTENT_CACHES.clear()
+        second = make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+
+        self.assertFalse(first['merge_stats']['merges']['merged_var']['cached'])
+        self.assertTrue(second['merge_stats']['merges']['merged_var']['cached'])
+        self.assertEqual(second['ansible_facts']['merged_var'], [u'woohoo', 1])
+        self.assertEqual(os.listdir(self.tmp_dir), ['merge_vars_cache.db'])
+
+    def test_referenced_vars_are_part_of_key(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'dict',
+            'cache': True,
+        }
+        results = []
+        for hostname in ['host1', 'host2', 'host1']:
+            task_vars = {
+                'inventory_hostname': hostname,
+                'fqdn': '{{ inventory_hostname }}.example.com',
+                'var1_whatever__to_merge': {'name': '{{ fqdn }}'},
+            }
+            result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+            results.append(result['ansible_facts']['merged_var'])
+
+        self.assertEqual(results, [
+            {'name': u'host1.example.com'},
+            {'name': u'host2.example.com'},
+            {'name': u'host1.example.com'},
+        ])
+        self.assertEqual((MERGE_CACHE.hits, MERGE_CACHE.misses), (1, 2))
+
+    def test_lookups_are_not_cached(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+        }
+        task_vars = {
+            'var1_whatever__to_merge': ["{{ lookup('env', 'HOME') }}"],
+        }
+        make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(len(MERGE_CACHE), 0)
+
+    def test_ansible_filters(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+        }
+        task_vars = {
+            'flag': 'no',
+            'var1_whatever__to_merge': ['{{ flag | bool }}', '{{ [flag] | to_json }}'],
+        }
+        make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+        result = make_and_run_plugin(task_args=task_args, task_vars=dict(task_vars))
+        self.assertEqual(result['ansible_facts']['merged_var'], [False, u'["no"]'])
+        self.assertEqual((MERGE_CACHE.hits, MERGE_CACHE.misses), (1, 1))
+
+    def test_cache_size_evicts_least_recently_used(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+            'cache_size': 2,
+        }
+        for val in [1, 2, 1, 3, 1, 2]:
+            make_and_run_plugin(
+                task_args=task_args, task_vars={'var1_whatever__to_merge': [val]}
+            )
+        self.assertEqual(len(MERGE_CACHE), 2)
+        # 1 stays in the cache because it keeps getting used, 2 gets evicted by 3
+        self.assertEqual((MERGE_CACHE.hits, MERGE_CACHE.misses), (2, 4))
+
+    def test_invalid_cache_size(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'cache': True,
+            'cache_size': 0,
+        }
+        with self.assertRaises(AnsibleError):
+            make_and_run_plugin(task_args=task_args, task_vars={})
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        TEMPLATE_CACHE.clear()
+        self.template = Templar.template
+
+    def tearDown(self):
+        TEMPLATE_CACHE.clear()
+
+    def run_counting_templates(self, task_args, task_vars):
+        """
+        Run the plugin, and return the result and the template strings that
+        were rendered (the templar also calls itself with rendered values)
+
+        """
+        task_args = dict({'template_cache': True}, **task_args)
+        with mock.patch.object(
+                Templar, 'template', autospec=True, side_effect=self.template
+        ) as template:
+            result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        templated = [call[0][1] for call in template.call_args_list]
+        return result, [val for val in templated if '{{' in str(val)]
+
+    def test_repeated_templates_are_rendered_once(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'dict',
+            'recursive_dict_merge': True,
+        }
+        task_vars = {
+            'base_domain': 'example.com',
+            'var1_whatever__to_merge': {'web': {'domain': '{{ base_domain }}'}},
+            'var2_whatever__to_merge': {'db': {'domain': '{{ base_domain }}'}},
+        }
+
+        result, templated = self.run_counting_templates(task_args, task_vars)
+
+        self.assertEqual(result['ansible_facts']['merged_var'], {
+            'web': {'domain': u'example.com'},
+            'db': {'domain': u'example.com'},
+        })
+        self.assertEqual(templated, ['{{ base_domain }}'])
+
+    def test_cache_is_keyed_on_referenced_vars(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+        }
+        results = []
+        for domain in ['example.com', 'example.org']:
+            task_vars = {
+                'base_domain': domain,
+                'fqdn': 'www.{{ base_domain }}',
+                'var1_whatever__to_merge': ['{{ fqdn }}'],
+            }
+            result, _ = self.run_counting_templates(task_args, task_vars)
+            results.append(result['ansible_facts']['merged_var'])
+
+        self.assertEqual(results, [[u'www.example.com'], [u'www.example.org']])
+
+    def test_template_cache_can_be_disabled(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'dedup': False,
+            'template_cache': False,
+        }
+        task_vars = {
+            'base_domain': 'example.com',
+            'var1_whatever__to_merge': ['{{ base_domain }}', '{{ base_domain }}'],
+        }
+
+        _, templated = self.run_counting_templates(task_args, task_vars)
+
+        self.assertEqual(templated, ['{{ base_domain }}', '{{ base_domain }}'])
+        self.assertEqual(len(TEMPLATE_CACHE), 0)
+
+    def test_lookups_are_not_cached(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'dedup': False,
+        }
+        task_vars = {
+            'var1_whatever__to_merge': ["{{ lookup('env', 'HOME') }}"] * 2,
+        }
+
+        _, templated = self.run_counting_templates(task_args, task_vars)
+
+        self.assertEqual(len(templated), 2)
+        self.assertEqual(len(TEMPLATE_CACHE), 0)
+
+    def test_off_by_default(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+        }
+        make_and_run_plugin(task_args=task_args, task_vars={
+            'base_domain': 'example.com',
+            'var1_whatever__to_merge': ['{{ base_domain }}'],
+        })
+        self.assertEqual(len(TEMPLATE_CACHE), 0)
+
+    def test_ansible_filters_and_tests(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'dedup': False,
+        }
+        task_vars = {
+            'flag': 'yes',
+            'name': 'web-01',
+            'var1_whatever__to_merge': [
+                '{{ flag | bool }}',
+                '{{ name | regex_replace("-", "_") }}',
+                '{{ {"a": flag} | to_json }}',
+                '{{ name is ansible.builtin.match("web") }}',
+            ] * 2,
+        }
+
+        result, templated = self.run_counting_templates(task_args, task_vars)
+
+        self.assertEqual(
+            result['ansible_facts']['merged_var'], [True, u'web_01', u'{"a": "yes"}', True] * 2,
+        )
+        self.assertEqual(len(templated), 4)
+
+    def test_random_filters_are_not_cached(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'dedup': False,
+        }
+        task_vars = {
+            'var1_whatever__to_merge': [
+                '{{ [1, 2, 3] | ansible.builtin.shuffle }}',
+                '{{ 100 | ansible.builtin.random }}',
+            ],
+        }
+
+        self.run_counting_templates(task_args, task_vars)
+
+        self.assertEqual(len(TEMPLATE_CACHE), 0)
+        # Rendering this needs passlib, so it's only parsed
+        self.assertIs(
+            parse_template_names('{{ "secret" | ansible.builtin.password_hash("sha512") }}'),
+            _OPAQUE,
+        )
+
+
+class TestPersistentCache(unittest.TestCase):
+    task_vars = {
+        'user': 'bob',
+        'var1_whatever__to_merge': ['{{ user }}', 'alice'],
+        'var2_whatever__to_merge': ['carol'],
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'cache', 'merge_vars.db')
+        self.new_run()
+
+    def tearDown(self):
+        self.new_run()
+        shutil.rmtree(self.tmp_dir)
+
+    def new_run(self):
+        """ Forget everything that's only kept in memory """
+        for _, cache in PERSISTENT_CACHES.values():
+            cache.close()
+        PERSISTENT_CACHES.clear()
+        TEMPLATE_CACHE.clear()
+
+    def run_plugin(self, task_vars):
+        return make_and_run_plugin(task_args={
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'persistent_cache': self.path,
+            'merge_stats': True,
+        }, task_vars=task_vars)
+
+    def test_unchanged_merge_is_reused(self):
+        first = self.run_plugin(dict(self.task_vars))
+        self.new_run()
+        with mock.patch('ansible_merge_vars.merge_values') as merge_values:
+            second = self.run_plugin(dict(self.task_vars))
+        self.assertFalse(merge_values.called)
+        self.assertEqual(second['ansible_facts'], {'merged_var': ['bob', 'alice', 'carol']})
+        self.assertEqual(second['ansible_facts'], first['ansible_facts'])
+        self.assertTrue(second['merge_stats']['merges']['merged_var']['cached'])
+        self.assertEqual(second['merge_stats']['persistent_cache_hits'], 1)
+
+    def test_unchanged_sources_are_reused(self):
+        self.run_plugin(dict(self.task_vars))
+        self.new_run()
+        task_vars = dict(self.task_vars, var2_whatever__to_merge=['dave'])
+        with mock.patch(
+            'ansible_merge_vars.render_templates', wraps=ansible_merge_vars.render_templates,
+        ) as render_templates:
+            result = self.run_plugin(task_vars)
+        self.assertEqual(result['ansible_facts'], {'merged_var': ['bob', 'alice', 'dave']})
+        rendered = [call[0][1] for call in render_templates.call_args_list]
+        self.assertNotIn(self.task_vars['var1_whatever__to_merge'], rendered)
+        self.assertIn(['dave'], rendered)
+
+    def test_referenced_vars_are_part_of_key(self):
+        self.run_plugin(dict(self.task_vars))
+        self.new_run()
+        result = self.run_plugin(dict(self.task_vars, user='eve'))
+        self.assertEqual(result['ansible_facts'], {'merged_var': ['eve', 'alice', 'carol']})
+
+    def test_corrupt_cache(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        with mock.patch.object(ansible_merge_vars.display, 'warning') as warning:
+            result = self.run_plugin(dict(self.task_vars))
+        self.assertEqual(result['ansible_facts'], {'merged_var': ['bob', 'alice', 'carol']})
+        self.assertIn('corrupt', warning.call_args[0][0])
+        self.assertTrue(os.path.exists(self.path + '.corrupt'))
+
+        self.new_run()
+        with mock.patch('ansible_merge_vars.merge_values') as merge_values:
+            self.run_plugin(dict(self.task_vars))
+        self.assertFalse(merge_values.called)
@@ -0,0 +1,102 @@
+import codecs
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from ansible.plugins.loader import callback_loader
+import mock
+
+from ansible_merge_vars import STATS_ENV
+from ansible_merge_vars_templates import TEMPLATE_CACHE
+from ansible_merge_vars_callback import percentile
+from tests.utils import make_and_run_plugin
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+def make_callback(**options):
+    """
+    Load the callback plugin with Ansible's plugin loader, so that its options
+    are loaded from its DOCUMENTATION
+
+    """
+    callback_loader.add_directory(ROOT_DIR)
+    callback = callback_loader.get('ansible_merge_vars_callback')
+    callback.set_options(direct=options)
+    return callback
+
+
+def make_result(task_uuid, host, result):
+    task = mock.MagicMock(_uuid=task_uuid)
+    task.get_name.return_value = 'merge {}'.format(task_uuid)
+    return mock.MagicMock(
+        _task=task,
+        _host=mock.MagicMock(**{'get_name.return_value': host}),
+        _result=result,
+    )
+
+
+class TestMergeVarsProfileCallback(unittest.TestCase):
+    task_args = {
+        'suffix_to_merge': 'whatever__to_merge',
+        'merged_var_name': 'merged_var',
+        'expected_type': 'list',
+    }
+
+    def setUp(self):
+        TEMPLATE_CACHE.clear()
+        self.report_dir = tempfile.mkdtemp()
+        self.report_file = os.path.join(self.report_dir, 'report.json')
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop(STATS_ENV, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.report_dir)
+
+    def test_turns_on_merge_stats(self):
+        make_callback()
+        result = make_and_run_plugin(
+            task_args=self.task_args, task_vars={'a_whatever__to_merge': [1]}
+        )
+        self.assertIn('merge_stats', result)
+
+    def test_reports_each_task(self):
+        callback = make_callback(report_file=self.report_file, top_hosts=2)
+        for i in range(10):
+            task_vars = {
+                'a_whatever__to_merge': list(range(i)),
+                'b_whatever__to_merge': ['{{ foo }}'],
+                'foo': 'bar',
+            }
+            result = make_and_run_plugin(
+                task_args=dict(self.task_args, template_cache=True), task_vars=task_vars,
+            )
+            callback.v2_runner_on_ok(make_result('task1', 'host{}'.format(i), result))
+        callback.v2_runner_on_ok(make_result('task2', 'host0', {'changed': False}))
+        callback.v2_playbook_on_stats(mock.MagicMock())
+
+        with codecs.open(self.report_file, encoding='utf-8') as f:
+            report = json.load(f)['tasks']
+        self.assertEqual(len(report), 1)
+        task_report = report[0]
+        self.assertEqual(task_report['task'], 'merge task1')
+        self.assertEqual(task_report['count'], 10)
+        self.assertLessEqual(task_report['p50_seconds'], task_report['p99_seconds'])
+        self.assertEqual(len(task_report['slowest_hosts']), 2)
+        self.assertEqual(
+            [item['host'] for item in task_report['biggest_outputs']], ['host9', 'host8']
+        )
+        self.assertEqual(task_report['merge_cache_hit_rate'], 0.0)
+        self.assertEqual(task_report['template_cache_hit_rate'], 0.9)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertIsNone(percentile([], 50))
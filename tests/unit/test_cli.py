@@ -0,0 +1,141 @@
+import codecs
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from ansible_merge_vars_cli import group_hosts, main
+
+
+INVENTORY = """
+[web]
+web1
+web2
+web3
+
+[db]
+db1
+"""
+
+GROUP_VARS = {
+    'all': "all_ports__to_merge: [22]\n",
+    'web': "web_ports__to_merge: [80, 443, 22]\n",
+    'db': "db_ports__to_merge: [5432, '{{ inventory_hostname }}']\n",
+}
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.inventory = os.path.join(self.tmp_dir, 'hosts')
+        with codecs.open(self.inventory, 'w', encoding='utf-8') as f:
+            f.write(INVENTORY)
+        os.mkdir(os.path.join(self.tmp_dir, 'group_vars'))
+        for group, contents in GROUP_VARS.items():
+            path = os.path.join(self.tmp_dir, 'group_vars', group + '.yml')
+            with codecs.open(path, 'w', encoding='utf-8') as f:
+                f.write(contents)
+        self.output = os.path.join(self.tmp_dir, 'merged.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_cli(self, *args):
+        return main([
+            '-i', self.inventory, '-o', self.output,
+            '--suffix-to-merge', 'ports__to_merge', '--merged-var-name', 'merged_ports',
+            '--expected-type', 'list',
+        ] + list(args))
+
+    def test_merges_every_host(self):
+        self.assertEqual(self.run_cli('--jobs', '2'), 0)
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = json.load(f)
+
+        self.assertEqual(records, [
+            {'host': 'db1', 'facts': {'merged_ports': [22, 5432, 'db1']}},
+        ] + [
+            {'host': host, 'facts': {'merged_ports': [22, 80, 443]}}
+            for host in ['web1', 'web2', 'web3']
+        ])
+
+    def test_json_lines(self):
+        self.assertEqual(self.run_cli('--jobs', '1', '--format', 'jsonl', '--limit', 'web'), 0)
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record['host'] for record in records], ['web1', 'web2', 'web3'])
+
+    def test_errors_are_recorded_for_each_host(self):
+        os.mkdir(os.path.join(self.tmp_dir, 'host_vars'))
+        path = os.path.join(self.tmp_dir, 'host_vars', 'web1.yml')
+        with codecs.open(path, 'w', encoding='utf-8') as f:
+            f.write("web1_ports__to_merge: {http: 80}\n")
+        self.assertEqual(self.run_cli('--jobs', '1'), 1)
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = json.load(f)
+        self.assertEqual(
+            [sorted(record) for record in records],
+            [['facts', 'host'], ['error', 'host'], ['facts', 'host'], ['facts', 'host']],
+        )
+
+    def test_ansible_filters(self):
+        os.mkdir(os.path.join(self.tmp_dir, 'host_vars'))
+        path = os.path.join(self.tmp_dir, 'host_vars', 'web1.yml')
+        with codecs.open(path, 'w', encoding='utf-8') as f:
+            f.write("use_tls: 'yes'\n"
+                    "web1_ports__to_merge: ['{{ use_tls | bool }}', '{{ 8443 | string }}']\n")
+        self.assertEqual(self.run_cli('--jobs', '1', '--limit', 'web1'), 0)
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = json.load(f)
+        self.assertEqual(records, [
+            {'host': 'web1', 'facts': {'merged_ports': [22, True, '8443', 80, 443]}},
+        ])
+
+    def test_unexpected_errors_are_recorded_for_each_host(self):
+        with mock.patch('ansible_merge_vars_cli.merge_cache_key', side_effect=TypeError('key')), \
+                mock.patch('ansible_merge_vars_cli.ActionModule.run',
+                           side_effect=ValueError('boom')):
+            self.assertEqual(self.run_cli('--jobs', '1', '--limit', 'web'), 1)
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = json.load(f)
+        self.assertEqual(
+            [record['error'] for record in records], ['ValueError: boom'] * 3
+        )
+
+    def test_task_args_file(self):
+        task_args = os.path.join(self.tmp_dir, 'task_args.yml')
+        with codecs.open(task_args, 'w', encoding='utf-8') as f:
+            f.write("expected_type: list\n"
+                    "merges:\n"
+                    "  - {suffix_to_merge: ports__to_merge, merged_var_name: a}\n"
+                    "  - {suffix_to_merge: ports__to_merge, merged_var_name: b, dedup: no}\n")
+        self.assertEqual(
+            main(['-i', self.inventory, '-o', self.output, '--task-args', task_args]), 0
+        )
+        with codecs.open(self.output, encoding='utf-8') as f:
+            records = json.load(f)
+        self.assertEqual(records[-1]['facts'], {'a': [22, 80, 443], 'b': [22, 80, 443, 22]})
+
+    def test_invalid_task_args(self):
+        self.assertEqual(main(['-i', self.inventory, '--expected-type', 'list']), 2)
+
+    def test_hosts_with_same_inputs_are_merged_once(self):
+        task_args = {
+            'suffix_to_merge': 'ports__to_merge',
+            'merged_var_name': 'merged_ports',
+            'expected_type': 'list',
+        }
+        hosts = [
+            ('web1', {'a_ports__to_merge': [1, '{{ b }}'], 'b': 2, 'inventory_hostname': 'web1'}),
+            ('web2', {'a_ports__to_merge': [1, '{{ b }}'], 'b': 2, 'inventory_hostname': 'web2'}),
+            ('web3', {'a_ports__to_merge': [1, '{{ b }}'], 'b': 3, 'inventory_hostname': 'web3'}),
+            ('web4', {'a_ports__to_merge': ["{{ lookup('env', 'HOME') }}"]}),
+            ('web5', {'a_ports__to_merge': ["{{ lookup('env', 'HOME') }}"]}),
+        ]
+        groups = group_hosts(task_args, hosts)
+        self.assertEqual(
+            [names for _, names in groups], [['web1', 'web2'], ['web3'], ['web4'], ['web5']]
+        )
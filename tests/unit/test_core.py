@@ -0,0 +1,281 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from ansible.errors import AnsibleError
+
+from ansible_merge_vars_core import (
+    InternTable,
+    MergeError,
+    PersistentCache,
+    deduplicate,
+    deduplicate_numbers,
+    merge_values,
+    numpy_module,
+)
+from tests.utils import make_and_run_plugin
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+class TestCore(unittest.TestCase):
+    def test_does_not_import_ansible_or_numpy(self):
+        script = (
+            "import sys; import ansible_merge_vars_core; "
+            "sys.exit(any(name.split('.')[0] in ('ansible', 'jinja2', 'numpy') "
+            "for name in sys.modules))"
+        )
+        self.assertEqual(subprocess.call([sys.executable, '-c', script], cwd=ROOT_DIR), 0)
+
+    def test_raises_merge_errors(self):
+        with self.assertRaises(MergeError):
+            merge_values([[1], {'a': 1}], 'list', True, False)
+
+    def test_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() * 2
+
+        def tree(leaf):
+            value = {'leaf': leaf, 'items': [leaf]}
+            for _ in range(depth):
+                value = {'child': value}
+            return value
+
+        merged = merge_values([tree(1), tree(2)], 'dict', True, True)
+        for _ in range(depth):
+            merged = merged['child']
+        self.assertEqual(merged, {'leaf': 2, 'items': [1, 2]})
+
+    def test_plugin_raises_ansible_errors(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+        }
+        task_vars = {
+            'var1_whatever__to_merge': [1],
+            'var2_whatever__to_merge': {'a': 1},
+        }
+        with self.assertRaises(AnsibleError) as raised:
+            make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertIn('must be of the same type', str(raised.exception))
+
+
+@unittest.skipIf(numpy_module() is None, "NumPy isn't installed")
+class TestNumpyDedup(unittest.TestCase):
+    def assert_same_dedup(self, items):
+        with mock.patch('ansible_merge_vars_core.numpy_module', return_value=None):
+            expected = deduplicate(items)
+        deduped = deduplicate_numbers(items)
+        self.assertEqual(deduped, expected)
+        self.assertEqual([type(item) for item in deduped], [type(item) for item in expected])
+
+    def test_keeps_first_occurrences_in_order(self):
+        self.assertEqual(deduplicate_numbers([3, 1, 3, 2, 1, -5]), [3, 1, 2, -5])
+
+    def test_matches_python(self):
+        self.assert_same_dedup([5, 1.0, 1, 2.5, 5.0, -0.0, 0, 2.5, 7])
+        self.assert_same_dedup([2 ** 62, -2 ** 62, 2 ** 62, 0])
+        self.assert_same_dedup([0.1, 0.2, 0.1, float('inf'), float('-inf'), float('inf')])
+
+    def test_falls_back(self):
+        for items in [
+            [1, 2, 'a', 1],
+            [1, True, 1],
+            [1, 2.0, {'a': 1}],
+            [1.0, float('nan'), 1.0],
+            [2 ** 64, 1, 2 ** 64],
+            [2 ** 53 + 1, float(2 ** 53)],
+        ]:
+            self.assertIsNone(deduplicate_numbers(items))
+
+    def test_deduplicate_uses_numpy_for_long_lists(self):
+        items = list(range(1000)) * 2
+        with mock.patch('ansible_merge_vars_core.deduplicate_numbers',
+                        wraps=deduplicate_numbers) as dedup:
+            self.assertEqual(deduplicate(items), list(range(1000)))
+            self.assertEqual(deduplicate(items[:10]), items[:10])
+            self.assertEqual(deduplicate(['a'] * 1000 + [1, 1]), ['a', 1])
+        self.assertEqual(dedup.call_count, 2)
+
+    def test_only_imported_for_long_lists_of_numbers(self):
+        script = (
+            "import sys; from ansible_merge_vars_core import deduplicate; "
+            "deduplicate(list(range(10)) * 2); deduplicate(['a'] * 1000); "
+            "imported = 'numpy' in sys.modules; "
+            "deduplicate(list(range(1000)) * 2); "
+            "sys.exit(imported or 'numpy' not in sys.modules)"
+        )
+        self.assertEqual(subprocess.call([sys.executable, '-c', script], cwd=ROOT_DIR), 0)
+
+
+class TestInternTable(unittest.TestCase):
+    def setUp(self):
+        self.table = InternTable(100)
+
+    def test_equal_subtrees_are_shared(self):
+        first = self.table.intern({'a': [1, 2], 'b': {'c': 'd'}})
+        second = self.table.intern([{'c': 'd'}, [1, 2]])
+
+        self.assertIs(second[0], first['b'])
+        self.assertIs(second[1], first['a'])
+        self.assertEqual(self.table.stats()['hits'], 2)
+        self.assertGreater(self.table.stats()['bytes_shared'], 0)
+
+    def test_equal_values_of_different_types_are_not_shared(self):
+        first = self.table.intern([1, 2])
+        second = self.table.intern([True, 2.0])
+
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(type(second[0]), bool)
+
+    def test_stats_since(self):
+        self.table.intern([1, 2])
+        before = self.table.stats()
+        self.table.intern([1, 2])
+        stats = self.table.stats(since=before)
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (1, 0, 1))
+        self.assertGreater(stats['bytes_shared'], 0)
+
+
+class TestPersistentCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'merge_vars.db')
+        self.warnings = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_cache(self, max_bytes=1000, max_age=60):
+        return PersistentCache(self.path, max_bytes, max_age, warn=self.warnings.append)
+
+    def test_survives_reopening(self):
+        cache = self.make_cache()
+        cache.set('key', {'a': [1, 2]})
+        cache.close()
+        cache = self.make_cache()
+        self.assertEqual(cache.get('key'), {'a': [1, 2]})
+        self.assertIsNone(cache.get('other'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = self.make_cache(max_bytes=30)
+        with mock.patch('ansible_merge_vars_core.time') as fake_time:
+            for now, key in enumerate(['a', 'b', 'c']):
+                fake_time.time.return_value = now
+                cache.set(key, 'x' * 8)
+            fake_time.time.return_value = 3
+            cache.get('a')
+            fake_time.time.return_value = 4
+            cache.set('d', 'x' * 8)
+        self.assertEqual([key for key in 'abcd' if cache.get(key)], ['a', 'c', 'd'])
+
+    def test_old_entries_are_evicted(self):
+        cache = self.make_cache(max_age=60)
+        with mock.patch('ansible_merge_vars_core.time') as fake_time:
+            fake_time.time.return_value = 0
+            cache.set('old', 1)
+            fake_time.time.return_value = 61
+            cache.set('new', 2)
+        self.assertEqual((cache.get('old'), cache.get('new')), (None, 2))
+
+    def test_errors_while_evicting_are_not_fatal(self):
+        cache = self.make_cache(max_bytes=30)
+        cache.set('a', 'x' * 20)
+        conn = cache._connect()  # pylint: disable=protected-access
+
+        def execute(sql, *args):
+            if 'ORDER BY accessed' in sql:
+                raise sqlite3.OperationalError('database is locked')
+            return conn.execute(sql, *args)
+
+        cache._conn = mock.Mock(wraps=conn, execute=execute)  # pylint: disable=protected-access
+        cache.set('b', 'x' * 20)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertIn('database is locked', self.warnings[0])
+        self.assertEqual(cache.get('b'), 'x' * 20)
+
+    def assert_total_is_consistent(self, cache):
+        conn = cache._connect()  # pylint: disable=protected-access
+        total = conn.execute('SELECT size FROM totals').fetchone()[0]
+        self.assertEqual(
+            total, conn.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0],
+        )
+        return total
+
+    def test_total_size_is_kept_up_to_date(self):
+        cache = self.make_cache(max_bytes=30, max_age=60)
+        with mock.patch('ansible_merge_vars_core.time') as fake_time:
+            fake_time.time.return_value = 0
+            cache.set('a', 'x' * 8)
+            cache.set('b', 'x' * 8)
+            self.assertEqual(self.assert_total_is_consistent(cache), 20)
+            # Replaced
+            cache.set('a', 'x' * 2)
+            self.assertEqual(self.assert_total_is_consistent(cache), 14)
+            # Least recently used evicted
+            cache.set('c', 'x' * 18)
+            self.assertEqual(self.assert_total_is_consistent(cache), 24)
+            # Too old
+            fake_time.time.return_value = 100
+            cache.set('d', 1)
+            self.assertEqual(self.assert_total_is_consistent(cache), 1)
+
+    def test_old_entries_are_only_evicted_periodically(self):
+        cache = self.make_cache(max_age=60)
+        conn = cache._connect()  # pylint: disable=protected-access
+        with mock.patch('ansible_merge_vars_core.time') as fake_time:
+            for now, key in [(0, 'a'), (50, 'old'), (61, 'b'), (115, 'c')]:
+                fake_time.time.return_value = now
+                cache.set(key, 1)
+            # Too old, but it's only been 54 seconds since old entries were evicted
+            keys = [row[0] for row in conn.execute('SELECT key FROM entries ORDER BY key')]
+            self.assertEqual(keys, ['b', 'c', 'old'])
+            fake_time.time.return_value = 121
+            cache.set('d', 1)
+        keys = [row[0] for row in conn.execute('SELECT key FROM entries ORDER BY key')]
+        self.assertEqual(keys, ['b', 'c', 'd'])
+
+    def test_old_schema_is_replaced(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('CREATE TABLE entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        conn.execute('PRAGMA user_version = 1')
+        conn.close()
+        cache = self.make_cache()
+        cache.set('key', 1)
+        self.assertEqual(cache.get('key'), 1)
+        self.assertEqual(self.assert_total_is_consistent(cache), 1)
+        self.assertEqual(self.warnings, [])
+
+    def test_values_that_cant_be_encoded_are_not_stored(self):
+        cache = self.make_cache()
+        cache.set('key', object())
+        self.assertIsNone(cache.get('key'))
+
+    def test_corrupt_database_is_replaced(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        cache = self.make_cache()
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 1)
+        self.assertEqual(cache.get('key'), 1)
+        self.assertEqual(len(self.warnings), 1)
+        self.assertTrue(os.path.exists(self.path + '.corrupt'))
+
+    def test_unusable_database_misses(self):
+        cache = PersistentCache(
+            os.path.join(self.path, 'not', 'a', 'dir'), 1000, 60, warn=self.warnings.append,
+        )
+        with open(self.path, 'wb'):
+            pass
+        cache.set('key', 1)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(len(self.warnings), 1)
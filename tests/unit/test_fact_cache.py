@@ -0,0 +1,178 @@
+import codecs
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from ansible.plugins.loader import cache_loader
+import mock
+import yaml
+
+from ansible_merge_vars_fact_cache import REFERENCE_KEY, TOUCH_INTERVAL
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+def make_cache(cache_dir, **options):
+    """
+    Load the cache plugin with Ansible's plugin loader, so that its options
+    are loaded from its DOCUMENTATION
+
+    """
+    cache_loader.add_directory(ROOT_DIR)
+    options.setdefault('_timeout', 0)
+    options.setdefault('content_store_min_size', 100)
+    return cache_loader.get('ansible_merge_vars_fact_cache', _uri=cache_dir, **options)
+
+
+class TestContentAddressedFactCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.big_fact = {'user{}'.format(i): {'uid': i} for i in range(50)}
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def stored_objects(self):
+        store = os.path.join(self.cache_dir, '.objects')
+        return [name for _, _, names in os.walk(store) for name in names]
+
+    def test_large_facts_are_stored_once(self):
+        cache = make_cache(self.cache_dir)
+        for host in ['host1', 'host2', 'host3']:
+            cache.set(host, {'merged_users': self.big_fact, 'small': [1, 2]})
+
+        self.assertEqual(len(self.stored_objects()), 1)
+        with codecs.open(os.path.join(self.cache_dir, 'host1'), encoding='utf-8') as f:
+            host_file = yaml.safe_load(f)
+        self.assertEqual(list(host_file['merged_users'].keys()), [REFERENCE_KEY])
+        self.assertEqual(host_file['small'], [1, 2])
+
+    def test_references_are_resolved_on_read(self):
+        make_cache(self.cache_dir).set('host1', {'merged_users': self.big_fact, 'small': [1]})
+
+        # A new cache, so that nothing comes from memory
+        facts = make_cache(self.cache_dir).get('host1')
+
+        self.assertEqual(facts, {'merged_users': self.big_fact, 'small': [1]})
+        self.assertEqual(make_cache(self.cache_dir).keys(), ['host1'])
+
+    def test_missing_object_is_a_miss(self):
+        make_cache(self.cache_dir).set('host1', {'merged_users': self.big_fact})
+        shutil.rmtree(os.path.join(self.cache_dir, '.objects'))
+
+        cache = make_cache(self.cache_dir)
+        with self.assertRaises(KeyError):
+            cache.get('host1')
+        self.assertFalse(cache.contains('host1'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'host1')))
+
+    def test_custom_store_and_min_size(self):
+        store = os.path.join(self.cache_dir, 'store')
+        cache = make_cache(self.cache_dir, content_store=store, content_store_min_size=10 ** 6)
+        cache.set('host1', {'merged_users': self.big_fact})
+        self.assertFalse(os.path.exists(store))
+
+        cache = make_cache(self.cache_dir, content_store=store, content_store_min_size=1)
+        cache.set('host1', {'merged_users': self.big_fact})
+        self.assertTrue(os.listdir(store))
+
+    def object_paths(self):
+        store = os.path.join(self.cache_dir, '.objects')
+        return [
+            os.path.join(directory, name)
+            for directory, _, names in os.walk(store) for name in names
+        ]
+
+    def age_objects(self, seconds):
+        for path in self.object_paths():
+            when = os.path.getmtime(path) - seconds
+            os.utime(path, (when, when))
+
+    def test_objects_are_touched_when_referenced(self):
+        make_cache(self.cache_dir).set('host1', {'merged_users': self.big_fact})
+        self.age_objects(10 * TOUCH_INTERVAL)
+
+        make_cache(self.cache_dir).set('host2', {'merged_users': self.big_fact})
+        path, = self.object_paths()
+        self.assertGreater(os.path.getmtime(path), time.time() - TOUCH_INTERVAL)
+
+    def test_unreferenced_objects_are_pruned_after_timeout(self):
+        make_cache(self.cache_dir, _timeout=60).set('host1', {'merged_users': self.big_fact})
+        self.age_objects(30)
+        make_cache(self.cache_dir, _timeout=60)
+        self.assertEqual(len(self.object_paths()), 1)
+
+        self.age_objects(TOUCH_INTERVAL + 60)
+        make_cache(self.cache_dir, _timeout=60)
+        self.assertEqual(self.object_paths(), [])
+
+    def test_objects_are_kept_without_timeout(self):
+        make_cache(self.cache_dir).set('host1', {'merged_users': self.big_fact})
+        self.age_objects(10 * TOUCH_INTERVAL)
+        make_cache(self.cache_dir)
+        self.assertEqual(len(self.object_paths()), 1)
+
+    def test_flush_removes_default_store(self):
+        cache = make_cache(self.cache_dir)
+        cache.set('host1', {'merged_users': self.big_fact})
+        cache.flush()
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, '.objects')))
+
+        # It's written again when it's needed again
+        cache.set('host1', {'merged_users': self.big_fact})
+        self.assertEqual(make_cache(self.cache_dir).get('host1')['merged_users'], self.big_fact)
+
+    def test_flush_keeps_custom_store(self):
+        store = os.path.join(self.cache_dir, 'store')
+        cache = make_cache(self.cache_dir, content_store=store)
+        cache.set('host1', {'merged_users': self.big_fact})
+        cache.flush()
+        self.assertTrue(os.listdir(store))
+
+    def test_interns_facts(self):
+        cache = make_cache(self.cache_dir, intern_facts=True)
+        cache.set('host1', {'merged_users': self.big_fact, 'ports': [22, 80]})
+        cache.set('host2', {'merged_users': dict(self.big_fact), 'ports': [22, 443]})
+
+        host1, host2 = cache.get('host1'), cache.get('host2')
+        self.assertIs(host1['merged_users'], host2['merged_users'])
+        self.assertIsNot(host1['ports'], host2['ports'])
+        # Ansible updates each host's facts in place, so they're never shared
+        self.assertIsNot(host1, host2)
+
+    def test_interns_facts_read_back(self):
+        cache = make_cache(self.cache_dir)
+        for host in ['host1', 'host2']:
+            cache.set(host, {'merged_users': self.big_fact})
+
+        cache = make_cache(self.cache_dir, intern_facts=True)
+        self.assertIs(cache.get('host1')['merged_users'], cache.get('host2')['merged_users'])
+
+    def test_reports_interning(self):
+        with mock.patch('atexit.register') as register:
+            cache = make_cache(self.cache_dir, intern_facts=True)
+        for host in ['host1', 'host2']:
+            cache.set(host, {'merged_users': dict(self.big_fact)})
+
+        # The plugin loader imports the plugin under its own module name
+        module = sys.modules[type(cache).__module__]
+        with mock.patch.object(module, 'display') as display:
+            cache.flush()
+            # At exit, only what's happened since the last report
+            register.call_args[0][0]()
+        first, second = [json.loads(call[0][0].split(': ', 1)[1])
+                         for call in display.vvv.call_args_list]
+        self.assertEqual(first['hits'], 51)
+        self.assertGreater(first['bytes_shared'], 0)
+        self.assertEqual((second['hits'], second['misses'], second['bytes_shared']), (0, 0, 0))
+
+    def test_no_interning_by_default(self):
+        cache = make_cache(self.cache_dir)
+        cache.set('host1', {'merged_users': self.big_fact})
+        cache.set('host2', {'merged_users': dict(self.big_fact)})
+        self.assertIsNot(cache.get('host1')['merged_users'], cache.get('host2')['merged_users'])
@@ -0,0 +1,127 @@
+import os
+import unittest
+
+from ansible.errors import AnsibleError
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import lookup_loader
+from ansible.template import Templar
+import mock
+
+import ansible_merge_vars_lookup
+from ansible_merge_vars_lookup import MERGED_VALUES, LookupModule
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+
+def make_lookup(task_vars):
+    templar = Templar(loader=DataLoader(), variables=task_vars)
+    return LookupModule(loader=templar._loader, templar=templar)  # pylint: disable=protected-access
+
+
+class TestMergeVarsLookup(unittest.TestCase):
+    def setUp(self):
+        MERGED_VALUES.clear()
+        self.task_vars = {
+            'domain': 'example.com',
+            'a_hosts__to_merge': ['www.{{ domain }}', 'db'],
+            'b_hosts__to_merge': ['db', 'mail'],
+            'a_users__to_merge': {'alice': {'uid': 1}},
+            'b_users__to_merge': {'alice': {'shell': 'zsh'}},
+        }
+
+    def test_merges_like_the_action_plugin(self):
+        lookup = make_lookup(self.task_vars)
+        self.assertEqual(
+            lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list'),
+            [['www.example.com', 'db', 'mail']],
+        )
+        self.assertEqual(
+            lookup.run(
+                ['users__to_merge'], self.task_vars,
+                expected_type='dict', recursive_dict_merge=True,
+            ),
+            [{'alice': {'uid': 1, 'shell': 'zsh'}}],
+        )
+
+    def test_from_template(self):
+        lookup_loader.add_directory(ROOT_DIR)
+        templar = Templar(loader=DataLoader(), variables=self.task_vars)
+        merged = templar.template(
+            "{{ lookup('ansible_merge_vars_lookup', 'hosts__to_merge', "
+            "expected_type='list', dedup=False) }}"
+        )
+        self.assertEqual(merged, ['www.example.com', 'db', 'db', 'mail'])
+
+    def test_memoized_for_the_same_vars_and_options(self):
+        lookup = make_lookup(self.task_vars)
+        with mock.patch.object(
+            ansible_merge_vars_lookup, 'merge_one', wraps=ansible_merge_vars_lookup.merge_one,
+        ) as merge_one:
+            first = lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list')
+            second = lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list')
+            self.assertIs(first[0], second[0])
+            self.assertEqual(merge_one.call_count, 1)
+
+            lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list', dedup=False)
+            self.assertEqual(merge_one.call_count, 2)
+
+            other_vars = dict(self.task_vars, c_hosts__to_merge=['ftp'])
+            merged = make_lookup(other_vars).run(
+                ['hosts__to_merge'], other_vars, expected_type='list',
+            )
+            self.assertEqual(merged, [['www.example.com', 'db', 'mail', 'ftp']])
+            self.assertEqual(merge_one.call_count, 3)
+
+    def test_memoized_by_content(self):
+        lookup = make_lookup(self.task_vars)
+        with mock.patch.object(
+            ansible_merge_vars_lookup, 'merge_one', wraps=ansible_merge_vars_lookup.merge_one,
+        ) as merge_one:
+            first = lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list')
+            # A new dict with the same vars, like Ansible builds for each template
+            same_vars = dict(self.task_vars)
+            second = make_lookup(same_vars).run(
+                ['hosts__to_merge'], same_vars, expected_type='list',
+            )
+            self.assertIs(first[0], second[0])
+            self.assertEqual(merge_one.call_count, 1)
+
+            # A var that a template references is part of the key
+            other_domain = dict(self.task_vars, domain='example.org')
+            merged = make_lookup(other_domain).run(
+                ['hosts__to_merge'], other_domain, expected_type='list',
+            )
+            self.assertEqual(merged, [['www.example.org', 'db', 'mail']])
+            self.assertEqual(merge_one.call_count, 2)
+
+    def test_lookups_in_templates_are_not_memoized(self):
+        self.task_vars['c_hosts__to_merge'] = ["{{ lookup('env', 'HOME') }}"]
+        lookup = make_lookup(self.task_vars)
+        lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list')
+        self.assertEqual(len(MERGED_VALUES), 0)
+
+    def test_dicts_with_expected_type_list(self):
+        lookup = make_lookup(self.task_vars)
+        self.assertEqual(
+            lookup.run(
+                ['users__to_merge'], self.task_vars,
+                expected_type='list', recursive_dict_merge=True,
+            ),
+            [{'alice': {'uid': 1, 'shell': 'zsh'}}],
+        )
+
+    def test_invalid_options(self):
+        lookup = make_lookup(self.task_vars)
+        with self.assertRaises(AnsibleError):
+            lookup.run(['hosts__to_merge'], self.task_vars)
+        with self.assertRaises(AnsibleError):
+            lookup.run(['hosts'], self.task_vars, expected_type='list')
+        with self.assertRaises(AnsibleError):
+            lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list', bogus=True)
+
+    def test_merge_errors(self):
+        self.task_vars['c_hosts__to_merge'] = {'ftp': True}
+        lookup = make_lookup(self.task_vars)
+        with self.assertRaises(AnsibleError):
+            lookup.run(['hosts__to_merge'], self.task_vars, expected_type='list')
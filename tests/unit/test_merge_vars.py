@@ -1,5 +1,33 @@
+import codecs
+import hashlib
+import json
+import os
+import shutil
+import stat
+import sys
+import tempfile
 import unittest
 
+from ansible.errors import AnsibleError
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.ajson import AnsibleJSONEncoder
+from ansible.parsing.dataloader import DataLoader
+from ansible.template import Templar
+from ansible.utils.unsafe_proxy import wrap_var
+from ansible.vars.hostvars import HostVars
+from ansible.vars.manager import VariableManager
+import mock
+
+import ansible_merge_vars
+from ansible_merge_vars import (
+    PROFILE_DIR_ENV,
+    SUFFIX_INDEX_MIN_LOOKUPS,
+    SuffixIndex,
+    SuffixScan,
+    suffix_index,
+)
+from ansible_merge_vars_output import output_chunks
+from ansible_merge_vars_templates import TEMPLATE_CACHE
 from tests.utils import make_and_run_plugin
 
 
@@ -24,6 +52,20 @@ class TestMergeVars(unittest.TestCase):
         result = make_and_run_plugin(task_args=task_args, task_vars={})
         self.assertEqual(result['ansible_facts'], expected)
 
+    def test_dicts_with_expected_type_list_are_not_deduped_into_keys(self):
+        task_args = {
+            'suffix_to_merge': 'x__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'recursive_dict_merge': True,
+        }
+        task_vars = {
+            'a_x__to_merge': {'k': [1, 1], 'j': 1},
+            'b_x__to_merge': {'k': [1, 2]},
+        }
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(result['ansible_facts']['merged_var'], {'k': [1, 2], 'j': 1})
+
     def test_render_jinja(self):
         task_args = {
             'suffix_to_merge': 'whatever__to_merge',
@@ -138,3 +180,608 @@ class TestMergeVars(unittest.TestCase):
         self.assertEqual(
             merged_var, [{'subvar_a': 1}, {'subvar_b': 2}, {'subvar_c': 3}]
         )
+
+
+class TestSuffixIndex(unittest.TestCase):
+    task_vars = {'b__to_merge': 1, 'a__to_merge': 2, 'c': 3, 'd__other': 4}
+
+    def test_scans_for_a_few_lookups(self):
+        for lookups in range(1, SUFFIX_INDEX_MIN_LOOKUPS):
+            index = suffix_index(self.task_vars, lookups)
+            self.assertIsInstance(index, SuffixScan)
+            self.assertEqual(index.matching('__to_merge'), ['a__to_merge', 'b__to_merge'])
+
+    def test_indexes_for_many_lookups(self):
+        index = suffix_index(self.task_vars, SUFFIX_INDEX_MIN_LOOKUPS)
+        self.assertIsInstance(index, SuffixIndex)
+        self.assertEqual(index.matching('__to_merge'), ['a__to_merge', 'b__to_merge'])
+        self.assertEqual(index.matching('__other'), ['d__other'])
+
+
+class TestBatchMerges(unittest.TestCase):
+    def test_merges_all_specs(self):
+        task_args = {
+            'dedup': False,
+            'merges': [
+                {
+                    'suffix_to_merge': 'ports__to_merge',
+                    'merged_var_name': 'merged_ports',
+                    'expected_type': 'list',
+                },
+                {
+                    'suffix_to_merge': 'users__to_merge',
+                    'merged_var_name': 'merged_users',
+                    'expected_type': 'dict',
+                    'recursive_dict_merge': True,
+                },
+                {
+                    'suffix_to_merge': 'packages__to_merge',
+                    'merged_var_name': 'merged_packages',
+                    'expected_type': 'list',
+                    'dedup': True,
+                },
+            ],
+        }
+        task_vars = {
+            'a_ports__to_merge': [22, 80],
+            'b_ports__to_merge': [80, 443],
+            'a_users__to_merge': {'admins': ['bob']},
+            'b_users__to_merge': {'admins': ['sally', 'bob']},
+            'a_packages__to_merge': ['vim', 'git'],
+            'b_packages__to_merge': ['git'],
+        }
+
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+
+        self.assertEqual(result['ansible_facts'], {
+            'merged_ports': [22, 80, 80, 443],
+            'merged_users': {'admins': ['bob', 'sally', 'bob']},
+            'merged_packages': ['vim', 'git'],
+        })
+        self.assertFalse(result['changed'])
+
+    def test_each_spec_is_validated(self):
+        task_args = {
+            'expected_type': 'list',
+            'merges': [
+                {'suffix_to_merge': 'ports__to_merge', 'merged_var_name': 'merged_ports'},
+                {'suffix_to_merge': 'ports__to_merge', 'merged_var_name': 'not valid'},
+            ],
+        }
+        with self.assertRaises(AnsibleError):
+            make_and_run_plugin(task_args=task_args, task_vars={})
+
+    def test_merged_var_names_must_be_unique(self):
+        task_args = {
+            'expected_type': 'list',
+            'merges': [
+                {'suffix_to_merge': 'ports__to_merge', 'merged_var_name': 'merged'},
+                {'suffix_to_merge': 'users__to_merge', 'merged_var_name': 'merged'},
+            ],
+        }
+        with self.assertRaises(AnsibleError):
+            make_and_run_plugin(task_args=task_args, task_vars={})
+
+    def test_suffix_cannot_be_set_for_whole_batch(self):
+        task_args = {
+            'suffix_to_merge': 'ports__to_merge',
+            'expected_type': 'list',
+            'merges': [
+                {'merged_var_name': 'merged_ports'},
+            ],
+        }
+        with self.assertRaises(AnsibleError):
+            make_and_run_plugin(task_args=task_args, task_vars={})
+
+
+class TestMergeStats(unittest.TestCase):
+    task_args = {
+        'suffix_to_merge': 'whatever__to_merge',
+        'merged_var_name': 'merged_var',
+        'expected_type': 'list',
+    }
+    task_vars = {
+        'var1_whatever__to_merge': [1, 2, '{{ foo }}'],
+        'var2_whatever__to_merge': [2, 3],
+        'foo': 'bar',
+    }
+
+    def test_no_stats_by_default(self):
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=self.task_vars)
+        self.assertNotIn('merge_stats', result)
+
+    def test_stats_for_each_phase(self):
+        task_args = dict(self.task_args, merge_stats=True)
+        result = make_and_run_plugin(task_args=task_args, task_vars=self.task_vars)
+
+        self.assertEqual(result['ansible_facts']['merged_var'], [1, 2, 'bar', 3])
+        stats = result['merge_stats']
+        self.assertEqual(
+            set(stats['seconds']), set(['total', 'scan', 'template', 'merge', 'dedup'])
+        )
+        self.assertTrue(all(seconds >= 0 for seconds in stats['seconds'].values()))
+        self.assertEqual(list(stats['merges']), ['merged_var'])
+        merge_stats = stats['merges']['merged_var']
+        self.assertEqual(merge_stats['sources'], 2)
+        self.assertEqual(merge_stats['items_before_dedup'], 5)
+        self.assertEqual(merge_stats['items_after_dedup'], 4)
+        self.assertEqual(merge_stats['output_bytes'], len('[1, 2, "bar", 3]'))
+        self.assertFalse(merge_stats['cached'])
+        self.assertLessEqual(merge_stats['seconds']['template'], stats['seconds']['template'])
+
+    def test_profile_dump_for_each_run(self):
+        profile_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_dir)
+        task_vars = dict(self.task_vars, inventory_hostname='host1')
+        with mock.patch.dict(os.environ, {PROFILE_DIR_ENV: profile_dir}):
+            for _ in range(2):
+                make_and_run_plugin(task_args=self.task_args, task_vars=task_vars)
+
+        dumps = sorted(os.listdir(profile_dir))
+        self.assertEqual(len(dumps), 2)
+        self.assertTrue(all(
+            name.startswith('merge_vars-host1-') and name.endswith('.prof') for name in dumps
+        ))
+
+
+class TestSortedUnion(unittest.TestCase):
+    def test_list_merge(self):
+        task_args = {
+            'suffix_to_merge': 'ports__to_merge',
+            'merged_var_name': 'merged_ports',
+            'expected_type': 'list',
+            'list_merge': 'sorted_union',
+        }
+        task_vars = {
+            'group1_ports__to_merge': [22, 443, 8080],
+            'group2_ports__to_merge': [8080, 80, '{{ ssh_port }}'],
+            'group3_ports__to_merge': [],
+            'ssh_port': 22,
+        }
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(result['ansible_facts']['merged_ports'], [22, 80, 443, 8080])
+
+    def test_recursive_dict_merge(self):
+        task_args = {
+            'suffix_to_merge': 'vlans__to_merge',
+            'merged_var_name': 'merged_vlans',
+            'expected_type': 'dict',
+            'recursive_dict_merge': True,
+            'list_merge': 'sorted_union',
+        }
+        task_vars = {
+            'group1_vlans__to_merge': {'switch1': {'ids': [30, 10]}, 'switch2': {'ids': [5]}},
+            'group2_vlans__to_merge': {'switch1': {'ids': [20, 10, 40]}},
+        }
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(result['ansible_facts']['merged_vlans'], {
+            'switch1': {'ids': [10, 20, 30, 40]},
+            'switch2': {'ids': [5]},
+        })
+
+    def test_items_must_be_comparable(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'list_merge': 'sorted_union',
+        }
+        task_vars = {
+            'var1_whatever__to_merge': [{'a': 1}],
+            'var2_whatever__to_merge': [{'b': 2}],
+        }
+        with self.assertRaises(AnsibleError) as raised:
+            make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertIn('compared', str(raised.exception))
+
+    def test_invalid_list_merge(self):
+        task_args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'list_merge': 'zip',
+        }
+        with self.assertRaises(AnsibleError) as raised:
+            make_and_run_plugin(task_args=task_args, task_vars={})
+        self.assertIn('list_merge must be one of', str(raised.exception))
+
+
+class TestKeyedListMerge(unittest.TestCase):
+    task_args = {
+        'suffix_to_merge': 'users__to_merge',
+        'merged_var_name': 'merged_users',
+        'expected_type': 'list',
+        'list_merge_key': 'name',
+    }
+    task_vars = {
+        'group1_users__to_merge': [
+            {'name': 'bob', 'shell': '/bin/bash', 'groups': ['admin']},
+            {'name': 'sally', 'shell': '/bin/zsh'},
+            'root',
+        ],
+        'group2_users__to_merge': [
+            {'name': 'bob', 'groups': ['wheel', 'admin']},
+            {'uid': 1000},
+            'root',
+            {'name': 'jane'},
+        ],
+    }
+
+    def test_later_items_replace_earlier_ones(self):
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=self.task_vars)
+        self.assertEqual(result['ansible_facts']['merged_users'], [
+            {'name': 'bob', 'groups': ['wheel', 'admin']},
+            {'name': 'sally', 'shell': '/bin/zsh'},
+            'root',
+            {'uid': 1000},
+            {'name': 'jane'},
+        ])
+
+    def test_recursive_merge_of_items(self):
+        task_args = dict(self.task_args, recursive_dict_merge=True)
+        result = make_and_run_plugin(task_args=task_args, task_vars=self.task_vars)
+        self.assertEqual(result['ansible_facts']['merged_users'], [
+            {'name': 'bob', 'shell': '/bin/bash', 'groups': ['admin', 'wheel']},
+            {'name': 'sally', 'shell': '/bin/zsh'},
+            'root',
+            {'uid': 1000},
+            {'name': 'jane'},
+        ])
+
+    def test_lists_in_recursive_dict_merge(self):
+        task_args = {
+            'suffix_to_merge': 'firewall__to_merge',
+            'merged_var_name': 'merged_firewall',
+            'expected_type': 'dict',
+            'recursive_dict_merge': True,
+            'list_merge_key': 'port',
+        }
+        task_vars = {
+            'group1_firewall__to_merge': {'rules': [
+                {'port': 22, 'from': ['10.0.0.0/8']}, {'port': 80, 'from': ['any']},
+            ]},
+            'group2_firewall__to_merge': {'rules': [{'port': 22, 'from': ['192.168.0.0/16']}]},
+        }
+        result = make_and_run_plugin(task_args=task_args, task_vars=task_vars)
+        self.assertEqual(result['ansible_facts']['merged_firewall'], {'rules': [
+            {'port': 22, 'from': ['10.0.0.0/8', '192.168.0.0/16']},
+            {'port': 80, 'from': ['any']},
+        ]})
+
+    def test_cannot_be_used_with_sorted_union(self):
+        task_args = dict(self.task_args, list_merge='sorted_union')
+        with self.assertRaises(AnsibleError) as raised:
+            make_and_run_plugin(task_args=task_args, task_vars={})
+        self.assertIn("list_merge_key can't be used", str(raised.exception))
+
+
+class TestSkipUnchanged(unittest.TestCase):
+    task_args = {
+        'suffix_to_merge': 'whatever__to_merge',
+        'merged_var_name': 'merged_var',
+        'expected_type': 'dict',
+        'skip_unchanged': True,
+    }
+    task_vars = {
+        'var1_whatever__to_merge': {'users': ['{{ user }}'], 'shell': '/bin/bash'},
+        'var2_whatever__to_merge': {'ports': [22, 80]},
+        'user': 'bob',
+    }
+
+    def test_new_fact_is_changed(self):
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=dict(self.task_vars))
+        self.assertTrue(result['changed'])
+        self.assertEqual(result['ansible_facts'], {'merged_var': {
+            'users': ['bob'], 'shell': '/bin/bash', 'ports': [22, 80],
+        }})
+
+    def test_same_fact_is_not_updated(self):
+        task_vars = dict(self.task_vars)
+        task_vars['ansible_facts'] = {
+            # As it would be after a round trip through the fact cache
+            'merged_var': wrap_var({'ports': [22, 80], 'shell': '/bin/bash', 'users': ['bob']}),
+        }
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=task_vars)
+        self.assertFalse(result['changed'])
+        self.assertEqual(result['ansible_facts'], {})
+
+    def test_different_fact_is_updated(self):
+        task_vars = dict(self.task_vars, merged_var={'ports': [22, 80]})
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=task_vars)
+        self.assertTrue(result['changed'])
+        self.assertIn('merged_var', result['ansible_facts'])
+
+    def test_types_are_compared(self):
+        task_vars = dict(self.task_vars, merged_var={
+            'users': ['bob'], 'shell': '/bin/bash', 'ports': [22.0, 80],
+        })
+        result = make_and_run_plugin(task_args=self.task_args, task_vars=task_vars)
+        self.assertTrue(result['changed'])
+
+
+class TestOutputFile(unittest.TestCase):
+    task_vars = {
+        'var1_whatever__to_merge': {'b': [1, 2], 'a': {'x': '{{ user }}'}},
+        'var2_whatever__to_merge': {'c': None, 'a': {'y': 1}},
+        'user': 'bob',
+    }
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_plugin(self, **task_args):
+        args = {
+            'suffix_to_merge': 'whatever__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'dict',
+            'recursive_dict_merge': True,
+            'output_file': os.path.join(self.tmp_dir, 'merged.json'),
+        }
+        args.update(task_args)
+        return make_and_run_plugin(task_args=args, task_vars=dict(self.task_vars))
+
+    def read(self, name='merged.json'):
+        with open(os.path.join(self.tmp_dir, name), 'rb') as f:
+            return f.read()
+
+    def test_json(self):
+        fact = self.run_plugin()['ansible_facts']['merged_var']
+        expected = {'a': {'x': 'bob', 'y': 1}, 'b': [1, 2], 'c': None}
+        data = self.read()
+        self.assertEqual(data, (json.dumps(expected, sort_keys=True) + '\n').encode('utf-8'))
+        self.assertEqual(fact, {
+            'path': os.path.join(self.tmp_dir, 'merged.json'),
+            'format': 'json',
+            'bytes': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+        })
+        self.assertEqual(os.listdir(self.tmp_dir), ['merged.json'])
+
+    def mode(self, name='merged.json'):
+        return stat.S_IMODE(os.stat(os.path.join(self.tmp_dir, name)).st_mode)
+
+    def test_new_file_mode_follows_the_umask(self):
+        umask = os.umask(0o027)
+        try:
+            self.run_plugin()
+        finally:
+            os.umask(umask)
+        self.assertEqual(self.mode(), 0o640)
+
+    def test_replaced_file_keeps_its_mode(self):
+        path = os.path.join(self.tmp_dir, 'merged.json')
+        with open(path, 'w'):
+            pass
+        os.chmod(path, 0o604)
+        self.run_plugin()
+        self.assertEqual(self.mode(), 0o604)
+
+    def test_jsonl(self):
+        self.run_plugin(output_format='jsonl')
+        lines = self.read().decode('utf-8').splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            [{'a': {'x': 'bob', 'y': 1}}, {'b': [1, 2]}, {'c': None}],
+        )
+
+        self.run_plugin(output_format='jsonl', expected_type='list', suffix_to_merge='l__to_merge')
+        self.assertEqual(self.read(), b'')
+
+    def test_lists(self):
+        task_vars = {'a_l__to_merge': [3, {'k': 'v'}], 'b_l__to_merge': [3, 4]}
+        path = os.path.join(self.tmp_dir, 'list.json')
+        make_and_run_plugin(task_args={
+            'suffix_to_merge': 'l__to_merge',
+            'merged_var_name': 'merged_var',
+            'expected_type': 'list',
+            'output_file': path,
+        }, task_vars=task_vars)
+        self.assertEqual(self.read('list.json'), b'[3, {"k": "v"}, 4]\n')
+
+    def test_nested_values_are_streamed(self):
+        value = {'big': [{'n': i} for i in range(1000)], 'small': 1}
+        chunks = list(output_chunks(value, 'json', AnsibleJSONEncoder(sort_keys=True)))
+        self.assertEqual(''.join(chunks), json.dumps(value, sort_keys=True) + '\n')
+        self.assertLess(max(len(chunk) for chunk in chunks), 100)
+
+        with mock.patch('ansible_merge_vars_output.WRITE_SIZE', 10):
+            self.run_plugin(output_format='jsonl')
+        self.assertEqual(
+            self.read(), b'{"a": {"x": "bob", "y": 1}}\n{"b": [1, 2]}\n{"c": null}\n',
+        )
+
+    def test_stats_use_file_size(self):
+        with mock.patch.object(ansible_merge_vars.MergeStats, 'record_output') as record_output:
+            result = self.run_plugin(merge_stats=True)
+        self.assertFalse(record_output.called)
+        self.assertEqual(
+            result['merge_stats']['merges']['merged_var']['output_bytes'],
+            result['ansible_facts']['merged_var']['bytes'],
+        )
+
+    def test_batch(self):
+        result = make_and_run_plugin(task_args={
+            'expected_type': 'dict',
+            'merges': [
+                {'suffix_to_merge': 'whatever__to_merge', 'merged_var_name': 'in_file',
+                 'output_file': os.path.join(self.tmp_dir, 'merged.json')},
+                {'suffix_to_merge': 'whatever__to_merge', 'merged_var_name': 'in_facts'},
+            ],
+        }, task_vars=dict(self.task_vars))
+        facts = result['ansible_facts']
+        self.assertEqual(set(facts['in_file']), set(['path', 'format', 'bytes', 'sha256']))
+        self.assertEqual(json.loads(self.read().decode('utf-8')), facts['in_facts'])
+
+    def test_invalid(self):
+        with self.assertRaises(AnsibleError):
+            self.run_plugin(output_format='yaml')
+        with self.assertRaises(AnsibleError):
+            self.run_plugin(output_file=os.path.join(self.tmp_dir, 'missing', 'merged.json'))
+        with self.assertRaises(AnsibleError):
+            make_and_run_plugin(task_args={
+                'expected_type': 'dict',
+                'output_file': os.path.join(self.tmp_dir, 'merged.json'),
+                'merges': [
+                    {'suffix_to_merge': 'whatever__to_merge', 'merged_var_name': 'one'},
+                    {'suffix_to_merge': 'whatever__to_merge', 'merged_var_name': 'two'},
+                ],
+            }, task_vars=dict(self.task_vars))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class TestDeferredTemplates(unittest.TestCase):
+    def setUp(self):
+        TEMPLATE_CACHE.clear()
+
+    templates = ['{{ env }}', '{{ env }}-base', '{{ env }}-override', 'www.{{ env }}',
+                 'web.{{ env }}', '{{ ports }}']
+
+    def run_plugin(self, task_vars, recursive_dict_merge, **task_args):
+        with mock.patch.object(Templar, 'template', autospec=True, side_effect=Templar.template) \
+                as template:
+            result = make_and_run_plugin(task_args=dict({
+                'suffix_to_merge': 'whatever__to_merge',
+                'merged_var_name': 'merged_var',
+                'expected_type': 'dict',
+                'recursive_dict_merge': recursive_dict_merge,
+            }, **task_args), task_vars=task_vars)
+        # Only the templates in the vars to merge, not the vars they reference
+        rendered = [call[0][1] for call in template.call_args_list]
+        return result['ansible_facts']['merged_var'], [
+            value for value in rendered if value in self.templates
+        ]
+
+    def test_overridden_values_are_not_rendered(self):
+        merged, rendered = self.run_plugin({
+            'env': 'prod',
+            'var1_whatever__to_merge': {'acl': {'a': '{{ env }}-base'}, 'zone': '{{ env }}'},
+            'var2_whatever__to_merge': {'acl': {'b': '{{ env }}-override'}},
+        }, recursive_dict_merge=False)
+        self.assertEqual(merged, {'acl': {'b': 'prod-override'}, 'zone': 'prod'})
+        self.assertEqual(sorted(rendered), ['{{ env }}', '{{ env }}-override'])
+
+    def test_overridden_scalars_are_not_rendered(self):
+        merged, rendered = self.run_plugin({
+            'env': 'prod',
+            'ports': [443],
+            'var1_whatever__to_merge': {'web': {'host': 'www.{{ env }}', 'ports': [80]}},
+            'var2_whatever__to_merge': {'web': {'host': 'web.{{ env }}', 'ports': '{{ ports }}'}},
+        }, recursive_dict_merge=True)
+        self.assertEqual(merged, {'web': {'host': 'web.prod', 'ports': [80, 443]}})
+        # Templates that might render to a list or dict are always rendered
+        self.assertEqual(sorted(rendered), ['web.{{ env }}', '{{ ports }}'])
+
+
+    def test_deeper_than_the_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 500
+
+        def tree(leaf):
+            value = {'host': leaf, 'ports': ['{{ ports }}']}
+            for _ in range(depth):
+                value = {'child': value}
+            return value
+
+        for recursive_dict_merge, template_cache in [(True, False), (False, False), (True, True)]:
+            merged, _ = self.run_plugin({
+                'env': 'prod',
+                'ports': 443,
+                'var1_whatever__to_merge': tree('www.{{ env }}'),
+                'var2_whatever__to_merge': tree('web.{{ env }}'),
+            }, recursive_dict_merge=recursive_dict_merge, template_cache=template_cache)
+            for _ in range(depth):
+                merged = merged['child']
+            self.assertEqual(merged, {'host': 'web.prod', 'ports': [443]})
+
+class TestAcrossHosts(unittest.TestCase):
+    task_args = {
+        'suffix_to_merge': 'backends__to_merge',
+        'merged_var_name': 'backends',
+        'expected_type': 'list',
+        'across_hosts': 'web',
+    }
+
+    def setUp(self):
+        TEMPLATE_CACHE.clear()
+        self.hostvars = {}
+        for i, name in enumerate(['web1', 'web2', 'web3', 'db1']):
+            self.hostvars[name] = {
+                'inventory_hostname': name,
+                'ip': '10.0.0.{}'.format(i + 1),
+                'app_backends__to_merge': [{'ip': '{{ ip }}', 'port': 8080}],
+                'lb_backends__to_merge': [{'ip': '10.0.0.100', 'port': 80}],
+            }
+        self.task_vars = {
+            'inventory_hostname': 'web1',
+            'groups': {'all': sorted(self.hostvars), 'web': ['web1', 'web2', 'web3']},
+            'hostvars': self.hostvars,
+        }
+
+    def run_plugin(self, **task_args):
+        args = dict(self.task_args, **task_args)
+        return make_and_run_plugin(task_args=args, task_vars=self.task_vars)
+
+    def test_group(self):
+        result = self.run_plugin()
+        self.assertEqual(result['ansible_facts']['backends'], [
+            {'ip': '10.0.0.1', 'port': 8080},
+            {'ip': '10.0.0.100', 'port': 80},
+            {'ip': '10.0.0.2', 'port': 8080},
+            {'ip': '10.0.0.3', 'port': 8080},
+        ])
+
+    def test_list_of_hosts(self):
+        result = self.run_plugin(across_hosts=['db1', 'web2', 'db1'], dedup=False)
+        self.assertEqual(result['ansible_facts']['backends'], [
+            {'ip': '10.0.0.4', 'port': 8080},
+            {'ip': '10.0.0.100', 'port': 80},
+            {'ip': '10.0.0.2', 'port': 8080},
+            {'ip': '10.0.0.100', 'port': 80},
+        ])
+
+    def test_dicts(self):
+        for name, host_vars in self.hostvars.items():
+            host_vars['members__to_merge'] = {'{}'.format(name): {'ip': '{{ ip }}'}}
+        result = self.run_plugin(
+            suffix_to_merge='members__to_merge', expected_type='dict', across_hosts='all',
+        )
+        self.assertEqual(result['ansible_facts']['backends'], {
+            'db1': {'ip': '10.0.0.4'},
+            'web1': {'ip': '10.0.0.1'},
+            'web2': {'ip': '10.0.0.2'},
+            'web3': {'ip': '10.0.0.3'},
+        })
+
+    def test_ansible_hostvars(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'hosts')
+            with codecs.open(path, 'w', encoding='utf-8') as f:
+                f.write(
+                    "[web]\n"
+                    "web1 ip=10.0.0.1\n"
+                    "web2 ip=10.0.0.2\n"
+                    "[web:vars]\n"
+                    "app_backends__to_merge=[{'ip': '{{ ip }}'}]\n"
+                )
+            loader = DataLoader()
+            inventory = InventoryManager(loader=loader, sources=[path])
+            variable_manager = VariableManager(loader=loader, inventory=inventory)
+            self.task_vars['hostvars'] = HostVars(inventory, variable_manager, loader)
+            self.task_vars['groups'] = inventory.get_groups_dict()
+            result = self.run_plugin()
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(
+            result['ansible_facts']['backends'], [{'ip': '10.0.0.1'}, {'ip': '10.0.0.2'}],
+        )
+
+    def test_invalid(self):
+        with self.assertRaises(AnsibleError):
+            self.run_plugin(across_hosts='nope')
+        with self.assertRaises(AnsibleError):
+            self.run_plugin(across_hosts=['web1', 'nope'])
+        with self.assertRaises(AnsibleError):
+            self.run_plugin(across_hosts={'web1': True})
@@ -0,0 +1,102 @@
+import codecs
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from ansible.inventory.manager import InventoryManager
+from ansible.parsing.dataloader import DataLoader
+from ansible.plugins.loader import vars_loader
+
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+
+FILES = {
+    'hosts': "[web]\nweb1\nweb2\nweb3\n\n[db]\ndb1 db1_ports__to_merge='[5432]'\n",
+    'group_vars/all.yml': "all_ports__to_merge: [22]\n",
+    'group_vars/web.yml': "web_ports__to_merge: [80, 443, '{{ inventory_hostname }}', 22]\n",
+    'host_vars/web3.yml': "web3_ports__to_merge: [8080]\n",
+    'merges.yml': (
+        "expected_type: list\n"
+        "merges:\n"
+        "  - {suffix_to_merge: ports__to_merge, merged_var_name: merged_ports}\n"
+        "  - {suffix_to_merge: ports__to_merge, merged_var_name: all_ports, dedup: no}\n"
+    ),
+}
+
+
+def make_vars_plugin(**options):
+    """
+    Load the vars plugin with Ansible's plugin loader, so that its options
+    are loaded from its DOCUMENTATION
+
+    """
+    vars_loader.add_directory(ROOT_DIR)
+    plugin = vars_loader.get('ansible_merge_vars_vars_plugin')
+    plugin.set_options(direct=options)
+    return plugin
+
+
+def plugin_module(plugin):
+    """
+    The module that the plugin loader loaded the plugin from, which is a
+    different module object than the one that `import` would give us
+
+    """
+    return sys.modules[type(plugin).__module__]
+
+
+class TestMergeVarsVarsPlugin(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for name, contents in FILES.items():
+            path = os.path.join(self.tmp_dir, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with codecs.open(path, 'w', encoding='utf-8') as f:
+                f.write(contents)
+        self.loader = DataLoader()
+        self.inventory = InventoryManager(
+            loader=self.loader, sources=[os.path.join(self.tmp_dir, 'hosts')]
+        )
+        self.plugin = make_vars_plugin(config=os.path.join(self.tmp_dir, 'merges.yml'))
+        self.merged_vars = plugin_module(self.plugin).MERGED_VARS
+        self.merged_vars.clear()
+        # Paths from earlier tests are gone
+        del plugin_module(self.plugin).PATHS[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def host_vars(self, name):
+        host = self.inventory.get_host(name)
+        return self.plugin.get_vars(self.loader, self.tmp_dir, [host])
+
+    def test_merges_inventory_vars(self):
+        self.assertEqual(self.host_vars('web1'), {
+            'merged_ports': [22, 80, 443, '{{ inventory_hostname }}'],
+            'all_ports': [22, 80, 443, '{{ inventory_hostname }}', 22],
+        })
+        self.assertEqual(self.host_vars('web3')['merged_ports'], [
+            22, 8080, 80, 443, '{{ inventory_hostname }}',
+        ])
+        self.assertEqual(self.host_vars('db1')['merged_ports'], [22, 5432])
+
+    def test_hosts_in_same_groups_share_merge(self):
+        web1 = self.host_vars('web1')
+        web2 = self.host_vars('web2')
+        web3 = self.host_vars('web3')
+
+        self.assertIs(web1['merged_ports'], web2['merged_ports'])
+        self.assertIsNot(web1['merged_ports'], web3['merged_ports'])
+        self.assertEqual(self.merged_vars.hits, 1)
+
+    def test_groups_are_ignored(self):
+        group = self.inventory.groups['web']
+        self.assertEqual(self.plugin.get_vars(self.loader, self.tmp_dir, [group]), {})
+
+    def test_nothing_without_config(self):
+        plugin = make_vars_plugin(config=None)
+        host = self.inventory.get_host('web1')
+        self.assertEqual(plugin.get_vars(self.loader, self.tmp_dir, [host]), {})